@@ -154,3 +154,28 @@ plt.title('Distribution of Pixel Classes (Classes ≥1%)', fontsize=16)
 plt.savefig('results/pixel_class_pie_chart.png', dpi=300)
 plt.show()
 # %%
+# Per-mask foreground fractions from the statistics index written by the counting step
+import sys
+sys.path.append("scripts")
+from stats_index import load_stats_index
+from utils import load_class_codes
+
+stats = load_stats_index("data/train/mask_stats.npz")
+class_codes = load_class_codes("meta/class_codes.tsv")
+code_to_name = {code: name for name, code in class_codes.items()}
+stats_df = pd.DataFrame({
+    'Class Name': [code_to_name[int(code)] for code in stats['class_code']],
+    'Foreground Percentage': stats['fg_fraction'] * 100,
+})
+
+plt.figure(figsize=(14, 8))
+sns.boxplot(x='Class Name', y='Foreground Percentage', data=stats_df)
+plt.xticks(rotation=90)
+plt.title('Foreground Percentage per Mask', fontsize=16)
+plt.ylabel('Foreground (%)', fontsize=14)
+plt.xlabel('Class Name', fontsize=14)
+plt.grid(axis='y', linestyle='--', alpha=0.7)
+plt.tight_layout()
+plt.savefig('results/mask_foreground_percentage.png', dpi=300)
+plt.show()
+# %%
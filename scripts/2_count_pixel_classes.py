@@ -1,14 +1,27 @@
-import numpy as np
-import cv2
 from pathlib import Path
-import csv
-from tqdm import tqdm
 import os
+import itertools
+import concurrent.futures
 import yaml
 import re
+import numpy as np
+from tqdm import tqdm
 from fire import Fire  # Add Fire for command-line arguments
 
-from utils import resolve_variables, load_config, extract_class_name
+from discovery import scan_files
+from image_io import read_image, configure as configure_image_io
+from manifest import load_manifest
+from mask_pass import (run_mask_pass, count_outcome, new_pixel_counts, accumulate_pixel_counts,
+                       write_pixel_counts_csv)
+from mask_store import mask_store_path, load_mask_store, store_stats_index
+from metrics import StageMetrics, write_metrics
+from profiling import profile_call, profiled_backend, tile_phases
+from rle import RleIndex
+from sampling import stratify, allocate_round, stratified_percentages, write_sampled_csv
+from split_views import split_view
+from stats_index import (build_stats_index, save_stats_index, load_stats_index, stats_index_path, index_pixel_counts,
+                         mask_bbox, EMPTY_BBOX)
+from utils import resolve_variables, load_config, extract_class_name, stream_map
 
 # Read the labels from the TSV file
 def read_labels_from_tsv(tsv_path):
@@ -25,7 +38,219 @@ def read_labels_from_tsv(tsv_path):
                     labels[label] = code
     return labels
 
-def main(config_path="./config/config.yaml", mask_dir=None, dataset_split="train"):
+def count_mask(mask_path, class_codes, name=None, multiclass=False):
+    """
+    Pixel statistics of one mask from a single 256-bin histogram.
+
+    Binary masks count every non-zero pixel as the class of the filename.
+    With multiclass, pixel values are class codes (e.g. the masks written by
+    3_reduce_mask_classes.py) and the non-zero bins are kept as "labels".
+
+    Returns:
+        Result like those of process_mask_once, or None if the class could not be determined
+    """
+    name = name or Path(mask_path).name
+    class_name = extract_class_name(name)
+    if not class_name or class_name not in class_codes:
+        print(f"\nWarning: Could not determine class for {name}")
+        return None
+    result = {"name": name, "class_name": class_name, "class_idx": class_codes[class_name], "prompt": None,
+              "failed": False}
+
+    mask = read_image(mask_path, "gray")
+    if mask is None:
+        print(f"\nError: Could not load mask at {mask_path}")
+        result.update(foreground=0, total=0, height=0, width=0, bbox=EMPTY_BBOX, failed=True)
+        return result
+
+    with tile_phases.phase("compute"):
+        histogram = np.bincount(mask.ravel(), minlength=256)
+        result.update(foreground=int(mask.size - histogram[0]), total=int(mask.size), height=int(mask.shape[0]),
+                      width=int(mask.shape[1]), bbox=mask_bbox(mask))
+        if multiclass:
+            result["labels"] = [[int(label), int(histogram[label])] for label in np.flatnonzero(histogram)]
+    return result
+
+
+def result_label_counts(result, multiclass=False):
+    """256-entry pixel count vector of a count_mask result."""
+    counts = np.zeros(256, dtype=np.int64)
+    if multiclass:
+        for label, count in result["labels"]:
+            counts[label] = count
+    else:
+        counts[0] = result["total"] - result["foreground"]
+        counts[result["class_idx"]] = result["foreground"]
+    return counts
+
+
+def count_chunk(items, class_codes, multiclass=False):
+    """Map step: summed pixel count vector of a chunk of (mask path, name) items, and their results."""
+    counts = np.zeros(256, dtype=np.int64)
+    results = []
+    for mask_path, name in items:
+        result = count_mask(mask_path, class_codes, name=name, multiclass=multiclass)
+        if result is not None and not result["failed"]:
+            counts += result_label_counts(result, multiclass)
+        results.append((mask_path, result))
+    return counts, results
+
+# Per-process state of the process backend, filled once by _init_count_worker
+_worker_state = {}
+
+def _init_count_worker(config_path, class_codes, multiclass):
+    configure_image_io(load_config(config_path))
+    _worker_state["class_codes"] = class_codes
+    _worker_state["multiclass"] = multiclass
+
+def _count_chunk_in_worker(items):
+    return count_chunk(items, **_worker_state)
+
+def count_files(mask_files, class_codes, config_path, names=None, counts_manifest=None, multiclass=False,
+                max_workers=None, chunk_size=64, metrics=None, desc="Counting masks", executor=None):
+    """
+    Count mask pixels as a map-reduce over a process pool.
+
+    Masks are submitted in chunks of chunk_size. Each worker returns the
+    summed np.bincount vector of its chunk and the per-mask results, and the
+    partial vectors are added up here, so that no per-pixel work is left to the
+    parent. Masks with up-to-date counts in counts_manifest are not submitted.
+    An existing pool from count_executor can be passed as executor and is left
+    running, e.g. for several calls in a row; otherwise one is created for the call.
+    
+    Returns:
+        (label_counts, results): 256-entry pixel count vector over all masks, and one
+        count_mask result per mask (None for masks of unknown class)
+    """
+    total = len(mask_files) if hasattr(mask_files, "__len__") else None
+    names = itertools.repeat(None) if names is None else names
+    label_counts = np.zeros(256, dtype=np.int64)
+    results = []
+    progress = tqdm(total=total, desc=desc, unit="file")
+
+    def add(mask_path, result, cached=False):
+        results.append(result)
+        count_outcome(metrics, result)
+        progress.update()
+        if result is None or result["failed"]:
+            return
+        if cached:
+            np.add(label_counts, result_label_counts(result, multiclass), out=label_counts)
+        elif counts_manifest is not None:
+            counts_manifest.update(mask_path, data={key: result[key] for key in
+                                                    ("foreground", "total", "height", "width", "bbox", "labels")
+                                                    if key in result})
+
+    def iter_pending():
+        # Masks with cached counts are added right away, only the others go to the workers
+        for mask_path, name in zip(mask_files, names):
+            name = name or Path(mask_path).name
+            class_name = extract_class_name(name)
+            cached = None
+            if counts_manifest is not None and class_name in class_codes:
+                cached = counts_manifest.lookup(mask_path)
+            if cached is None:
+                yield mask_path, name
+                continue
+            add(mask_path, {"name": name, "class_name": class_name, "class_idx": class_codes[class_name],
+                            "prompt": None, "failed": False, **cached["data"]}, cached=True)
+
+    max_workers = max_workers or os.cpu_count()
+    own_executor = executor is None
+    if own_executor:
+        executor = count_executor(config_path, class_codes, multiclass, max_workers)
+    pending = iter_pending()
+    chunks = iter(lambda: list(itertools.islice(pending, chunk_size)), [])
+    try:
+        with progress:
+            for counts, chunk_results in stream_map(_count_chunk_in_worker, chunks, max_workers,
+                                                    executor=executor):
+                label_counts += counts
+                for mask_path, result in chunk_results:
+                    add(mask_path, result)
+    finally:
+        if own_executor:
+            executor.shutdown(wait=True)
+    return label_counts, results
+
+def count_executor(config_path, class_codes, multiclass=False, max_workers=None):
+    """Process pool whose workers load the config and class codes once, for count_files."""
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=max_workers or os.cpu_count(),
+        initializer=_init_count_worker,
+        initargs=(str(config_path), class_codes, multiclass)
+    )
+
+def count_sample(mask_files, class_codes, config_path, sampling, names=None, counts_manifest=None,
+                 multiclass=False, max_workers=None, chunk_size=64, metrics=None, desc="Sampling masks"):
+    """
+    Estimate pixel percentages from a stratified random sample of the masks.
+
+    The masks are grouped by the class of their filename and read in rounds of
+    sampling["round_size"] masks through the map-reduce of count_files, until
+    the confidence interval of every percentage is within ± sampling["precision"]
+    percentage points or all masks have been read. All rounds share one
+    process pool, and each round is split into at least one chunk per worker.
+    Masks that fail to decode are left out of both the sample and the
+    population, as they are left out of the exact count.
+
+    Returns:
+        (percentages, half_widths, population, sampled): 256-entry arrays in percent,
+        and the masks per class in the split and decoded in the sample
+    """
+    strata, unknown = stratify(list(mask_files), names, seed=sampling.get("seed", 0))
+    unknown += sum(len(items) for class_name, items in strata.items() if class_name not in class_codes)
+    if unknown:
+        print(f"Warning: Leaving out {unknown} masks of unknown class")
+    strata = {class_name: items for class_name, items in strata.items() if class_name in class_codes}
+    population = {class_name: len(items) for class_name, items in strata.items()}
+    read = dict.fromkeys(strata, 0)
+    failed = dict.fromkeys(strata, 0)
+    samples = {class_name: [] for class_name in strata}
+    percentages, half_widths = np.zeros(256), np.full(256, np.inf)
+
+    max_workers = max_workers or os.cpu_count()
+    with count_executor(config_path, class_codes, multiclass, max_workers) as executor:
+        for round_number in itertools.count(1):
+            allocation = allocate_round(population, read, sampling.get("round_size", 256),
+                                        sampling.get("min_per_class", 10))
+            batch = [item for class_name, take in allocation.items()
+                     for item in strata[class_name][read[class_name]:read[class_name] + take]]
+            if not batch:
+                break
+            _, results = count_files([mask_path for mask_path, _ in batch], class_codes, config_path,
+                                     names=[name for _, name in batch], counts_manifest=counts_manifest,
+                                     multiclass=multiclass, max_workers=max_workers,
+                                     chunk_size=max(1, min(chunk_size, -(-len(batch) // max_workers))),
+                                     metrics=metrics, desc=f"{desc} (round {round_number})", executor=executor)
+            for class_name, take in allocation.items():
+                read[class_name] += take
+            for result in results:
+                if result is None:
+                    continue
+                if result["failed"]:
+                    failed[result["class_name"]] += 1
+                else:
+                    samples[result["class_name"]].append(result_label_counts(result, multiclass))
+
+            percentages, half_widths = stratified_percentages(
+                {class_name: np.array(counts).reshape(-1, 256) for class_name, counts in samples.items()},
+                {class_name: size - failed[class_name] for class_name, size in population.items()},
+                sampling.get("confidence", 0.95)
+            )
+            widest = float(np.max(half_widths))
+            print(f"Round {round_number}: {sum(map(len, samples.values()))} of {sum(population.values())} masks "
+                  f"sampled, widest interval ±{widest:.4f} percentage points")
+            if widest <= sampling.get("precision", 0.1):
+                break
+    if any(failed.values()):
+        print(f"Warning: Left out {sum(failed.values())} sampled masks that could not be decoded")
+    sampled = {class_name: len(counts) for class_name, counts in samples.items()}
+    return percentages, half_widths, population, sampled
+
+def main(config_path="./config/config.yaml", mask_dir=None, dataset_split="train", incremental=None,
+         use_index=False, split_manifest=None, store=None, use_rle=False, backend=None, multiclass=False,
+         sample=False, precision=None, profile=False):
     """
     Count pixel classes in binary mask images.
     
@@ -33,9 +258,33 @@ def main(config_path="./config/config.yaml", mask_dir=None, dataset_split="train
         config_path: Path to configuration file
         mask_dir: Directory containing mask files (overrides config if provided)
         dataset_split: Dataset split to process ('train' or 'val')
+        incremental: Reuse cached counts of unchanged masks (defaults to manifest.enabled)
+        use_index: Aggregate the existing per-mask statistics index instead of reading masks
+        split_manifest: Read the split's tiles from the tissue directories listed in this split
+            manifest (True for dataset.split.manifest) instead of mask_dir
+        store: Count the memory-mapped mask store (True for paths.<split>_mask_store) in one
+            streaming pass instead of reading mask files
+        use_rle: Take areas and bounding boxes from the RLE index next to the masks (see rle.py),
+            decoding only masks without an up-to-date RLE (thread backend)
+        backend: 'thread' pool over the shared mask pass, or 'process' pool map-reduce of
+            per-chunk np.bincount vectors (defaults to settings.count_backend)
+        multiclass: Count every pixel value as a class code instead of the non-zero pixels as
+            the class of the filename, for multi-class masks (selects the process backend);
+            writes <split>_multiclass_<output_file> and a '-multiclass' statistics index
+        sample: Estimate the percentages from a stratified random sample of the masks of each
+            class, with confidence intervals, reading masks until the target precision is
+            reached (see the sampling section of the config); writes sampled_<output_file>
+        precision: Target half width of the confidence intervals in percentage points
+            (overrides sampling.precision)
+        profile: Write cProfile stats, a collapsed-stack flame graph and per-tile phase times
+            into results/profiles (see profiling.py)
     """
+    if profile:
+        return profile_call(main, locals(), config_path, name="count_pixel_classes")
+    
     # Load configuration
     config = load_config(config_path)
+    configure_image_io(config)
     
     # Validate dataset split
     if dataset_split not in ["train", "val"]:
@@ -50,74 +299,158 @@ def main(config_path="./config/config.yaml", mask_dir=None, dataset_split="train
     # Print loaded class codes for verification
     print(f"Loaded {len(class_codes)} class codes from {labels_tsv_path}")
     
-    # Reverse the dictionary for label to name lookup (class_code -> class_name)
-    label_to_name = {v: k for k, v in class_codes.items()}
-    
-    # Initialize a dictionary to hold pixel counts per class
-    pixel_counts = {0: 0}  # Start with background class (0)
-    for code in class_codes.values():
-        pixel_counts[code] = 0
-    
-    # Total number of pixels
-    total_pixels = 0
-    
-    # Path to the target directory (masks)
-    if mask_dir is None:
-        # Use the appropriate mask directory based on dataset split - using output_dirs definition
-        mask_dir_key = f"{dataset_split}_source"
-        mask_dir = Path(resolve_variables(config, config["dataset"]["output_dirs"][mask_dir_key]))
+    # Multi-class counts go to their own CSV and index, next to the binary ones
+    variant = "multiclass" if multiclass else None
+    index_path = stats_index_path(config, dataset_split, variant)
+    max_workers = os.cpu_count()
+    if backend is None and use_rle:
+        # RLE lookups run in the shared mask pass
+        backend = "thread"
+    elif backend is None and (multiclass or sample):
+        # Multi-class and sampled counts only run as the map-reduce
+        backend = profiled_backend("process")
     else:
-        mask_dir = Path(mask_dir)
+        backend = profiled_backend(backend, config["settings"].get("count_backend", "process"))
+    if backend not in ("thread", "process"):
+        raise ValueError(f"Unknown count backend '{backend}', expected 'thread' or 'process'")
+    if backend == "thread" and sample:
+        raise ValueError("Sampled counting runs on the process backend (--backend process)")
+    if backend == "thread" and multiclass:
+        raise ValueError("Multi-class counting needs the process backend (--backend process)")
+    if backend == "process" and use_rle:
+        raise ValueError("RLE counting needs the thread backend (--backend thread)")
+    if multiclass and (use_index or store):
+        raise ValueError("The statistics index and mask stores hold binary counts; --multiclass reads mask files")
+    if sample and (use_index or store or use_rle):
+        raise ValueError("Sampling reads mask files and cannot be combined with --use_index, --store or --use_rle")
+    serial = use_index or store
+    metrics = StageMetrics("count", dataset_split, workers=1 if serial else max_workers,
+                           backend="serial" if serial else backend)
+    extra_metrics = {}
     
-    print(f"Processing masks from: {mask_dir}")
-    
-    # Get list of all mask files and count them
-    mask_files = list(mask_dir.glob("*.png"))
-    total_files = len(mask_files)
-    print(f"Found {total_files} mask files in {mask_dir}")
-    
-    # Dictionary to track masks per class
-    masks_per_class = {name: 0 for name in class_codes.keys()}
-    unknown_classes = 0
-    
-    # Loop through all mask files with proper progress bar
-    for mask_path in tqdm(mask_files, 
-                         total=total_files,
-                         desc=f"Processing {dataset_split} mask files",
-                         unit="file"):
-        # Extract class name from filename
-        class_name = extract_class_name(mask_path.name)
-        
-        if not class_name or class_name not in class_codes:
-            print(f"\nWarning: Could not determine class for {mask_path.name}")
-            unknown_classes += 1
-            continue
-            
-        # Get the class index for this mask
-        class_idx = class_codes[class_name]
+    if use_index:
+        # Aggregate the per-mask statistics written by an earlier counting run
+        index = load_stats_index(index_path)
+        print(f"Aggregating {len(index)} masks from statistics index {index_path}")
+        pixel_counts, masks_per_class = index_pixel_counts(index, class_codes)
+        total_files = len(index)
+        unknown_classes = 0
+        metrics.count("processed", total_files)
+    elif store:
+        # One streaming reduction over the memory-mapped (N, H, W) mask array
+        store_path = mask_store_path(config, dataset_split, store)
+        masks, store_index = load_mask_store(store_path)
+        print(f"Counting {len(masks)} masks from mask store {store_path}")
+        index = store_stats_index(masks, store_index, config["settings"].get("store_chunk_rows", 64),
+                                  desc=f"Counting {dataset_split} masks")
+        pixel_counts, masks_per_class = index_pixel_counts(index, class_codes)
+        total_files = len(index)
+        unknown_classes = 0
+        metrics.count("processed", total_files)
+        save_stats_index(index_path, index)
+        print(f"Per-mask statistics index written to {index_path}")
+    elif split_manifest:
+        # Masks of the split view, read straight from the tissue directories
+        view = split_view(config, split_manifest, dataset_split)
+        mask_files = [mask_path for mask_path, _, _ in view]
+        names = [name for _, _, name in view]
+    else:
+        names = None
         
-        # Track the class occurrence
-        masks_per_class[class_name] += 1
+        # Path to the target directory (masks)
+        if mask_dir is None:
+            # Use the appropriate mask directory based on dataset split - using output_dirs definition
+            mask_dir_key = f"{dataset_split}_source"
+            mask_dir = Path(resolve_variables(config, config["dataset"]["output_dirs"][mask_dir_key]))
+        else:
+            mask_dir = Path(mask_dir)
         
-        # Read the mask
-        mask = cv2.imread(str(mask_path), cv2.IMREAD_GRAYSCALE)
-        if mask is None:
-            print(f"\nError: Could not load mask at {mask_path}")
-            continue
+        print(f"Processing masks from: {mask_dir}")
         
-        # Count foreground and background pixels
-        foreground_count = np.sum(mask > 0)
-        background_count = mask.size - foreground_count
+        # Stream the mask files, so counting starts while the directory is being read
+        mask_files = scan_files(mask_dir, ".png")
+    
+    if sample:
+        # Approximate percentages from a stratified sample, stopping once precise enough
+        sampling = dict(config.get("sampling", {}))
+        if precision is not None:
+            sampling["precision"] = precision
+        counts_manifest = load_manifest(config, "counts", dataset_split, extra="multiclass" if multiclass else None,
+                                        enabled=incremental)
+        try:
+            percentages, half_widths, population, sampled = count_sample(
+                mask_files, class_codes, config_path, sampling, names=names, counts_manifest=counts_manifest,
+                multiclass=multiclass, max_workers=max_workers,
+                chunk_size=config["settings"].get("count_chunk_size", 64), metrics=metrics,
+                desc=f"Sampling {dataset_split} masks"
+            )
+        finally:
+            counts_manifest.save()
         
-        # Update total pixels
-        total_pixels += mask.size
+        results_dir = Path(resolve_variables(config, config["paths"]["results_dir"]))
+        results_dir.mkdir(parents=True, exist_ok=True)
+        output_file = results_dir / "_".join([dataset_split, "sampled", *filter(None, [variant]),
+                                              config['files']['output_file']])
+        confidence = sampling.get("confidence", 0.95)
+        write_sampled_csv(output_file, percentages, half_widths, class_codes, population, sampled, confidence)
         
-        # Accumulate counts - background (0) and foreground (class_idx)
-        pixel_counts[0] += background_count
-        pixel_counts[class_idx] += foreground_count
+        label_to_name = {v: k for k, v in class_codes.items()}
+        print(f"\nEstimated from {sum(sampled.values())} of {sum(population.values())} masks "
+              f"({confidence:.0%} confidence intervals), written to {output_file}")
+        for label in sorted(set([0, *class_codes.values()]), key=lambda label: percentages[label], reverse=True):
+            print(f"  {label_to_name.get(label, 'Unknown')}: {percentages[label]:.4f}% ± {half_widths[label]:.4f}")
+        write_metrics(config, metrics, sampled=sum(sampled.values()), max_half_width=float(np.max(half_widths)),
+                      **extra_metrics)
+        return
     
-    # Calculate percentages
-    percentages = {label_id: (count / total_pixels) * 100 for label_id, count in pixel_counts.items()}
+    if not use_index and not store:
+        # Pixel counts per class code and masks per class name
+        pixel_counts, masks_per_class = new_pixel_counts(class_codes)
+        unknown_classes = 0
+        results = []
+        total_files = 0
+        
+        # Multi-class counts are cached separately, with the non-zero bins of every mask
+        counts_manifest = load_manifest(config, "counts", dataset_split, extra="multiclass" if multiclass else None,
+                                        enabled=incremental)
+        rle_index = RleIndex() if use_rle else None
+        try:
+            if backend == "process":
+                # Map-reduce: workers return summed bincount vectors of their chunks
+                label_counts, mask_results = count_files(
+                    mask_files, class_codes, config_path, names=names, counts_manifest=counts_manifest,
+                    multiclass=multiclass, max_workers=max_workers,
+                    chunk_size=config["settings"].get("count_chunk_size", 64), metrics=metrics,
+                    desc=f"Processing {dataset_split} mask files"
+                )
+                for label in np.flatnonzero(label_counts):
+                    pixel_counts[int(label)] = int(label_counts[label])
+            else:
+                # Decode each mask once through the shared mask pass, counting only
+                mask_results = run_mask_pass(mask_files, class_codes, counts_manifest=counts_manifest, names=names,
+                                             rle_index=rle_index, max_workers=max_workers, metrics=metrics,
+                                             desc=f"Processing {dataset_split} mask files")
+            for result in mask_results:
+                total_files += 1
+                if result is None:
+                    unknown_classes += 1
+                    continue
+                if backend == "process":
+                    masks_per_class[result["class_name"]] += 1
+                else:
+                    accumulate_pixel_counts(result, pixel_counts, masks_per_class)
+                results.append(result)
+        finally:
+            counts_manifest.save()
+        print(f"Reused cached counts for {counts_manifest.hits} unchanged masks")
+        extra_metrics["cached"] = counts_manifest.hits
+        if rle_index is not None:
+            print(f"Answered {rle_index.hits} masks from the RLE index without decoding")
+            extra_metrics["rle_hits"] = rle_index.hits
+        
+        # Per-mask statistics for downstream scripts, so they don't have to decode masks again
+        save_stats_index(index_path, build_stats_index(results))
+        print(f"Per-mask statistics index written to {index_path}")
     
     # Create results directory if it doesn't exist
     results_dir = Path(resolve_variables(config, config["paths"]["results_dir"]))
@@ -126,37 +459,9 @@ def main(config_path="./config/config.yaml", mask_dir=None, dataset_split="train
         print(f"Created directory {results_dir}")
     
     # Write results to a CSV file - include dataset split in filename
-    output_filename = f"{dataset_split}_{config['files']['output_file']}"
+    output_filename = "_".join([dataset_split, *filter(None, [variant]), config['files']['output_file']])
     output_file = results_dir / output_filename
-    with open(output_file, 'w', newline='') as csvfile:
-        writer = csv.writer(csvfile)
-        # Section 1: Pixel counts and percentages
-        writer.writerow(['Label ID', 'Class Name', 'Pixel Count', 'Percentage', 'Mask Count'])
-        
-        # Sort by percentage (descending) to show most common classes first
-        sorted_items = sorted(pixel_counts.items(), key=lambda x: percentages[x[0]], reverse=True)
-        
-        for label_id, count in sorted_items:
-            class_name = label_to_name.get(label_id, 'Unknown')
-            percentage = percentages[label_id]
-            mask_count = 0
-            if label_id > 0:  # For non-background classes
-                for name, code in class_codes.items():
-                    if code == label_id:
-                        mask_count = masks_per_class.get(name, 0)
-                        break
-            writer.writerow([label_id, class_name, count, f"{percentage:.4f}", mask_count])
-        
-        # Add a separator and a section for masks per class summary
-        writer.writerow([])
-        writer.writerow(['Class Name', 'Mask Count', 'Description'])
-        
-        # Sort by mask count (descending)
-        sorted_masks = sorted(masks_per_class.items(), key=lambda x: x[1], reverse=True)
-        
-        for class_name, count in sorted_masks:
-            if count > 0:
-                writer.writerow([class_name, count, f"Number of masks for {class_name}"])
+    write_pixel_counts_csv(output_file, pixel_counts, masks_per_class, class_codes)
     
     print(f"\nResults written to {output_file}")
     print(f"Total masks processed: {total_files - unknown_classes}")
@@ -165,6 +470,7 @@ def main(config_path="./config/config.yaml", mask_dir=None, dataset_split="train
     for class_name, count in sorted(masks_per_class.items(), key=lambda x: x[1], reverse=True):
         if count > 0:
             print(f"  {class_name}: {count}")
+    write_metrics(config, metrics, **extra_metrics)
 
 if __name__ == "__main__":
     Fire(main)
\ No newline at end of file
@@ -1,12 +1,18 @@
-import numpy as np
-from PIL import Image
 import os
 from pathlib import Path
 from tqdm import tqdm
 from fire import Fire
 import yaml
 
-from utils import resolve_variables  # Import the resolve_variables function
+from discovery import scan_files
+from manifest import load_manifest
+from mask_store import (mask_store_path, load_mask_store, reduce_store, reduce_store_in_place, label_map_lut,
+                        remap_labels, store_remapped)
+from metrics import StageMetrics, write_metrics
+from image_io import read_image, save_image, configure as configure_image_io
+from profiling import tile_phases, profile_call
+from split_views import split_view
+from utils import resolve_variables, stream_map  # Import the resolve_variables function
 
 def load_config(config_path):
     """Load configuration from YAML file"""
@@ -20,20 +26,23 @@ def load_yaml_mapper(yaml_path):
     # Convert keys and values to integers (just to be safe)
     return {int(k): int(v) for k, v in mapping.items()}
 
-def reduce_mask_classes(mask_path, output_path, label_map):
-    mask = Image.open(mask_path)
-    mask_array = np.array(mask)
+def reduce_mask_classes(mask_path, output_path, lut):
+    """
+    Write a mask with its labels remapped and return the path written.
     
-    # Create output array filled with unknown class (0)
-    output_array = np.zeros_like(mask_array)
+    lut is the label map compiled with mask_store.label_map_lut, so the remap
+    is a single lookup pass whatever the number of labels.
+    """
+    # Labels mode keeps palette indices, as np.array(Image.open(mask_path)) does
+    mask_array = read_image(mask_path, "labels")
+    if mask_array is None:
+        raise FileNotFoundError(f"Could not load mask at {mask_path}")
     
-    # Apply label mapping for known classes
-    for old_label, new_label in label_map.items():
-        output_array[mask_array == old_label] = new_label
-        
-    # Any unmapped values will remain 0 (unknown class)
-    new_mask = Image.fromarray(output_array.astype(np.uint8))
-    new_mask.save(output_path)
+    with tile_phases.phase("compute"):
+        # Any unmapped values become 0 (unknown class)
+        output_array = remap_labels(mask_array, lut)
+    
+    return save_image(output_array, output_path, output="reduced")
 
 def process_directory(
     input_dir: str = None,
@@ -42,7 +51,12 @@ def process_directory(
     mapper_yaml: str = None,
     ext: str = None,
     dataset_split: str = "train",
-    config_path: str = "./config/config.yaml"
+    config_path: str = "./config/config.yaml",
+    incremental: bool = None,
+    split_manifest: str = None,
+    store: str = None,
+    in_place: bool = False,
+    profile: bool = False
 ):
     """
     Process mask images to reduce number of classes.
@@ -54,16 +68,31 @@ def process_directory(
         ext: File extension of mask images ('png' or 'jpg')
         dataset_split: Dataset split to process ('train' or 'val')
         config_path: Path to configuration file
+        incremental: Skip masks whose reduced output is up to date (defaults to manifest.enabled)
+        split_manifest: Read the split's tiles from the tissue directories listed in this split
+            manifest (True for dataset.split.manifest) instead of input_dir
+        store: Remap the memory-mapped mask store (True for paths.<split>_mask_store) chunk by
+            chunk instead of reading mask files; manifests are not used
+        in_place: With store, remap the labels of the (.npy) mask store itself instead of
+            writing mask files
+        profile: Write cProfile stats, a collapsed-stack flame graph and per-tile phase times
+            into results/profiles (see profiling.py)
     """
+    if profile:
+        return profile_call(process_directory, locals(), config_path)
+    
     # Validate dataset split
     if dataset_split not in ["train", "val"]:
         raise ValueError("Dataset split must be either 'train' or 'val'")
+    if in_place and not store:
+        raise ValueError("in_place remaps a mask store, pass store as well (--store True --in_place True)")
     
     # Load configuration
     config = load_config(config_path)
+    configure_image_io(config)
     
     # Use provided values or defaults from config based on dataset split
-    if input_dir is None:
+    if input_dir is None and not split_manifest and not store:
         input_dir = resolve_variables(config, config["paths"][f"{dataset_split}_mask_dir"])
     
     num_classes = num_classes or config["settings"]["num_classes"]
@@ -87,19 +116,76 @@ def process_directory(
     
     desc = f"Processing {dataset_split} masks ({num_classes} classes)"
     
+    # Compiled once: every mask is remapped with a single lookup pass
+    lut = label_map_lut(label_map)
+    chunk_rows = config["settings"].get("store_chunk_rows", 64)
+    
+    if store and in_place:
+        metrics = StageMetrics("reduce", dataset_split, backend="serial")
+        store_path = mask_store_path(config, dataset_split, store)
+        print(f"Reducing the masks of mask store {store_path} in place")
+        metrics.count("processed", reduce_store_in_place(store_path, label_map, chunk_rows, desc=desc))
+        write_metrics(config, metrics)
+        return
+    
     os.makedirs(output_dir, exist_ok=True)
-    mask_files = list(Path(input_dir).glob(f'*.{ext}'))
+    # Lookups, PNG encoding and file I/O release the GIL, so threads scale across cores
+    max_workers = os.cpu_count() * config["settings"].get("thread_multiplier", 2)
+    metrics = StageMetrics("reduce", dataset_split, workers=1 if store else max_workers,
+                           backend="serial" if store else "thread")
+    if store:
+        store_path = mask_store_path(config, dataset_split, store)
+        masks, store_index = load_mask_store(store_path)
+        if store_remapped(store_index):
+            raise ValueError(f"Mask store {store_path} already holds remapped labels, rebuild it with "
+                             f"mask_store.py before reducing it")
+        print(f"Reducing {len(masks)} masks from mask store {store_path}")
+        reduce_store(masks, store_index, label_map, output_dir, chunk_rows=chunk_rows, desc=desc)
+        metrics.count("processed", len(masks))
+        print(f"Results saved to {output_dir}")
+        write_metrics(config, metrics)
+        return
     
-    print(f"Found {len(mask_files)} mask files in {input_dir}")
+    if split_manifest:
+        # Masks of the split view, read straight from the tissue directories
+        view = split_view(config, split_manifest, dataset_split)
+        tiles = [(mask_path, name) for mask_path, _, name in view]
+    else:
+        # Streamed from the directory, so reducing starts while it is being read
+        tiles = ((Path(path), os.path.basename(path)) for path in scan_files(input_dir, f'.{ext}'))
+        print(f"Reading mask files from {input_dir}")
     
-    for mask_file in tqdm(mask_files, desc=desc):
-        # Keep original filename without adding _mask
-        output_file = Path(output_dir) / mask_file.name
+    # Manifest of reduced outputs, invalidated when the mapping or output directory changes
+    with open(mapper_yaml, 'r') as f:
+        mapper_text = f.read()
+    reduce_manifest = load_manifest(config, "reduce", dataset_split,
+                                    extra={"mapper": mapper_text, "output_dir": str(output_dir)},
+                                    enabled=incremental)
+    
+    def reduce_one(tile):
+        mask_file, output_name = tile
+        if reduce_manifest.lookup(mask_file) is not None:
+            metrics.count("skipped")
+            return
         
-        reduce_mask_classes(mask_file, output_file, label_map)
+        # Keep original filename without adding _mask
+        with metrics.busy():
+            output_file = reduce_mask_classes(mask_file, Path(output_dir) / output_name, lut)
+        reduce_manifest.update(mask_file, outputs=[output_file])
+        metrics.count("processed")
+    
+    total_files = 0
+    try:
+        for _ in tqdm(stream_map(reduce_one, tiles, max_workers), total=len(tiles) if split_manifest else None,
+                      desc=desc):
+            total_files += 1
+    finally:
+        reduce_manifest.save()
     
-    print(f"\nProcessed {len(mask_files)} {dataset_split} masks from {input_dir}")
+    print(f"Skipped {reduce_manifest.hits} up-to-date masks")
+    print(f"\nProcessed {total_files} {dataset_split} masks from {input_dir or 'the split manifest'}")
     print(f"Results saved to {output_dir}")
+    write_metrics(config, metrics)
 
 if __name__ == "__main__":
     Fire(process_directory)
\ No newline at end of file
@@ -1,55 +1,125 @@
 import os
+import itertools
 from pathlib import Path
-import numpy as np
-from PIL import Image
 import concurrent.futures
 from tqdm import tqdm
 import yaml
 import csv
 from fire import Fire
 
-from utils import resolve_variables, load_config, load_class_codes
+from discovery import scan_files
+from image_io import encoded_path, configure as configure_image_io
+from manifest import load_manifest
+from metrics import StageMetrics, write_metrics
+from profiling import profile_call, profiled_backend
+from mask_pass import process_mask_once, build_color_map, colored_mask_format
+from mask_store import mask_store_path, load_mask_store, color_store
+from split_views import split_view
+from utils import resolve_variables, load_config, load_class_codes, stream_map
 
-def extract_class_name(filename):
-    """Extract class name from filename."""
-    # Parse filenames like 'CD235a_RBC_033_026624_045056_mask.png'
-    parts = filename.split('_')
-    if len(parts) >= 2:
-        # First two components should be the class name (e.g., 'CD235a_RBC')
-        return f"{parts[0]}_{parts[1]}"
-    return None
+def process_image(filename, input_dir, output_dir, color_map, class_codes, color_manifest=None, output_name=None,
+                  colored_format="rgb"):
+    """
+    Process a single binary mask image.
 
-def process_image(filename, input_dir, output_dir, color_map, class_codes):
-    """Process a single binary mask image."""
+    Returns:
+        'processed' if the colored mask was written, 'unknown_class' if the class
+        of the filename is not known, or 'failed' (the outcomes of mask_pass.count_outcome)
+    """
     try:
-        # Extract class name from filename
-        class_name = extract_class_name(filename)
-        if not class_name or class_name not in class_codes:
-            print(f"Warning: Could not determine class for {filename}")
-            return
-            
-        # Get the class index for this mask
-        class_idx = class_codes[class_name]
-        
-        # Read the mask image (binary)
-        img_path = input_dir / filename
-        mask = np.array(Image.open(img_path))
-        
-        # Create an RGB image with the same size as mask
-        colored = np.zeros((*mask.shape, 3), dtype=np.uint8)
-        
-        # Set background color (class 0)
-        colored[:] = color_map[0]  
-        
-        # Set foreground color based on class index
-        colored[mask > 0] = color_map[class_idx]
-            
-        # Save the colored image
-        output_path = output_dir / filename
-        Image.fromarray(colored).save(output_path)
-        
+        # Decode, colorize and save through the shared single-decode mask pass
+        result = process_mask_once(Path(input_dir) / filename, class_codes, color_map=color_map,
+                                   colored_dir=output_dir, color_manifest=color_manifest, name=output_name,
+                                   colored_format=colored_format)
     except Exception as e:
         print(f"Error processing {filename}: {str(e)}")
+        return "failed"
+    if result is None:
+        return "unknown_class"
+    return "failed" if result["failed"] else "processed"
+
+# Per-process state of the process backend, filled once by _init_color_worker
+_worker_state = {}
+
+def _init_color_worker(config_path, class_codes_path, input_dir, output_dir):
+    """Load the color map and class codes once per worker process."""
+    config = load_config(config_path)
+    configure_image_io(config)
+    _worker_state["color_map"] = build_color_map(config["settings"]["colors"])
+    _worker_state["class_codes"] = load_class_codes(class_codes_path)
+    _worker_state["colored_format"] = colored_mask_format(config)
+    _worker_state["input_dir"] = Path(input_dir)
+    _worker_state["output_dir"] = Path(output_dir)
+
+def _color_in_worker(filename, output_name=None):
+    return filename, process_image(filename, output_name=output_name, **_worker_state)
+
+def _color_chunk_in_worker(items):
+    return [_color_in_worker(filename, output_name) for filename, output_name in items]
+
+def iter_color_files(image_files, input_dir, output_dir, config_path, class_codes_path,
+                     backend="thread", max_workers=None, chunk_size=64, desc="Coloring masks", output_names=None,
+                     metrics=None):
+    """
+    Color mask files with a thread or process pool, yielding each outcome as soon as it is known.
+    
+    The thread backend shares one color map between threads but is limited by
+    the GIL during PNG encoding and boolean indexing. The process backend loads
+    the color map and class codes once per worker and submits files in chunks.
+    image_files may be a generator, in which case files are submitted while it
+    is still producing them. output_names optionally maps files to their
+    colored filename. With the thread backend, worker busy time is recorded in
+    metrics (a StageMetrics) when given.
+    
+    Yields:
+        (filename, outcome) in the order of image_files, outcome as returned by process_image
+    """
+    total = len(image_files) if hasattr(image_files, "__len__") else None
+    output_names = output_names or {}
+    items = ((f, output_names.get(f)) for f in image_files)
+    max_workers = max_workers or os.cpu_count()
+    if backend == "thread":
+        config = load_config(config_path)
+        configure_image_io(config)
+        color_map = build_color_map(config["settings"]["colors"])
+        class_codes = load_class_codes(class_codes_path)
+        colored_format = colored_mask_format(config)
+        
+        def color_one(item):
+            if metrics is None:
+                return item[0], process_image(item[0], input_dir, output_dir, color_map, class_codes,
+                                              output_name=item[1], colored_format=colored_format)
+            with metrics.busy():
+                return item[0], process_image(item[0], input_dir, output_dir, color_map, class_codes,
+                                              output_name=item[1], colored_format=colored_format)
+        
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        results = stream_map(color_one, items, max_workers, executor=executor)
+    elif backend == "process":
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=_init_color_worker,
+            initargs=(str(config_path), str(class_codes_path), str(input_dir), str(output_dir))
+        )
+        chunks = iter(lambda: list(itertools.islice(items, chunk_size)), [])
+        results = itertools.chain.from_iterable(
+            stream_map(_color_chunk_in_worker, chunks, max_workers, executor=executor)
+        )
+    else:
+        raise ValueError(f"Unknown color backend '{backend}', expected 'thread' or 'process'")
+    
+    with executor:
+        yield from tqdm(results, total=total, desc=desc, unit="image")
+
+def color_files(image_files, input_dir, output_dir, config_path, class_codes_path, **kwargs):
+    """
+    Color mask files with iter_color_files and wait for all of them.
+    
+    Returns:
+        List with one success flag per file, in the order of image_files
+    """
+    return [outcome == "processed" for _, outcome in
+            iter_color_files(image_files, input_dir, output_dir, config_path, class_codes_path, **kwargs)]
 
 def color_masks(
     num_classes: int = None,
@@ -58,7 +128,12 @@ def color_masks(
     ext: str = None,
     dataset_split: str = "train",
     config_path: str = "./config/config.yaml",
-    class_codes_path: str = None
+    class_codes_path: str = None,
+    incremental: bool = None,
+    backend: str = None,
+    split_manifest: str = None,
+    store: str = None,
+    profile: bool = False
 ):
     """
     Create colored visualization of mask images.
@@ -71,20 +146,35 @@ def color_masks(
         dataset_split: Dataset split to process ('train' or 'val')
         config_path: Path to configuration file
         class_codes_path: Path to class codes TSV file (optional, will use config value if not provided)
+        incremental: Skip masks whose colored output is up to date (defaults to manifest.enabled)
+        backend: 'thread' or 'process' pool (defaults to settings.color_backend)
+        split_manifest: Read the split's tiles from the tissue directories listed in this split
+            manifest (True for dataset.split.manifest) instead of input_dir
+        store: Color the memory-mapped mask store (True for paths.<split>_mask_store) chunk by
+            chunk instead of reading mask files; manifests are not used
+        profile: Write cProfile stats, a collapsed-stack flame graph and per-tile phase times
+            into results/profiles (see profiling.py)
     """
+    if profile:
+        return profile_call(color_masks, locals(), config_path)
+    
     # Validate dataset split
     if dataset_split not in ["train", "val"]:
         raise ValueError("Dataset split must be either 'train' or 'val'")
     
     # Load configuration
     config = load_config(config_path)
+    configure_image_io(config)
     
     # Use provided values or defaults from config
     num_classes = num_classes or config["settings"]["num_classes"]
     ext = ext or config["settings"]["mask_file_extension"]
     
     # Use paths based on dataset split - using earlier definitions from dataset.output_dirs
-    if input_dir is None:
+    if split_manifest:
+        # Split views read the masks from the tissue directories under the data directory
+        input_dir = resolve_variables(config, config["base_dirs"]["data"])
+    elif input_dir is None:
         input_dir = resolve_variables(config, config["dataset"]["output_dirs"][f"{dataset_split}_source"])
     
     # Keep using colored_mask_dir from paths as it's not defined in dataset.output_dirs
@@ -107,39 +197,73 @@ def color_masks(
     class_codes = load_class_codes(class_codes_path)
     print(f"Loaded {len(class_codes)} class codes")
     
-    # Get colors for the specified number of classes
-    colors = config["settings"]["colors"]
+    if store:
+        store_path = mask_store_path(config, dataset_split, store)
+        masks, store_index = load_mask_store(store_path)
+        print(f"Coloring {len(masks)} masks from mask store {store_path} to {output_dir}")
+        metrics = StageMetrics("color", dataset_split, backend="serial")
+        color_store(masks, store_index, build_color_map(config["settings"]["colors"]), output_dir,
+                    chunk_rows=config["settings"].get("store_chunk_rows", 64),
+                    colored_format=colored_mask_format(config), desc=f"Processing {dataset_split} images ({num_classes} classes)")
+        metrics.count("processed", len(masks))
+        print(f"Completed coloring {len(masks)} {dataset_split} mask images.")
+        write_metrics(config, metrics)
+        return
     
-    # Convert hex colors to RGB tuples
-    color_map = {
-        i: tuple(int(color.lstrip('#')[j:j+2], 16) for j in (0, 2, 4))
-        for i, color in enumerate(colors)
-    }
+    # Mask files of the split view, or streamed from the directory so coloring starts right away
+    if split_manifest:
+        view = split_view(config, split_manifest, dataset_split)
+        image_files = [os.path.relpath(mask_path, input_dir) for mask_path, _, _ in view]
+        output_names = {f: name for f, (_, _, name) in zip(image_files, view)}
+        print(f"Found {len(image_files)} {dataset_split} images to process")
+    else:
+        image_files = (os.path.basename(path) for path in scan_files(input_dir, f'.{ext}'))
+        output_names = None
     
-    # Get list of all mask files
-    image_files = [f for f in os.listdir(input_dir) if f.endswith(f'.{ext}')]
-    total_files = len(image_files)
-    
-    print(f"Found {total_files} {dataset_split} images to process")
     print(f"Processing from {input_dir} to {output_dir}")
     
-    # Using ThreadPoolExecutor for parallel processing
-    thread_multiplier = config["settings"].get("thread_multiplier", 2)
-    max_workers = os.cpu_count() * thread_multiplier
-    
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        # Create a progress bar
-        list(tqdm(
-            executor.map(
-                lambda f: process_image(f, input_dir, output_dir, color_map, class_codes), 
-                image_files
-            ),
-            total=total_files,
+    # Threads are multiplied to hide I/O, processes are one per core
+    backend = profiled_backend(backend, config["settings"].get("color_backend", "thread"))
+    if backend == "thread":
+        max_workers = os.cpu_count() * config["settings"].get("thread_multiplier", 2)
+    else:
+        max_workers = os.cpu_count()
+    chunk_size = config["settings"].get("color_chunk_size", 64)
+    print(f"Using {backend} backend with {max_workers} workers")
+    metrics = StageMetrics("color", dataset_split, workers=max_workers, backend=backend)
+    
+    # Manifest of colored outputs, invalidated when settings.colors changes
+    color_manifest = load_manifest(config, "color", dataset_split, extra=str(output_dir), enabled=incremental)
+    total_files = 0
+    pending_files = 0
+    
+    def iter_pending():
+        nonlocal total_files, pending_files
+        for f in image_files:
+            total_files += 1
+            if color_manifest.lookup(input_dir / f) is None:
+                pending_files += 1
+                yield f
+    
+    try:
+        # Record every colored mask as soon as it is written, so an interrupted run keeps its work
+        for filename, outcome in iter_color_files(
+            iter_pending(), input_dir, output_dir, config_path, class_codes_path,
+            backend=backend, max_workers=max_workers, chunk_size=chunk_size,
             desc=f"Processing {dataset_split} images ({num_classes} classes)",
-            unit="image"
-        ))
+            output_names=output_names, metrics=metrics
+        ):
+            metrics.count(outcome)
+            if outcome == "processed":
+                output_name = output_names[filename] if output_names else filename
+                color_manifest.update(input_dir / filename, outputs=[encoded_path(output_dir / output_name, "colored")])
+    finally:
+        color_manifest.save()
     
+    print(f"Skipped {total_files - pending_files} up-to-date {dataset_split} images")
     print(f"Completed coloring {total_files} {dataset_split} mask images.")
+    metrics.count("skipped", total_files - pending_files)
+    write_metrics(config, metrics)
 
 if __name__ == "__main__":
     Fire(color_masks)
\ No newline at end of file
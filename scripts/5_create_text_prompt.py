@@ -1,79 +1,37 @@
-import numpy as np
-import cv2
 from pathlib import Path
 import json
 import csv
 from tqdm import tqdm
-import sys
 import os
-import yaml
+import numpy as np
 from fire import Fire  # Import Fire
 
+from profiling import profile_call
 from prompt_augmenter import augment_prompt
-from utils import resolve_variables, load_config, clean_class_name, create_prompt, extract_class_name, load_class_codes
-
-def load_labels_from_tsv(tsv_path):
-    """Load labels from TSV file."""
-    labels = {}
-    with open(tsv_path, 'r') as file:
-        reader = csv.DictReader(file, delimiter='\t')
-        for row in reader:
-            labels[int(row['GT_code'])] = row['label']
-    return labels
+from discovery import scan_files
+from image_io import configure as configure_image_io
+from manifest import load_manifest
+from mask_pass import (count_outcome, process_mask_once, mask_prompt, load_labels_from_tsv, view_target,
+                       lazy_colorization, prompt_record, DEFAULT_PROMPT_TEMPLATE)
+from metrics import StageMetrics, write_metrics
+from rle import RleIndex
+from split_views import split_view
+from stats_index import load_stats_index, stats_index_path
+from utils import resolve_variables, load_config, load_class_codes, extract_class_name
 
-def process_mask(mask_path, label_to_name, class_codes, config, filter_background=False):
-    """Process a binary mask image to create a text prompt."""
-    # Extract class name from filename
-    class_name = extract_class_name(mask_path.name)
-    if not class_name or class_name not in class_codes:
-        print(f"\nWarning: Could not determine class for {mask_path.name}")
-        return None
-        
-    # Get the class index for this mask
-    class_idx = class_codes[class_name]
-    
-    # Read the mask
-    mask = cv2.imread(str(mask_path), cv2.IMREAD_GRAYSCALE)
-    if mask is None:
-        print(f"\nError: Could not load mask at {mask_path}")
+def process_mask(mask_path, label_to_name, class_codes, config, filter_background=False, counts_manifest=None,
+                 name=None, rle_index=None, metrics=None):
+    """Process a binary mask image to create a text prompt, counting its outcome in metrics if given."""
+    prompt_template = config["settings"].get("prompt_template", DEFAULT_PROMPT_TEMPLATE)
+    
+    # Decode the mask and build the prompt through the shared single-decode mask pass
+    result = process_mask_once(mask_path, class_codes, label_to_name=label_to_name,
+                               prompt_template=prompt_template, filter_background=filter_background,
+                               counts_manifest=counts_manifest, name=name, rle_index=rle_index)
+    count_outcome(metrics, result)
+    if result is None:
         return None
-
-    # For binary masks, we need to create our own labeled version
-    # Create an empty array with the same shape as the mask
-    labeled_mask = np.zeros_like(mask)
-    # Set foreground pixels to the class index
-    labeled_mask[mask > 0] = class_idx
-    
-    # Get unique labels and their counts
-    unique_labels = np.array([0, class_idx])  # Background (0) and the class index
-    counts = np.array([np.sum(mask == 0), np.sum(mask > 0)])
-    total_pixels = mask.size
-    
-    # Filter out masks with only background if requested
-    if filter_background and counts[1] == 0:
-        return None
-    
-    # Calculate percentages and create prompt
-    class_percentages = []
-    for label, count in zip(unique_labels, counts):
-        # Include all labels, including background (0) if it's in label_to_name
-        if label in label_to_name:
-            percentage = (count / total_pixels) * 100
-            clean_name = clean_class_name(label_to_name[label])
-            class_percentages.append((clean_name, percentage))
-
-    # Sort by percentage in ascending order (smallest first)
-    class_percentages.sort(key=lambda x: x[1])
-    
-    # Create prompt with full names
-    prompt_template = config["settings"].get("prompt_template", "pathology image: {class_descriptions}")
-    prompt = create_prompt(class_percentages, prompt_template)
-    
-    # Handle case of empty prompt
-    if not class_percentages:
-        prompt = prompt_template.format(class_descriptions="background")
-        
-    return prompt
+    return result["prompt"]
 
 def main(
     use_augmentation=False, 
@@ -81,13 +39,33 @@ def main(
     config_path="./config/config.yaml",
     filter_background=False,
     use_detailed_labels=True,
-    class_codes_path=None  # Added parameter for class codes
+    class_codes_path=None,  # Added parameter for class codes
+    incremental=None,
+    use_index=False,
+    split_manifest=None,
+    use_rle=False,
+    profile=False
 ):
     """
     Create text prompts from binary mask images.
+    
+    With use_index, prompts are built from the per-mask statistics index of
+    the split without reading any mask image. The index is not checked against
+    the masks on disk, so it has to be rebuilt (2_count_pixel_classes.py)
+    after masks are added, removed or changed. With
+    split_manifest (True for dataset.split.manifest), the split's tiles are read
+    from their tissue directories and the targets point to the original HE images.
+    With use_rle, the background filter and percentages come from the RLE index
+    next to the masks (see rle.py) instead of decoding them. With profile,
+    cProfile stats, a collapsed-stack flame graph and per-tile phase times are
+    written into results/profiles (see profiling.py).
     """
+    if profile:
+        return profile_call(main, locals(), config_path, name="create_text_prompt")
+    
     # Load configuration
     config = load_config(config_path)
+    configure_image_io(config)
     
     # Get the appropriate paths based on dataset split
     if dataset_split not in ["train", "val"]:
@@ -114,9 +92,8 @@ def main(
     # Reverse the dictionary for label to name lookup
     label_to_name = labels
     
-    # Path for the source and target directories based on dataset split
+    # Path for the source directory based on dataset split
     source_dir = Path(resolve_variables(config, config["dataset"]["output_dirs"][f"{dataset_split}_source"]))
-    target_dir = Path(resolve_variables(config, config["dataset"]["output_dirs"][f"{dataset_split}_target"]))
     
     # Path for output file - only defined in paths section
     output_path = Path(resolve_variables(config, config["paths"][f"{dataset_split}_prompt_output_path"]))
@@ -124,45 +101,94 @@ def main(
     # Create output directory if not exists
     os.makedirs(output_path.parent, exist_ok=True)
     
-    # Find all mask files
-    mask_files = list(source_dir.glob(f"*.{config['settings']['mask_file_extension']}"))
-    total_files = len(mask_files)
+    prompt_template = config["settings"].get("prompt_template", DEFAULT_PROMPT_TEMPLATE)
+    index_path = stats_index_path(config, dataset_split)
+    if use_index and use_rle:
+        raise ValueError("use_index and use_rle are alternative sources of mask statistics, pass only one")
+    
+    # Tiles of a split view and the relative paths of their HE images
+    view = split_view(config, split_manifest, dataset_split) if split_manifest else None
+    targets = {name: view_target(config, dataset_split, he_path) for _, he_path, name in view or []}
+    
+    # Lazily colored sources point to the plain mask they are colored from on read
+    lazy = lazy_colorization(config)
+    mask_paths = {name: mask_path for mask_path, _, name in view or []}
+    
+    # Cached pixel counts let unchanged masks skip decoding entirely
+    counts_manifest = load_manifest(config, "counts", dataset_split, enabled=incremental)
+    rle_index = RleIndex() if use_rle else None
+    metrics = StageMetrics("prompt", dataset_split, backend="serial")
+    
+    if use_index:
+        # Prompts only need the foreground fraction, which the statistics index already has
+        index = load_stats_index(index_path)
+        if view is not None:
+            # Only the tiles of the split view
+            index = index[np.isin(index["name"], list(targets))]
+            missing = len(targets) - len(index)
+            if missing:
+                print(f"Warning: {missing} tiles of the split view are not in {index_path}, rebuild it to include them")
+        total_files = len(index)
+        print(f"Using per-mask statistics index {index_path}")
+        print(f"Found {total_files} mask files in {dataset_split} set")
+        metrics.count("processed", total_files)
+        
+        def prompts():
+            for row in index:
+                prompt = None
+                if not (filter_background and row["foreground"] == 0):
+                    prompt = mask_prompt(int(row["class_code"]), int(row["foreground"]), int(row["total"]),
+                                         label_to_name, prompt_template)
+                yield str(row["name"]), prompt
+    else:
+        # Mask files of the split view, or streamed from the source directory
+        if view is not None:
+            mask_files = [(mask_path, name) for mask_path, _, name in view]
+            total_files = len(mask_files)
+            print(f"Found {total_files} mask files in {dataset_split} set")
+        else:
+            mask_files = ((Path(path), os.path.basename(path))
+                          for path in scan_files(source_dir, f".{config['settings']['mask_file_extension']}"))
+            total_files = None
+        
+        def prompts():
+            nonlocal total_files
+            total_files = 0
+            for mask_path, name in mask_files:
+                total_files += 1
+                with metrics.busy():
+                    prompt = process_mask(mask_path, label_to_name, class_codes, config,
+                                          filter_background, counts_manifest, name, rle_index, metrics)
+                yield name, prompt
+    
     processed_files = 0
     augmented_prompts = 0
     
-    print(f"Found {total_files} mask files in {dataset_split} set")
     print(f"Background-only check: {'Enabled' if filter_background else 'Disabled'}")
     
     # Process all mask files and write results to JSON file
     with open(output_path, 'w') as f:
-        for mask_path in tqdm(mask_files, desc=f"Processing {dataset_split} masks", unit="file"):
-            prompt = process_mask(mask_path, label_to_name, class_codes, config, filter_background)
+        for mask_name, prompt in tqdm(prompts(), total=total_files,
+                                      desc=f"Processing {dataset_split} masks", unit="file"):
             
             # Only include results with non-empty prompts
             if prompt and prompt.endswith(": ") == False:
-                # Get filename for source and target
-                source_name = mask_path.name
-                target_name = source_name
-                
-                # Get the source and target directory names from the config
-                source_dir_name = Path(config["paths"][f"{dataset_split}_colored_mask_dir"]).name
-                target_dir_name = Path(config["dataset"]["output_dirs"][f"{dataset_split}_target"]).name
-                
                 # Augment prompt if specified and track augmentations
                 original_length = len(prompt.split())
                 prompt = augment_prompt(prompt, use_augmentation)
                 if len(prompt.split()) > original_length:
                     augmented_prompts += 1
                 
-                # Write result directly to file in JSON format with proper directory prefixes
-                result = {
-                    "source": f"{source_dir_name}/{source_name}",
-                    "target": f"{target_dir_name}/{target_name}",
-                    "prompt": prompt
-                }
+                # Write result directly to file in JSON format with the directory prefixes of the shared pass
+                lazy_mask = mask_paths.get(mask_name, source_dir / mask_name) if lazy else None
+                result = prompt_record(config, dataset_split, mask_name, prompt, target=targets.get(mask_name),
+                                       mask_path=lazy_mask,
+                                       class_idx=class_codes[extract_class_name(mask_name)] if lazy else None)
                 f.write(f"{json.dumps(result)}\n")
                 processed_files += 1
 
+    counts_manifest.save()
+    
     # Print summary
     print("\nProcessing Summary:")
     print(f"Total {dataset_split} files processed: {total_files}")
@@ -171,6 +197,8 @@ def main(
     if use_augmentation:
         print(f"Prompts augmented: {augmented_prompts}")
     print(f"\nResults saved to {output_path}")
+    write_metrics(config, metrics, prompts=processed_files, filtered=total_files - processed_files,
+                  augmented=augmented_prompts, cached=counts_manifest.hits)
 
 if __name__ == "__main__":
     # Replace argparse with Fire
@@ -1,13 +1,23 @@
 #!/bin/bash
 # Script to prepare the training set
 
-echo "Step 1: Creating colored visualizations of masks for training set"
-# Run the color masks script
-python3 /home/ubuntu/datasets/bscc/scripts/4_color_masks.py
+set -e  # Exit on error
 
-echo "Step 2: Generating text prompts from masks for training set"
-# Run the text prompt creation script with augmentation enabled
-python3 /home/ubuntu/datasets/bscc/scripts/5_create_text_prompt.py \
+# Define the config file path
+CONFIG_FILE="./config/config.yaml"
+
+# Check if config file exists
+if [ ! -f "$CONFIG_FILE" ]; then
+    echo "Error: Config file not found at $CONFIG_FILE"
+    exit 1
+fi
+
+echo "Counting pixel classes, coloring masks and generating text prompts for training set"
+# Run the pipeline on the existing training split; all paths come from the config
+python scripts/segpath.py run \
+    --config_path "$CONFIG_FILE" \
+    --splits "train" \
+    --stages "reduce,color,prompt,stats" \
     --use_augmentation False
 
-echo "Training set processing complete!"
\ No newline at end of file
+echo "Training set processing complete!"
@@ -0,0 +1,260 @@
+import os
+import time
+import random
+import concurrent.futures
+from collections import deque
+from multiprocessing import shared_memory
+from pathlib import Path
+
+import cv2
+import numpy as np
+from tqdm import tqdm
+from fire import Fire
+
+from image_io import read_image, configure as configure_image_io
+from mask_pass import build_color_map, mask_colorizer
+from shards import read_prompt_records
+from utils import resolve_variables, load_config
+
+
+def decode_rgb_into(path, out):
+    """Decode an image into a preallocated (H, W, 3) uint8 RGB buffer."""
+    image = cv2.imread(str(path), cv2.IMREAD_COLOR)
+    if image is None:
+        raise FileNotFoundError(f"Could not load image at {path}")
+    if image.shape != out.shape:
+        raise ValueError(f"Image {path} has shape {image.shape}, expected {out.shape}")
+    cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=out)
+
+
+def colorize_into(mask_path, class_idx, colorizer, out):
+    """Color a plain mask of a class into a preallocated (H, W, 3) buffer with a MaskColorizer."""
+    mask = read_image(mask_path, "gray")
+    if mask is None:
+        raise FileNotFoundError(f"Could not load mask at {mask_path}")
+    if mask.shape != out.shape[:2]:
+        raise ValueError(f"Mask {mask_path} has shape {mask.shape}, expected {out.shape[:2]}")
+    colorizer.binary(mask, class_idx, out=out)
+
+
+def load_source_into(source, out, colorizer):
+    """Decode a source image, or color it on read when source is a (plain mask path, class index) pair."""
+    if isinstance(source, tuple):
+        colorize_into(*source, colorizer, out)
+    else:
+        decode_rgb_into(source, out)
+
+
+# Shared batch buffers and colorizer of the process backend, attached once per worker by _init_loader_worker
+_worker_buffers = {}
+_worker_colorizer = {}
+
+
+def _init_loader_worker(names, shape, colorizer=None):
+    for key, name in names.items():
+        memory = shared_memory.SharedMemory(name=name)
+        _worker_buffers[key] = (memory, np.ndarray(shape, dtype=np.uint8, buffer=memory.buf))
+    _worker_colorizer["colorizer"] = colorizer
+
+
+def _decode_in_worker(slot, row, source, target_path):
+    load_source_into(source, _worker_buffers["source"][1][slot, row], _worker_colorizer["colorizer"])
+    decode_rgb_into(target_path, _worker_buffers["target"][1][slot, row])
+
+
+class PromptPairLoader:
+    """
+    Batches of decoded {source, target, prompt} pairs from a prompt.json manifest.
+
+    Images are decoded by a thread or process pool into preallocated,
+    contiguous (B, H, W, 3) uint8 buffers. prefetch batches are decoded ahead
+    of the one being consumed, and the prefetch + 1 buffer slots are reused
+    across iterations: a yielded batch stays valid until the next one is
+    requested, so copy it to keep it longer.
+
+    Records with a plain 'mask' and 'class_idx' (settings.lazy_colorization)
+    have their source colored on read through the 256-entry RGB lookup tables
+    of a MaskColorizer, built from colors (settings.colors).
+    """
+
+    def __init__(self, prompt_path, batch_size=16, prefetch=2, max_workers=None, backend="thread",
+                 shuffle=False, seed=None, drop_last=False, image_shape=None, colors=None):
+        if backend not in ("thread", "process"):
+            raise ValueError(f"Unknown loader backend '{backend}', expected 'thread' or 'process'")
+        self.prompt_path = Path(prompt_path)
+        self.records = read_prompt_records(self.prompt_path)
+        if not self.records:
+            raise ValueError(f"No records in {self.prompt_path}")
+        self.batch_size = batch_size
+        self.prefetch = max(1, prefetch)
+        self.max_workers = max_workers or os.cpu_count()
+        self.backend = backend
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.rng = random.Random(seed)
+        self.colorizer = None
+        if any("mask" in record for record in self.records):
+            if colors is None:
+                raise ValueError(f"{self.prompt_path} has lazily colored sources, pass colors to color them")
+            self.colorizer = mask_colorizer(build_color_map(colors))
+
+        if image_shape is None:
+            first = cv2.imread(str(self.path_of(self.records[0], "target")), cv2.IMREAD_COLOR)
+            if first is None:
+                raise FileNotFoundError(f"Could not load image at {self.path_of(self.records[0], 'target')}")
+            image_shape = first.shape[:2]
+        self.image_shape = tuple(image_shape)
+
+        # One slot per batch in flight plus the one being consumed
+        shape = (self.prefetch + 1, batch_size, *self.image_shape, 3)
+        self._memory = {}
+        if backend == "process":
+            nbytes = int(np.prod(shape))
+            self._memory = {key: shared_memory.SharedMemory(create=True, size=nbytes) for key in ("source", "target")}
+            self.buffers = {key: np.ndarray(shape, dtype=np.uint8, buffer=memory.buf)
+                            for key, memory in self._memory.items()}
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                initializer=_init_loader_worker,
+                initargs=({key: memory.name for key, memory in self._memory.items()}, shape, self.colorizer)
+            )
+        else:
+            self.buffers = {key: np.empty(shape, dtype=np.uint8) for key in ("source", "target")}
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+
+    def path_of(self, record, key):
+        """Path of the source or target image of a record, relative to the prompt.json directory."""
+        return self.prompt_path.parent / record[key]
+
+    def source_of(self, record):
+        """Source image path of a record, or its (plain mask path, class index) when it is colored on read."""
+        if "mask" in record:
+            return str(self.path_of(record, "mask")), record["class_idx"]
+        return self.path_of(record, "source")
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.records) // self.batch_size
+        return -(-len(self.records) // self.batch_size)
+
+    def _submit(self, slot, records):
+        futures = []
+        for row, record in enumerate(records):
+            source, target_path = self.source_of(record), self.path_of(record, "target")
+            if self.backend == "process":
+                source = source if isinstance(source, tuple) else str(source)
+                futures.append(self.executor.submit(_decode_in_worker, slot, row, source, str(target_path)))
+            else:
+                futures.append(self.executor.submit(self._decode_in_thread, slot, row, source, target_path))
+        return futures
+
+    def _decode_in_thread(self, slot, row, source, target_path):
+        load_source_into(source, self.buffers["source"][slot, row], self.colorizer)
+        decode_rgb_into(target_path, self.buffers["target"][slot, row])
+
+    def __iter__(self):
+        """
+        Yield batches as dictionaries with 'source' and 'target' (b, H, W, 3)
+        views of the batch buffers and the list of 'prompt' strings.
+        """
+        order = list(range(len(self.records)))
+        if self.shuffle:
+            self.rng.shuffle(order)
+        batches = (order[i:i + self.batch_size] for i in range(0, len(self) * self.batch_size, self.batch_size))
+
+        free_slots = deque(range(self.prefetch + 1))
+        in_flight = deque()
+        for indices in batches:
+            records = [self.records[i] for i in indices]
+            slot = free_slots.popleft()
+            in_flight.append((slot, records, self._submit(slot, records)))
+            if len(in_flight) > self.prefetch:
+                yield from self._emit(in_flight.popleft(), free_slots)
+        while in_flight:
+            yield from self._emit(in_flight.popleft(), free_slots)
+
+    def _emit(self, batch, free_slots):
+        slot, records, futures = batch
+        for future in futures:
+            future.result()
+        n = len(records)
+        yield {
+            "source": self.buffers["source"][slot, :n],
+            "target": self.buffers["target"][slot, :n],
+            "prompt": [record["prompt"] for record in records],
+        }
+        # The consumer asked for the next batch, so this slot can be refilled
+        free_slots.append(slot)
+
+    def close(self):
+        """Shut down the worker pool and release the shared batch buffers."""
+        self.executor.shutdown(wait=True)
+        self.buffers = {}
+        for memory in self._memory.values():
+            memory.close()
+            memory.unlink()
+        self._memory = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main(
+    dataset_split="train",
+    config_path="./config/config.yaml",
+    batch_size=None,
+    prefetch=None,
+    max_workers=None,
+    backend=None,
+    shuffle=True,
+    limit=None
+):
+    """
+    Measure the throughput of the batch loader over the prompt.json of a split.
+
+    Args:
+        dataset_split: Dataset split to load ('train' or 'val')
+        config_path: Path to configuration file
+        batch_size: Pairs per batch (defaults to loader.batch_size)
+        prefetch: Batches decoded ahead (defaults to loader.prefetch)
+        max_workers: Decoding workers (defaults to loader.max_workers or cpu count)
+        backend: 'thread' or 'process' pool (defaults to loader.backend)
+        shuffle: Visit the pairs in random order
+        limit: Stop after this many batches
+    """
+    config = load_config(config_path)
+    configure_image_io(config)
+    loader_config = config.get("loader", {})
+    prompt_path = resolve_variables(config, config["paths"][f"{dataset_split}_prompt_output_path"])
+
+    with PromptPairLoader(
+        prompt_path,
+        batch_size=batch_size or loader_config.get("batch_size", 16),
+        prefetch=prefetch or loader_config.get("prefetch", 2),
+        max_workers=max_workers or loader_config.get("max_workers"),
+        backend=backend or loader_config.get("backend", "thread"),
+        shuffle=shuffle,
+        colors=config["settings"]["colors"]
+    ) as loader:
+        total = min(len(loader), limit) if limit else len(loader)
+        print(f"Loading {total} batches of {loader.batch_size} {loader.image_shape} pairs from {prompt_path} "
+              f"with {loader.max_workers} {loader.backend} workers, prefetch {loader.prefetch}")
+        images = 0
+        total_bytes = 0
+        start = time.perf_counter()
+        for i, batch in enumerate(tqdm(loader, total=total, unit="batch")):
+            if i == total:
+                break
+            images += 2 * len(batch["prompt"])
+            total_bytes += batch["source"].nbytes + batch["target"].nbytes
+        elapsed = time.perf_counter() - start
+
+    print(f"{total / elapsed if elapsed else 0.0:.1f} batches/s, {images / elapsed if elapsed else 0.0:.1f} images/s, "
+          f"{total_bytes / 1e6 / elapsed if elapsed else 0.0:.1f} MB/s of decoded pixels")
+
+
+if __name__ == "__main__":
+    Fire(main)
@@ -0,0 +1,74 @@
+import os
+import time
+import tempfile
+from importlib import import_module
+from pathlib import Path
+
+from fire import Fire
+
+from utils import resolve_variables, load_config
+
+color_module = import_module("4_color_masks")
+
+
+def main(
+    config_path="./config/config.yaml",
+    input_dir=None,
+    dataset_split="train",
+    limit=2000,
+    backends=("thread", "process"),
+    max_workers=None
+):
+    """
+    Benchmark the thread and process backends of 4_color_masks.py side by side.
+
+    Each backend colors the same files into a temporary directory and the
+    throughput is reported in tiles per second.
+
+    Args:
+        config_path: Path to configuration file
+        input_dir: Directory containing mask images (defaults to the split's source directory)
+        dataset_split: Dataset split to take masks from ('train' or 'val')
+        limit: Maximum number of masks to color per backend
+        backends: Backends to benchmark
+        max_workers: Number of workers (defaults to the values used by color_masks)
+    """
+    config = load_config(config_path)
+    if input_dir is None:
+        input_dir = resolve_variables(config, config["dataset"]["output_dirs"][f"{dataset_split}_source"])
+    input_dir = Path(input_dir)
+    class_codes_path = resolve_variables(config, config["paths"]["labels_tsv"])
+    chunk_size = config["settings"].get("color_chunk_size", 64)
+
+    ext = config["settings"]["mask_file_extension"]
+    image_files = sorted(f for f in os.listdir(input_dir) if f.endswith(f'.{ext}'))[:limit]
+    print(f"Benchmarking {len(image_files)} masks from {input_dir}")
+
+    if isinstance(backends, str):
+        backends = [backends]
+
+    rows = []
+    for backend in backends:
+        workers = max_workers
+        if workers is None and backend == "thread":
+            workers = os.cpu_count() * config["settings"].get("thread_multiplier", 2)
+        elif workers is None:
+            workers = os.cpu_count()
+
+        with tempfile.TemporaryDirectory(dir=resolve_variables(config, config["base_dirs"]["temp"])) as output_dir:
+            start = time.perf_counter()
+            written = color_module.color_files(
+                image_files, input_dir, output_dir, config_path, class_codes_path,
+                backend=backend, max_workers=workers, chunk_size=chunk_size,
+                desc=f"{backend} backend"
+            )
+            elapsed = time.perf_counter() - start
+        rows.append((backend, workers, sum(written), elapsed, sum(written) / elapsed if elapsed else 0.0))
+
+    print(f"\n{'Backend':<10}{'Workers':>10}{'Tiles':>10}{'Seconds':>12}{'Tiles/sec':>12}")
+    for backend, workers, tiles, elapsed, rate in rows:
+        print(f"{backend:<10}{workers:>10}{tiles:>10}{elapsed:>12.2f}{rate:>12.1f}")
+
+
+if __name__ == "__main__":
+    Fire(main)
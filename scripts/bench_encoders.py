@@ -0,0 +1,183 @@
+import csv
+import time
+from pathlib import Path
+
+import numpy as np
+from fire import Fire
+
+from discovery import scan_files
+from image_io import (ENCODER_DEFAULTS, ZLIB_STRATEGIES, encode_image, decode_image, read_image,
+                      configure as configure_image_io)
+from mask_pass import build_color_map, colorize_mask, color_palette, index_mask
+from synthetic_data import generate_tile, SEGPATH_TILE_SIZE
+from utils import resolve_variables, load_config, load_class_codes, extract_class_name
+
+# Outputs the pipeline writes, as derived from a binary mask tile
+KINDS = ("mask", "reduced", "colored", "palette")
+
+
+def load_tiles(config, class_codes, dataset_split, limit, tile_size, seed):
+    """
+    Binary masks and class codes of up to limit tiles of a split.
+
+    Falls back to synthetic tiles when the split has no masks yet.
+    """
+    mask_dir = resolve_variables(config, config["dataset"]["output_dirs"][f"{dataset_split}_source"])
+    ext = f".{config['settings']['mask_file_extension']}"
+    tiles = []
+    for path in sorted(scan_files(mask_dir, ext) if Path(mask_dir).is_dir() else []):
+        class_name = extract_class_name(Path(path).name)
+        mask = read_image(path, "gray")
+        if class_name in class_codes and mask is not None:
+            tiles.append((mask, class_codes[class_name]))
+        if len(tiles) == limit:
+            break
+    if tiles:
+        print(f"Using {len(tiles)} {dataset_split} masks from {mask_dir}")
+        return tiles
+
+    tissue_dirs = config["dataset"]["source_dirs"]["tissue_dirs"]
+    print(f"No masks in {mask_dir}, generating {limit} synthetic {tile_size}x{tile_size} tiles (seed {seed})")
+    for i in range(limit):
+        class_index = i % len(tissue_dirs)
+        _, _, mask = generate_tile(tissue_dirs[class_index], class_index, i // len(tissue_dirs), tile_size, seed)
+        tiles.append((mask, class_codes.get(tissue_dirs[class_index], class_index + 1)))
+    return tiles
+
+
+def kind_arrays(kind, tiles, color_map):
+    """Arrays (and PNG palette) of one output kind, with the array each decodes back to."""
+    if kind == "mask":
+        return [mask for mask, _ in tiles], None, "labels"
+    if kind == "reduced":
+        return [index_mask(mask, code) for mask, code in tiles], None, "labels"
+    if kind == "colored":
+        return [colorize_mask(mask, code, color_map) for mask, code in tiles], None, "rgb"
+    if kind == "palette":
+        return [index_mask(mask, code) for mask, code in tiles], color_palette(color_map), "labels"
+    raise ValueError(f"Unknown kind '{kind}', expected one of {', '.join(KINDS)}")
+
+
+def candidate_settings(kind, compress_levels, strategies, webp_methods):
+    """
+    Encoder settings to compare on an output kind, as (format, label, settings).
+
+    1-bit PNG only applies to binary masks, and WebP has no palette mode, so
+    those are left out where they would not apply.
+    """
+    candidates = []
+    for strategy in strategies:
+        for level in compress_levels:
+            candidates.append(("PNG", f"png-{level}-{strategy}",
+                               {**ENCODER_DEFAULTS, "compress_level": level, "zlib_strategy": strategy}))
+    if kind == "mask":
+        for level in compress_levels:
+            candidates.append(("PNG", f"png-{level}-1bit",
+                               {**ENCODER_DEFAULTS, "compress_level": level, "one_bit": True}))
+    if kind == "palette":
+        return candidates
+    for method in webp_methods:
+        candidates.append(("WEBP", f"webp-lossless-m{method}", {**ENCODER_DEFAULTS, "format": "webp",
+                                                                "webp_method": method}))
+    return candidates
+
+
+def bench_encoder(format_name, settings, arrays, palette, decode_mode, repeat):
+    """Best total encode time over repeat runs, encoded sizes, and whether every tile decodes back unchanged."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        encoded = [encode_image(array, format_name, settings, palette).getvalue() for array in arrays]
+        best = min(best, time.perf_counter() - start)
+    suffix = ".webp" if format_name == "WEBP" else ".png"
+    if format_name == "WEBP" and decode_mode == "labels":
+        # WebP stores single-channel images as RGB, read back through the gray mode
+        decode_mode = "gray"
+    lossless = all(np.array_equal(decode_image(data, suffix, decode_mode, decoder="pil"), array)
+                   for data, array in zip(encoded, arrays))
+    return best, sum(len(data) for data in encoded), lossless
+
+
+def main(
+    config_path="./config/config.yaml",
+    dataset_split="train",
+    kinds=KINDS,
+    limit=16,
+    compress_levels=(0, 1, 3, 6, 9),
+    strategies=tuple(ZLIB_STRATEGIES),
+    webp_methods=(0, 4, 6),
+    repeat=3,
+    tile_size=SEGPATH_TILE_SIZE,
+    seed=0,
+    output_file=None
+):
+    """
+    Report the encode time versus file size tradeoff of the encoder settings on the tiles of a split.
+
+    Kinds: 'mask' (binary masks), 'reduced' (class-coded masks of
+    3_reduce_mask_classes.py), 'colored' (RGB colored masks) and 'palette'
+    (palette-mode colored masks). Each kind is encoded with every PNG level
+    and zlib strategy, 1-bit PNG (binary masks) and lossless WebP (except
+    palette masks), and checked to decode back unchanged. Sizes are relative
+    to the library default (level 6, strategy 'default').
+
+    Args:
+        config_path: Path to configuration file
+        dataset_split: Dataset split to take masks from ('train' or 'val')
+        kinds: Output kinds to benchmark
+        limit: Tiles per kind
+        compress_levels: zlib levels to compare
+        strategies: zlib strategies to compare
+        webp_methods: Lossless WebP methods to compare
+        repeat: Encodes per setting, the fastest is reported
+        tile_size: Tile width and height of the synthetic fallback tiles
+        seed: Random seed of the synthetic fallback tiles
+        output_file: CSV file for the results (defaults to encoder_benchmarks.csv in the results directory)
+    """
+    config = load_config(config_path)
+    configure_image_io(config)
+    class_codes = load_class_codes(resolve_variables(config, config["paths"]["labels_tsv"]))
+    color_map = build_color_map(config["settings"]["colors"])
+    if isinstance(kinds, str):
+        kinds = [kinds]
+    tiles = load_tiles(config, class_codes, dataset_split, limit, tile_size, seed)
+
+    rows = []
+    for kind in kinds:
+        arrays, palette, decode_mode = kind_arrays(kind, tiles, color_map)
+        raw_bytes = sum(array.nbytes for array in arrays)
+        for format_name, label, settings in candidate_settings(kind, compress_levels, strategies, webp_methods):
+            seconds, size, lossless = bench_encoder(format_name, settings, arrays, palette, decode_mode, repeat)
+            rows.append({
+                "kind": kind,
+                "encoder": label,
+                "ms_per_tile": 1000 * seconds / len(arrays),
+                "raw_mb_per_sec": raw_bytes / seconds / 1e6 if seconds else 0.0,
+                "kb_per_tile": size / len(arrays) / 1000,
+                "compression_ratio": raw_bytes / size if size else 0.0,
+                "lossless": lossless,
+            })
+
+    print(f"\n{'Kind':<9}{'Encoder':<24}{'ms/tile':>9}{'MB/s':>9}{'KB/tile':>10}{'Ratio':>8}{'vs default':>12}  Output")
+    for kind in kinds:
+        kind_rows = [row for row in rows if row["kind"] == kind]
+        default = next((row for row in kind_rows if row["encoder"] == "png-6-default"), None)
+        for row in sorted(kind_rows, key=lambda row: row["ms_per_tile"]):
+            relative = f"{row['kb_per_tile'] / default['kb_per_tile']:.0%}" if default else "-"
+            print(f"{kind:<9}{row['encoder']:<24}{row['ms_per_tile']:>9.2f}{row['raw_mb_per_sec']:>9.1f}"
+                  f"{row['kb_per_tile']:>10.1f}{row['compression_ratio']:>8.1f}{relative:>12}  "
+                  f"{'lossless' if row['lossless'] else 'CHANGED'}")
+
+    if output_file is None:
+        output_file = Path(resolve_variables(config, config["paths"]["results_dir"])) / "encoder_benchmarks.csv"
+    output_file = Path(output_file)
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()) if rows else [])
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"\nResults saved to {output_file}")
+
+
+if __name__ == "__main__":
+    Fire(main)
@@ -0,0 +1,272 @@
+import csv
+import time
+from importlib import import_module
+from pathlib import Path
+
+import cv2
+import numpy as np
+from fire import Fire
+
+from mask_pass import build_color_map, mask_colorizer
+from mask_store import label_map_lut
+from synthetic_data import generate_tile, SEGPATH_TILE_SIZE
+from utils import resolve_variables, load_config, load_class_codes
+
+reduce_module = import_module("3_reduce_mask_classes")
+
+KERNELS = ("remap", "colorize", "count", "compose")
+
+
+def remap_loop(mask, label_map):
+    """Per-label remap of reduce_mask_classes: one full-tile comparison per label."""
+    output = np.zeros_like(mask)
+    for old_label, new_label in label_map.items():
+        output[mask == old_label] = new_label
+    return output
+
+
+def remap_implementations(label_map):
+    lut = label_map_lut(label_map)
+    return {
+        "loop": lambda mask: remap_loop(mask, label_map),
+        "lut-index": lambda mask: lut[mask],
+        "np.take": lambda mask: np.take(lut, mask),
+        "cv2.LUT": lambda mask: cv2.LUT(mask, lut),
+    }
+
+
+def colorize_bool_index(mask, class_idx, color_map):
+    """Original colorize_mask of color_masks: background fill, then a boolean write of the class color."""
+    colored = np.empty((*mask.shape, 3), dtype=np.uint8)
+    colored[:] = color_map[0]
+    colored[mask > 0] = color_map[class_idx]
+    return colored
+
+
+def colorize_implementations(color_map, class_idx):
+    palette = np.zeros((256, 3), dtype=np.uint8)
+    palette[0] = color_map[0]
+    palette[1:] = color_map[class_idx]
+    lut3 = palette[None]
+    colorizer = mask_colorizer(color_map)
+    return {
+        "bool-index": lambda mask: colorize_bool_index(mask, class_idx, color_map),
+        "np.where": lambda mask: np.where((mask > 0)[..., None], np.uint8(color_map[class_idx]),
+                                          np.uint8(color_map[0])),
+        "palette-index": lambda mask: palette[mask],
+        "np.take": lambda mask: np.take(palette, mask, axis=0),
+        "cv2.LUT": lambda mask: cv2.LUT(cv2.merge([mask, mask, mask]), lut3),
+        "MaskColorizer": lambda mask: colorizer.binary(mask, class_idx),
+    }
+
+
+def count_implementations():
+    """Background and foreground counts of a binary mask, as (background, foreground)."""
+    def bincount(mask):
+        counts = np.bincount(mask.ravel(), minlength=256)
+        return int(counts[0]), int(mask.size - counts[0])
+
+    def count_nonzero(mask):
+        foreground = np.count_nonzero(mask)
+        return mask.size - foreground, foreground
+
+    def cv2_count(mask):
+        foreground = cv2.countNonZero(mask)
+        return mask.size - foreground, foreground
+
+    return {
+        "np.sum": lambda mask: (int(np.sum(mask == 0)), int(np.sum(mask > 0))),
+        "count_nonzero": count_nonzero,
+        "bincount": bincount,
+        "cv2.countNonZero": cv2_count,
+    }
+
+
+def compose_loop(masks, codes, colors):
+    """Per-class composition of select_samples: boolean writes, np.sum areas and per-color comparisons."""
+    combined = np.zeros(masks[0].shape, dtype=np.uint8)
+    areas = {}
+    for mask, code in zip(masks, codes):
+        foreground = (mask > 0)
+        combined[foreground] = code
+        areas[code] = np.sum(foreground)
+    colored = np.zeros((*combined.shape, 3), dtype=np.uint8)
+    for class_idx, rgb in enumerate(colors):
+        colored[combined == class_idx] = rgb
+    return combined, colored, areas
+
+
+def compose_implementations(colors):
+    palette = np.zeros((256, 3), dtype=np.uint8)
+    palette[:len(colors)] = colors
+
+    def copyto_lut(masks, codes, _colors):
+        combined = np.zeros(masks[0].shape, dtype=np.uint8)
+        areas = {}
+        for mask, code in zip(masks, codes):
+            np.copyto(combined, np.uint8(code), where=mask > 0)
+            areas[code] = np.count_nonzero(mask)
+        return combined, palette[combined], areas
+
+    def argmax_lut(masks, codes, _colors):
+        # The last class with a foreground pixel wins, like the sequential writes
+        stack = np.stack(masks)
+        foreground = stack > 0
+        last = len(masks) - 1 - np.argmax(foreground[::-1], axis=0)
+        combined = np.where(foreground.any(axis=0), np.asarray(codes, dtype=np.uint8)[last], np.uint8(0))
+        areas = dict(zip(codes, np.count_nonzero(foreground.reshape(len(masks), -1), axis=1)))
+        return combined, palette[combined], areas
+
+    return {
+        "loop": compose_loop,
+        "copyto+lut": copyto_lut,
+        "argmax+lut": argmax_lut,
+    }
+
+
+def outputs_equal(a, b):
+    if isinstance(a, dict):
+        return a.keys() == b.keys() and all(int(a[key]) == int(b[key]) for key in a)
+    if isinstance(a, tuple):
+        return len(a) == len(b) and all(outputs_equal(x, y) for x, y in zip(a, b))
+    if isinstance(a, np.ndarray):
+        return np.array_equal(a, b)
+    return a == b
+
+
+def time_implementation(func, inputs, repeat):
+    """Best wall time over repeat runs of func on every input, and the outputs of the last run."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        outputs = [func(*args) for args in inputs]
+        best = min(best, time.perf_counter() - start)
+    return best, outputs
+
+
+def bench_kernel(kernel, implementations, inputs, pixels_per_input, repeat):
+    """
+    Time every implementation of a kernel and compare its outputs to the first (reference) one.
+
+    Returns:
+        List of result rows as dictionaries
+    """
+    rows = []
+    reference = None
+    for name, func in implementations.items():
+        seconds, outputs = time_implementation(func, inputs, repeat)
+        if reference is None:
+            reference = outputs
+        rows.append({
+            "kernel": kernel,
+            "implementation": name,
+            "ns_per_pixel": seconds * 1e9 / (len(inputs) * pixels_per_input),
+            "tiles_per_sec": len(inputs) / seconds if seconds else 0.0,
+            "matches_reference": all(outputs_equal(a, b) for a, b in zip(reference, outputs)),
+        })
+    return rows
+
+
+def synthetic_tiles(tissue_dirs, class_codes, tiles, tile_size, seed):
+    """Binary and class-coded masks of synthetic tiles, cycling through the tissue directories."""
+    binary, coded, class_indices = [], [], []
+    for i in range(tiles):
+        class_index = i % len(tissue_dirs)
+        tissue_dir = tissue_dirs[class_index]
+        _, _, mask = generate_tile(tissue_dir, class_index, i // len(tissue_dirs), tile_size, seed)
+        code = class_codes.get(tissue_dir, class_index + 1)
+        binary.append(mask)
+        coded.append(np.where(mask > 0, np.uint8(code), np.uint8(0)))
+        class_indices.append(code)
+    return binary, coded, class_indices
+
+
+def main(
+    config_path="./config/config.yaml",
+    kernels=KERNELS,
+    tiles=16,
+    tile_size=SEGPATH_TILE_SIZE,
+    repeat=5,
+    seed=0,
+    mapper_yaml=None,
+    output_file=None
+):
+    """
+    Time the hot mask kernels in isolation on synthetic tiles, against alternative implementations.
+
+    Kernels: 'remap' (class reduction of 3_reduce_mask_classes.py), 'colorize'
+    (colored masks of 4_color_masks.py), 'count' (background/foreground counts
+    of 2_count_pixel_classes.py and 5_create_text_prompt.py) and 'compose'
+    (combined mask of select_val_samples.py). The first implementation of each
+    kernel is the one the scripts used originally; every other implementation
+    is checked against its output.
+
+    Args:
+        config_path: Path to configuration file
+        kernels: Kernels to benchmark
+        tiles: Synthetic tiles per kernel
+        tile_size: Tile width and height in pixels
+        repeat: Runs per implementation, the fastest is reported
+        seed: Random seed of the synthetic tiles
+        mapper_yaml: Class mapping for the remap kernel (defaults to folding the classes onto 5)
+        output_file: CSV file for the results (defaults to kernel_benchmarks.csv in the results directory)
+    """
+    config = load_config(config_path)
+    tissue_dirs = config["dataset"]["source_dirs"]["tissue_dirs"]
+    class_codes = load_class_codes(resolve_variables(config, config["paths"]["labels_tsv"]))
+    color_map = build_color_map(config["settings"]["colors"])
+    colors = [color_map[i] for i in range(len(color_map))]
+    if isinstance(kernels, str):
+        kernels = [kernels]
+
+    if mapper_yaml:
+        label_map = reduce_module.load_yaml_mapper(mapper_yaml)
+    else:
+        label_map = {label: label % 5 for label in range(len(colors))}
+
+    print(f"Generating {tiles} synthetic {tile_size}x{tile_size} tiles (seed {seed})")
+    binary, coded, class_indices = synthetic_tiles(tissue_dirs, class_codes, tiles, tile_size, seed)
+    pixels = tile_size * tile_size
+
+    rows = []
+    for kernel in kernels:
+        if kernel == "remap":
+            rows += bench_kernel(kernel, remap_implementations(label_map), [(mask,) for mask in coded], pixels, repeat)
+        elif kernel == "colorize":
+            # One class per run keeps the palette of the LUT variants fixed
+            class_idx = class_indices[0]
+            rows += bench_kernel(kernel, colorize_implementations(color_map, class_idx),
+                                 [(mask,) for mask in binary], pixels, repeat)
+        elif kernel == "count":
+            rows += bench_kernel(kernel, count_implementations(), [(mask,) for mask in binary], pixels, repeat)
+        elif kernel == "compose":
+            # One mask per class, as picked by select_samples
+            groups = [(binary[i:i + len(tissue_dirs)], class_indices[i:i + len(tissue_dirs)], colors)
+                      for i in range(0, len(binary) - len(tissue_dirs) + 1, len(tissue_dirs))]
+            if not groups:
+                raise ValueError(f"The compose kernel needs at least {len(tissue_dirs)} tiles")
+            rows += bench_kernel(kernel, compose_implementations(colors), groups, pixels, repeat)
+        else:
+            raise ValueError(f"Unknown kernel '{kernel}', expected one of {', '.join(KERNELS)}")
+
+    print(f"\n{'Kernel':<10}{'Implementation':<18}{'ns/pixel':>10}{'Tiles/sec':>12}{'Speedup':>10}  Output")
+    baseline = {}
+    for row in rows:
+        baseline.setdefault(row["kernel"], row["ns_per_pixel"])
+        speedup = baseline[row["kernel"]] / row["ns_per_pixel"] if row["ns_per_pixel"] else 0.0
+        print(f"{row['kernel']:<10}{row['implementation']:<18}{row['ns_per_pixel']:>10.3f}"
+              f"{row['tiles_per_sec']:>12.1f}{speedup:>9.1f}x  {'same' if row['matches_reference'] else 'DIFFERENT'}")
+
+    if output_file is None:
+        output_file = Path(resolve_variables(config, config["paths"]["results_dir"])) / "kernel_benchmarks.csv"
+    output_file = Path(output_file)
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()) if rows else [])
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"\nResults saved to {output_file}")
+
+
+if __name__ == "__main__":
+    Fire(main)
@@ -0,0 +1,95 @@
+import os
+import queue
+import threading
+from collections import namedtuple
+
+from utils import extract_class_name
+
+# A tile file found by scan_tiles: full path, filename, class (tissue) name and
+# tile ID (the filename without the scanned suffix)
+TileFile = namedtuple("TileFile", ["path", "name", "class_name", "tile_id"])
+
+_END = object()
+
+
+def scan_files(directory, suffix):
+    """
+    Stream the paths of the files in a directory whose names end with suffix.
+
+    Uses a single os.scandir, so no per-file stat is needed and files are
+    yielded as the directory is read, in directory order. Paths are plain
+    strings to keep memory small for directories with 100k+ entries.
+    """
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.endswith(suffix) and entry.is_file():
+                yield entry.path
+
+
+def parse_tile_name(filename, suffix):
+    """Split a tile filename like 'CD235a_RBC_033_026624_045056_mask.png' into (class name, tile ID)."""
+    tile_id = filename[:-len(suffix)] if suffix and filename.endswith(suffix) else os.path.splitext(filename)[0]
+    return extract_class_name(filename), tile_id
+
+
+def scan_tiles(directory, suffix):
+    """Stream the tiles of a directory as TileFile tuples, parsing their names on the way."""
+    for path in scan_files(directory, suffix):
+        name = os.path.basename(path)
+        yield TileFile(path, name, *parse_tile_name(name, suffix))
+
+
+def scan_dirs(directories, suffix, max_workers=None, queue_size=1024):
+    """
+    Stream the files ending with suffix from several directories scanned in parallel.
+
+    Each directory is scanned by its own thread (at most max_workers at a
+    time) into a bounded queue, so consumers get the first files right away.
+    Files of different directories are interleaved in no particular order.
+    """
+    directories = list(directories)
+    max_workers = min(max_workers or len(directories), len(directories)) or 1
+    results = queue.Queue(maxsize=queue_size)
+    pending = queue.Queue()
+    for directory in directories:
+        pending.put(directory)
+    stop = threading.Event()
+    errors = []
+
+    def worker():
+        try:
+            while not stop.is_set():
+                try:
+                    directory = pending.get_nowait()
+                except queue.Empty:
+                    return
+                for path in scan_files(directory, suffix):
+                    if stop.is_set():
+                        return
+                    results.put(path)
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            results.put(_END)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(max_workers)]
+    for thread in threads:
+        thread.start()
+    try:
+        remaining = len(threads)
+        while remaining:
+            path = results.get()
+            if path is _END:
+                remaining -= 1
+            else:
+                yield path
+    finally:
+        stop.set()
+        # Unblock workers waiting on a full queue
+        while any(thread.is_alive() for thread in threads):
+            try:
+                results.get(timeout=0.1)
+            except queue.Empty:
+                pass
+    if errors:
+        raise errors[0]
@@ -0,0 +1,406 @@
+import io
+import os
+import time
+import threading
+import zlib
+from pathlib import Path
+
+import cv2
+import numpy as np
+from PIL import Image
+from fire import Fire
+
+from discovery import scan_files
+from profiling import tile_phases
+from utils import resolve_variables, load_config, stream_map
+
+# Optional decoders, used when installed
+try:
+    import pyspng
+except ImportError:
+    pyspng = None
+try:
+    import simplejpeg
+except ImportError:
+    simplejpeg = None
+
+# Decode modes: 'gray' is a single 8-bit channel (converted from color if
+# needed), 'labels' the stored sample values with palette indices kept (as
+# np.array(Image.open(path))), 'rgb' three channels in RGB order
+MODES = ("gray", "labels", "rgb")
+
+# Decoders tried in this order when no benchmark is run; PIL handles every file
+DECODER_PREFERENCE = {
+    ".png": ("pyspng", "cv2", "pil"),
+    ".jpg": ("simplejpeg", "cv2", "pil"),
+    ".jpeg": ("simplejpeg", "cv2", "pil"),
+}
+DEFAULT_PREFERENCE = ("cv2", "pil")
+
+# Encoder settings of an output, overridden by image_io.encoders.default and
+# image_io.encoders.<output> (outputs: 'reduced', 'colored', 'samples')
+ENCODER_DEFAULTS = {
+    "format": "png",
+    "compress_level": 6,
+    "zlib_strategy": "default",
+    "one_bit": False,
+    "webp_quality": 80,
+    "webp_method": 4,
+}
+ENCODE_FORMATS = ("png", "webp")
+# zlib strategies of PNG encoding; "default" leaves the choice to PIL
+ZLIB_STRATEGIES = {
+    "default": -1,
+    "plain": zlib.Z_DEFAULT_STRATEGY,
+    "filtered": zlib.Z_FILTERED,
+    "huffman_only": zlib.Z_HUFFMAN_ONLY,
+    "rle": zlib.Z_RLE,
+    "fixed": zlib.Z_FIXED,
+}
+
+
+class UnsupportedImage(Exception):
+    """Raised by a decoder that cannot produce the requested mode for an image."""
+
+
+def _decode_cv2(data, mode):
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    if mode == "gray":
+        return cv2.imdecode(buffer, cv2.IMREAD_GRAYSCALE)
+    if mode == "rgb":
+        image = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+        return None if image is None else cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    image = cv2.imdecode(buffer, cv2.IMREAD_UNCHANGED)
+    if image is not None and image.ndim == 3:
+        # OpenCV expands palette images to colors, losing their indices
+        raise UnsupportedImage("cv2 cannot read the labels of multi-channel or palette images")
+    return image
+
+
+def _decode_pil(data, mode):
+    image = Image.open(io.BytesIO(data))
+    if mode == "gray":
+        return np.asarray(image.convert("L"))
+    if mode == "rgb":
+        return np.asarray(image.convert("RGB"))
+    if image.mode == "1":
+        # 1-bit masks come back as 0 and 255, like the 8-bit masks they were written from
+        return np.array(image.convert("L"))
+    return np.array(image)
+
+
+def _decode_pyspng(data, mode):
+    if data[24:25] == b"\x01":
+        # Bit depth in the IHDR chunk: 1-bit masks are left to PIL, which scales them to 0 and 255
+        raise UnsupportedImage("pyspng keeps 1-bit samples as 0 and 1")
+    image = pyspng.load(data)
+    if mode == "rgb" and image.ndim == 3 and image.shape[2] == 3:
+        return image
+    if mode != "rgb" and image.ndim == 2 and image.dtype == np.uint8:
+        return image
+    raise UnsupportedImage(f"pyspng decoded a {image.shape} image, not {mode}")
+
+
+def _decode_simplejpeg(data, mode):
+    if mode == "labels":
+        raise UnsupportedImage("JPEG images have no labels")
+    image = simplejpeg.decode_jpeg(data, colorspace="GRAY" if mode == "gray" else "RGB")
+    return image[..., 0] if mode == "gray" else image
+
+
+DECODERS = {
+    "cv2": _decode_cv2,
+    "pil": _decode_pil,
+    "pyspng": _decode_pyspng,
+    "simplejpeg": _decode_simplejpeg,
+}
+
+# Exceptions each decoder raises for data it cannot decode; anything else is a bug
+# and propagates. cv2.imdecode returns None for most bad data, and raises on empty buffers
+DECODE_ERRORS = {
+    "cv2": (cv2.error,),
+    "pil": (OSError, SyntaxError),
+    "pyspng": (RuntimeError,),
+    "simplejpeg": (ValueError,),
+}
+
+# Modules the optional decoders need
+_DECODER_MODULES = {"pyspng": pyspng, "simplejpeg": simplejpeg}
+
+# Decoder setting from image_io.decoder, encoder settings from image_io.encoders,
+# and the decoders chosen per (suffix, mode)
+_settings = {"decoder": "auto", "benchmark": True, "encoders": {}}
+_selected = {}
+_select_lock = threading.Lock()
+
+
+def available_decoders(suffix=None):
+    """Names of the installed decoders able to read files with suffix, in order of preference."""
+    preference = DECODER_PREFERENCE.get(suffix.lower(), DEFAULT_PREFERENCE) if suffix else tuple(DECODERS)
+    return [name for name in preference if _DECODER_MODULES.get(name, True) is not None]
+
+
+def configure(config):
+    """
+    Apply the image_io section of the config.
+
+    decoder is 'auto' or the name of a decoder used for every file; with
+    'auto' and benchmark enabled, the first file of every type is decoded by
+    each available decoder and the fastest one is kept. encoders holds the
+    encoder settings of the outputs (see ENCODER_DEFAULTS).
+    """
+    settings = config.get("image_io", {})
+    decoder = settings.get("decoder", "auto")
+    if decoder != "auto" and decoder not in DECODERS:
+        raise ValueError(f"Unknown decoder '{decoder}', expected 'auto' or one of {', '.join(DECODERS)}")
+    if decoder != "auto" and _DECODER_MODULES.get(decoder, True) is None:
+        raise ValueError(f"Decoder '{decoder}' is not installed")
+    encoders = settings.get("encoders") or {}
+    for output, output_settings in encoders.items():
+        validate_encoder_settings(output_settings or {}, output)
+    with _select_lock:
+        _settings["decoder"] = decoder
+        _settings["benchmark"] = settings.get("benchmark", True)
+        _settings["encoders"] = encoders
+        _selected.clear()
+
+
+def validate_encoder_settings(settings, output="default"):
+    """Raise ValueError for unknown keys or values in the encoder settings of an output."""
+    unknown = set(settings) - set(ENCODER_DEFAULTS)
+    if unknown:
+        raise ValueError(f"Unknown encoder settings {', '.join(sorted(unknown))} for output '{output}', "
+                         f"expected {', '.join(ENCODER_DEFAULTS)}")
+    if settings.get("format", "png") not in ENCODE_FORMATS:
+        raise ValueError(f"Unknown encode format '{settings['format']}' for output '{output}', "
+                         f"expected one of {', '.join(ENCODE_FORMATS)}")
+    if settings.get("zlib_strategy", "default") not in ZLIB_STRATEGIES:
+        raise ValueError(f"Unknown zlib strategy '{settings['zlib_strategy']}' for output '{output}', "
+                         f"expected one of {', '.join(ZLIB_STRATEGIES)}")
+    if not 0 <= settings.get("compress_level", 6) <= 9:
+        raise ValueError(f"compress_level of output '{output}' must be between 0 and 9")
+
+
+def encoder_settings(output=None):
+    """Encoder settings of an output: ENCODER_DEFAULTS, then image_io.encoders.default and .<output>."""
+    encoders = _settings["encoders"]
+    return {**ENCODER_DEFAULTS, **(encoders.get("default") or {}), **((encoders.get(output) or {}) if output else {})}
+
+
+def decode_with(name, data, mode):
+    """Decode with one decoder, falling back to PIL when it does not support the image or mode."""
+    try:
+        return DECODERS[name](data, mode)
+    except UnsupportedImage:
+        return _decode_pil(data, mode)
+
+
+def benchmark_decoders(data, suffix, mode="gray", decoders=None, repeat=5):
+    """
+    Time the decoders on encoded image bytes.
+
+    Decoders whose output differs from the first decoder's are left out.
+
+    Returns:
+        Dictionary of decoder name to the best decode time in seconds
+    """
+    timings = {}
+    reference = None
+    for name in decoders or available_decoders(suffix):
+        try:
+            output = DECODERS[name](data, mode)
+        except (UnsupportedImage, *DECODE_ERRORS[name]):
+            continue
+        if output is None:
+            continue
+        if reference is None:
+            reference = output
+        elif not np.array_equal(output, reference):
+            continue
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            DECODERS[name](data, mode)
+            best = min(best, time.perf_counter() - start)
+        timings[name] = best
+    return timings
+
+
+def decoder_for(suffix, mode="gray", sample=None):
+    """
+    Decoder used for files with suffix, chosen on first use.
+
+    With the 'auto' setting, the decoders are benchmarked on sample (encoded
+    bytes of a file of that type) when given, and the preference order is
+    used otherwise.
+    """
+    if _settings["decoder"] != "auto":
+        return _settings["decoder"]
+    key = (suffix.lower(), mode)
+    if key in _selected:
+        return _selected[key]
+    with _select_lock:
+        if key not in _selected:
+            candidates = available_decoders(suffix)
+            timings = benchmark_decoders(sample, suffix, mode, candidates) if sample and _settings["benchmark"] else {}
+            _selected[key] = min(timings, key=timings.get) if timings else candidates[0]
+        return _selected[key]
+
+
+def read_bytes(path):
+    """Read the encoded bytes of an image file."""
+    with tile_phases.phase("read"):
+        with open(path, 'rb') as f:
+            return f.read()
+
+
+def decode_image(data, suffix=".png", mode="gray", decoder=None):
+    """
+    Decode encoded image bytes.
+
+    Only the decode errors of the decoder (and of PIL, its fallback) listed in
+    DECODE_ERRORS are turned into None; other exceptions propagate.
+
+    Returns:
+        uint8 array of shape (H, W) for 'gray' and 'labels', (H, W, 3) for 'rgb',
+        or None if the data could not be decoded
+    """
+    if mode not in MODES:
+        raise ValueError(f"Unknown decode mode '{mode}', expected one of {', '.join(MODES)}")
+    decoder = decoder or decoder_for(suffix, mode, sample=data)
+    with tile_phases.phase("decode"):
+        try:
+            return decode_with(decoder, data, mode)
+        except (*DECODE_ERRORS[decoder], *DECODE_ERRORS["pil"]):
+            return None
+
+
+def read_image(path, mode="gray", decoder=None):
+    """Read and decode an image file, returning None if it cannot be read or decoded (like cv2.imread)."""
+    try:
+        data = read_bytes(path)
+    except OSError:
+        return None
+    return decode_image(data, Path(path).suffix, mode, decoder)
+
+
+def read_images(paths, mode="gray", io_workers=None, decode_workers=None):
+    """
+    Stream decoded images in the order of paths, reading and decoding on separate thread pools.
+
+    Reading is I/O-bound and decoding CPU-bound, so each gets its own pool;
+    None is yielded for files that cannot be read or decoded.
+    """
+    def read(path):
+        try:
+            return path, read_bytes(path)
+        except OSError:
+            return path, None
+
+    def decode(item):
+        path, data = item
+        return None if data is None else decode_image(data, Path(path).suffix, mode)
+
+    encoded = stream_map(read, paths, io_workers or 2 * os.cpu_count())
+    yield from stream_map(decode, encoded, decode_workers or os.cpu_count())
+
+
+def encode_image(array, format_name="PNG", settings=None, palette=None):
+    """
+    Encode an array with PIL.
+
+    With palette (a flat [r, g, b, r, g, b, ...] list), the uint8 array is
+    encoded as palette indices, an 8-bit 'P' mode image. For PNG, settings
+    (see ENCODER_DEFAULTS) give the zlib level and strategy, and with one_bit
+    masks holding only 0 and 255 are stored with 1 bit per pixel. WebP is
+    always lossless.
+
+    Returns:
+        BytesIO with the encoded image
+    """
+    settings = settings or ENCODER_DEFAULTS
+    image = Image.fromarray(array)
+    options = {}
+    if palette is not None:
+        image.putpalette(palette)
+    if format_name == "PNG":
+        options = {"compress_level": settings["compress_level"],
+                   "compress_type": ZLIB_STRATEGIES[settings["zlib_strategy"]]}
+        if settings["one_bit"] and palette is None and array.ndim == 2 and array.dtype == np.uint8:
+            if not np.any((array != 0) & (array != 255)):
+                image = Image.fromarray(array > 0)
+    elif format_name == "WEBP":
+        options = {"lossless": True, "quality": settings["webp_quality"], "method": settings["webp_method"]}
+    buffer = io.BytesIO()
+    image.save(buffer, format=format_name, **options)
+    return buffer
+
+
+def encoded_path(path, output=None):
+    """Path save_image writes for path: with a .webp suffix when the output is encoded as WebP."""
+    path = Path(path)
+    return path.with_suffix(".webp") if encoder_settings(output)["format"] == "webp" else path
+
+
+def save_image(array, path, palette=None, output=None):
+    """
+    Save an array with PIL, encoding in memory first so encode and write time are measured apart.
+
+    output names the encoder settings to use (see encoder_settings); with the
+    'webp' format, the file is written with a .webp suffix instead.
+
+    Returns:
+        Path of the written file
+    """
+    path = encoded_path(path, output)
+    settings = encoder_settings(output)
+    with tile_phases.phase("encode"):
+        buffer = encode_image(array, Image.registered_extensions()[path.suffix.lower()], settings, palette)
+    with tile_phases.phase("write"):
+        with open(path, 'wb') as f:
+            f.write(buffer.getbuffer())
+    return path
+
+
+def main(
+    config_path="./config/config.yaml",
+    dataset_split="train",
+    repeat=20,
+    limit=20
+):
+    """
+    Benchmark the available decoders on the masks and HE images of a split.
+
+    Args:
+        config_path: Path to configuration file
+        dataset_split: Dataset split to take images from ('train' or 'val')
+        repeat: Decodes per image and decoder, the fastest is kept
+        limit: Images per kind
+    """
+    config = load_config(config_path)
+    output_dirs = config["dataset"]["output_dirs"]
+    ext = f".{config['settings']['mask_file_extension']}"
+    kinds = [
+        ("mask", resolve_variables(config, output_dirs[f"{dataset_split}_source"]), "gray"),
+        ("HE", resolve_variables(config, output_dirs[f"{dataset_split}_target"]), "rgb"),
+    ]
+    print(f"Available decoders: {', '.join(available_decoders())}")
+    print(f"\n{'Images':<8}{'Mode':<8}{'Decoder':<12}{'ms/image':>10}{'MP/s':>10}")
+    for kind, directory, mode in kinds:
+        paths = sorted(scan_files(directory, ext))[:limit]
+        if not paths:
+            print(f"{kind:<8}{mode:<8}no {ext} files in {directory}")
+            continue
+        totals = {}
+        pixels = 0
+        for path in paths:
+            data = read_bytes(path)
+            pixels += np.prod(decode_image(data, ext, mode, decoder="pil").shape[:2])
+            for name, seconds in benchmark_decoders(data, ext, mode, repeat=repeat).items():
+                totals[name] = totals.get(name, 0.0) + seconds
+        for name, seconds in sorted(totals.items(), key=lambda item: item[1]):
+            print(f"{kind:<8}{mode:<8}{name:<12}{1000 * seconds / len(paths):>10.3f}{pixels / seconds / 1e6:>10.1f}")
+
+
+if __name__ == "__main__":
+    Fire(main)
@@ -0,0 +1,142 @@
+import os
+import json
+import hashlib
+import threading
+from pathlib import Path
+
+from utils import resolve_variables
+
+# Config sections whose values change the outputs of each stage. A change in
+# any of them invalidates the whole manifest of that stage.
+STAGE_CONFIG_SECTIONS = {
+    "split": ["dataset.source_dirs", "dataset.split", "dataset.output_dirs"],
+    # Encoder settings decide the suffix and bytes of the written masks
+    "reduce": ["files.mapper", "image_io.encoders"],
+    "counts": [],
+    "color": ["settings.colors", "settings.colored_mask_format", "image_io.encoders"],
+}
+
+MANIFEST_VERSION = 2
+
+
+def _config_value(config, dotted_key):
+    value = config
+    for part in dotted_key.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+
+def config_hash(config, sections, extra=None):
+    """Hash the given dotted config sections (and any extra values) into a short hex digest."""
+    payload = {key: _config_value(config, key) for key in sections}
+    if extra is not None:
+        payload["extra"] = extra
+    encoded = json.dumps(payload, sort_keys=True, default=str).encode()
+    return hashlib.blake2b(encoded, digest_size=16).hexdigest()
+
+
+def file_fingerprint(path, use_hash=False):
+    """Fingerprint a file by size and mtime, optionally adding a content hash."""
+    stat = os.stat(path)
+    fingerprint = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if use_hash:
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        fingerprint["hash"] = digest.hexdigest()
+    return fingerprint
+
+
+class Manifest:
+    """
+    Per-stage record of processed inputs, their fingerprints and their outputs.
+
+    An input is up to date when its fingerprint is unchanged, all of its
+    recorded outputs still exist and the stage config hash is the same as
+    when it was recorded. Lookups and updates are thread-safe.
+    """
+
+    def __init__(self, path, stage_hash, use_hash=False, enabled=True):
+        self.path = Path(path)
+        self.stage_hash = stage_hash
+        self.use_hash = use_hash
+        self.enabled = enabled
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if enabled and self.path.exists():
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            if data.get("version") == MANIFEST_VERSION and data.get("config_hash") == stage_hash:
+                self.entries = data.get("entries", {})
+
+    def lookup(self, input_path):
+        """Return the entry of an up-to-date input, or None if it has to be processed."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self.entries.get(str(input_path))
+        try:
+            current = file_fingerprint(input_path, self.use_hash and entry is not None and "hash" in entry)
+        except OSError:
+            current = None
+        up_to_date = (
+            entry is not None
+            and current is not None
+            and all(entry.get(key) == value for key, value in current.items())
+            and all(os.path.exists(output) for output in entry.get("outputs", []))
+        )
+        with self._lock:
+            if up_to_date:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return entry if up_to_date else None
+
+    def update(self, input_path, outputs=(), data=None):
+        """Record an input as processed together with its outputs and optional cached data."""
+        if not self.enabled:
+            return
+        entry = file_fingerprint(input_path, self.use_hash)
+        entry["outputs"] = [str(output) for output in outputs]
+        if data is not None:
+            entry["data"] = data
+        with self._lock:
+            self.entries[str(input_path)] = entry
+
+    def save(self):
+        """Write the manifest atomically next to its final location."""
+        if not self.enabled:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(self.path.suffix + ".tmp")
+        with self._lock:
+            data = {"version": MANIFEST_VERSION, "config_hash": self.stage_hash, "entries": self.entries}
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+
+def load_manifest(config, stage, dataset_split, extra=None, enabled=None):
+    """
+    Load the manifest of a stage and split using the manifest section of the config.
+
+    Args:
+        config: Loaded configuration
+        stage: Stage name, one of STAGE_CONFIG_SECTIONS
+        dataset_split: Dataset split ('train' or 'val')
+        extra: Additional values that affect the stage outputs (e.g. command-line options)
+        enabled: Override manifest.enabled from the config
+    """
+    manifest_config = config.get("manifest", {})
+    if enabled is None:
+        enabled = manifest_config.get("enabled", False)
+    manifest_dir = Path(resolve_variables(config, manifest_config.get("dir", "${base_dirs.data}/.manifests")))
+    stage_hash = config_hash(config, STAGE_CONFIG_SECTIONS[stage], extra)
+    return Manifest(manifest_dir / f"{stage}_{dataset_split}.json", stage_hash,
+                    use_hash=manifest_config.get("use_hash", False), enabled=enabled)
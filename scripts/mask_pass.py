@@ -0,0 +1,518 @@
+import os
+import csv
+import json
+import itertools
+import threading
+from pathlib import Path
+
+import numpy as np
+from tqdm import tqdm
+from fire import Fire
+
+from discovery import scan_files
+from image_io import read_image, save_image, encoded_path, configure as configure_image_io
+from manifest import load_manifest
+from metrics import StageMetrics, write_metrics
+from profiling import tile_phases
+from prompt_augmenter import augment_prompt
+from rle import rle_stats
+from split_views import split_view
+from stats_index import mask_bbox, build_stats_index, save_stats_index, stats_index_path, EMPTY_BBOX
+from utils import (resolve_variables, load_config, load_class_codes, clean_class_name, create_prompt,
+                   extract_class_name, stream_map)
+
+DEFAULT_PROMPT_TEMPLATE = "pathology image: {class_descriptions}"
+
+# Colored mask formats: 24-bit RGB, or 8-bit class indices with settings.colors as PNG palette
+COLORED_FORMATS = ("rgb", "palette")
+
+
+def load_labels_from_tsv(tsv_path):
+    """Load a GT_code -> label mapping from a TSV file."""
+    labels = {}
+    with open(tsv_path, 'r') as file:
+        reader = csv.DictReader(file, delimiter='\t')
+        for row in reader:
+            labels[int(row['GT_code'])] = row['label']
+    return labels
+
+
+def build_color_map(colors):
+    """Convert the hex colors from settings.colors to a class index -> RGB tuple mapping."""
+    return {
+        i: tuple(int(color.lstrip('#')[j:j+2], 16) for j in (0, 2, 4))
+        for i, color in enumerate(colors)
+    }
+
+
+def palette_lut(color_map):
+    """(256, 3) RGB lookup table of class-index images: the color of every class, black past the last one."""
+    lut = np.zeros((256, 3), dtype=np.uint8)
+    for class_idx in range(min(len(color_map), 256)):
+        lut[class_idx] = color_map[class_idx]
+    return lut
+
+
+def color_luts(color_map):
+    """
+    Per-class 256-entry RGB lookup tables for colorizing binary masks.
+
+    luts[class_idx][value] is the background color for value 0 and the class
+    color for any other value, so luts[class_idx][mask] is the colored mask.
+    """
+    luts = np.empty((len(color_map), 256, 3), dtype=np.uint8)
+    for class_idx in range(len(color_map)):
+        luts[class_idx] = color_map[class_idx]
+        luts[class_idx, 0] = color_map[0]
+    return luts
+
+
+class MaskColorizer:
+    """
+    Colorize masks through RGB lookup tables built once from a color map.
+
+    labels() colors class-index images, binary() a binary mask of one class
+    and binary_chunk() a chunk of (N, H, W) binary masks with one class per
+    mask. Each is a single lookup pass over the pixels, written into out when
+    given so that callers can reuse their output buffers.
+    """
+
+    def __init__(self, color_map):
+        self.palette = palette_lut(color_map)
+        self.class_luts = color_luts(color_map)
+
+    def labels(self, labels, out=None):
+        return np.take(self.palette, labels, axis=0, out=out, mode='clip')
+
+    def binary(self, mask, class_idx, out=None):
+        return np.take(self.class_luts[class_idx], mask, axis=0, out=out, mode='clip')
+
+    def binary_chunk(self, masks, class_codes):
+        return self.class_luts[np.asarray(class_codes)[:, None, None], masks]
+
+
+# Colorizers of the color maps in use, so that their tables are built once per process
+_colorizers = {}
+
+
+def mask_colorizer(color_map):
+    """Shared MaskColorizer of a color map."""
+    key = tuple(color_map.items())
+    colorizer = _colorizers.get(key)
+    if colorizer is None:
+        colorizer = _colorizers[key] = MaskColorizer(color_map)
+    return colorizer
+
+
+# Per-thread colored mask buffers of process_mask_once
+_buffers = threading.local()
+
+
+def reusable_buffer(shape):
+    """uint8 buffer of shape for the calling thread, reused by its next tile of the same size."""
+    buffer = getattr(_buffers, "colored", None)
+    if buffer is None or buffer.shape != shape:
+        buffer = _buffers.colored = np.empty(shape, dtype=np.uint8)
+    return buffer
+
+
+def colorize_mask(mask, class_idx, color_map, out=None):
+    """Turn a binary mask into an RGB image using the background and class colors."""
+    return mask_colorizer(color_map).binary(mask, class_idx, out=out)
+
+
+def lazy_colorization(config):
+    """Whether colored masks are computed on read (settings.lazy_colorization) instead of written."""
+    return bool(config["settings"].get("lazy_colorization", False))
+
+
+def colored_mask_format(config):
+    """Colored mask format from settings.colored_mask_format, one of COLORED_FORMATS."""
+    colored_format = config["settings"].get("colored_mask_format", "rgb")
+    if colored_format not in COLORED_FORMATS:
+        raise ValueError(f"Unknown colored mask format '{colored_format}', expected one of {', '.join(COLORED_FORMATS)}")
+    return colored_format
+
+
+def color_palette(color_map):
+    """Flat [r, g, b, ...] palette of a color map, indexed by class, for palette-mode PNGs."""
+    return [channel for i in range(len(color_map)) for channel in color_map[i]]
+
+
+def index_mask(mask, class_idx):
+    """Turn a binary mask into class indices: class_idx on the foreground, 0 elsewhere."""
+    return np.where(mask > 0, np.uint8(class_idx), np.uint8(0))
+
+
+def mask_prompt(class_idx, foreground_count, total_pixels, label_to_name, prompt_template):
+    """Create the text prompt of a binary mask from its foreground pixel count."""
+    background_count = total_pixels - foreground_count
+
+    # Include all labels, including background (0) if it's in label_to_name
+    class_percentages = []
+    for label, count in ((0, background_count), (class_idx, foreground_count)):
+        if label in label_to_name:
+            percentage = (count / total_pixels) * 100
+            class_percentages.append((clean_class_name(label_to_name[label]), percentage))
+
+    # Sort by percentage in ascending order (smallest first)
+    class_percentages.sort(key=lambda x: x[1])
+
+    if not class_percentages:
+        return prompt_template.format(class_descriptions="background")
+    return create_prompt(class_percentages, prompt_template)
+
+
+def process_mask_once(
+    mask_path,
+    class_codes,
+    color_map=None,
+    colored_dir=None,
+    label_to_name=None,
+    prompt_template=DEFAULT_PROMPT_TEMPLATE,
+    filter_background=False,
+    counts_manifest=None,
+    color_manifest=None,
+    name=None,
+    rle_index=None,
+    colored_format="rgb"
+):
+    """
+    Decode a mask once and derive every requested output from it.
+
+    The colored mask is written to colored_dir when both colored_dir and
+    color_map are given, and a prompt is created when label_to_name is given.
+    With manifests, the mask is not decoded at all when its cached pixel
+    counts and its colored output are still up to date, or when an up-to-date
+    RLE of the mask is found in rle_index. name is the tile filename used for
+    outputs and defaults to the mask filename. colored_format is 'rgb' for
+    24-bit colored masks or 'palette' for 8-bit class indices with the color
+    map as PNG palette.
+
+    Returns:
+        Dictionary with the mask name, class name and index, foreground and
+        total pixel counts, shape, foreground bounding box, and the prompt (None if not requested or filtered
+        out), or None if the class or mask could not be determined.
+    """
+    mask_path = Path(mask_path)
+    name = name or mask_path.name
+    class_name = extract_class_name(name)
+    if not class_name or class_name not in class_codes:
+        print(f"\nWarning: Could not determine class for {name}")
+        return None
+
+    class_idx = class_codes[class_name]
+
+    write_colored = colored_dir is not None and color_map is not None
+    if write_colored and color_manifest is not None and color_manifest.lookup(mask_path) is not None:
+        write_colored = False
+    cached = counts_manifest.lookup(mask_path) if counts_manifest is not None else None
+
+    rle = rle_index.lookup(mask_path) if rle_index is not None and cached is None and not write_colored else None
+
+    if cached is not None and not write_colored:
+        stats = cached["data"]
+    elif rle is not None:
+        # Area and bounding box straight from the runs of the RLE index
+        stats = rle_stats(rle)
+        if counts_manifest is not None:
+            counts_manifest.update(mask_path, data=stats)
+    else:
+        mask = read_image(mask_path, "gray")
+        if mask is None:
+            print(f"\nError: Could not load mask at {mask_path}")
+            return {"name": name, "class_name": class_name, "class_idx": class_idx,
+                    "foreground": 0, "total": 0, "height": 0, "width": 0, "bbox": EMPTY_BBOX,
+                    "prompt": None, "failed": True}
+
+        with tile_phases.phase("compute"):
+            stats = {
+                "foreground": int(np.count_nonzero(mask)),
+                "total": int(mask.size),
+                "height": int(mask.shape[0]),
+                "width": int(mask.shape[1]),
+                "bbox": mask_bbox(mask),
+            }
+        if counts_manifest is not None:
+            counts_manifest.update(mask_path, data=stats)
+
+        if write_colored:
+            output_path = Path(colored_dir) / name
+            if colored_format == "palette":
+                with tile_phases.phase("compute"):
+                    indexed = index_mask(mask, class_idx)
+                output_path = save_image(indexed, output_path, palette=color_palette(color_map), output="colored")
+            else:
+                with tile_phases.phase("compute"):
+                    colored = colorize_mask(mask, class_idx, color_map, out=reusable_buffer((*mask.shape, 3)))
+                output_path = save_image(colored, output_path, output="colored")
+            if color_manifest is not None:
+                color_manifest.update(mask_path, outputs=[output_path])
+
+    prompt = None
+    if label_to_name is not None and not (filter_background and stats["foreground"] == 0):
+        prompt = mask_prompt(class_idx, stats["foreground"], stats["total"], label_to_name, prompt_template)
+
+    return {"name": name, "class_name": class_name, "class_idx": class_idx,
+            "foreground": stats["foreground"], "total": stats["total"], "height": stats["height"],
+            "width": stats["width"], "bbox": tuple(stats["bbox"]), "prompt": prompt, "failed": False}
+
+
+def count_outcome(metrics, result):
+    """Count the outcome of a process_mask_once result in a StageMetrics."""
+    if metrics is not None:
+        metrics.count("unknown_class" if result is None else "failed" if result["failed"] else "processed")
+
+
+def run_mask_pass(mask_files, class_codes, max_workers=None, desc="Processing masks", names=None, metrics=None,
+                  **kwargs):
+    """
+    Run process_mask_once over mask_files with a thread pool.
+
+    mask_files can be a stream (e.g. from discovery.scan_files), and masks are
+    processed while it is still being read. Results are yielded in the order
+    of mask_files so that prompt files stay deterministic. names optionally
+    gives the output tile name of each mask. Tile outcomes and worker busy
+    time are recorded in metrics (a StageMetrics) when given. Extra keyword
+    arguments are passed to process_mask_once.
+    """
+    max_workers = max_workers or os.cpu_count()
+    total = len(mask_files) if hasattr(mask_files, "__len__") else None
+    names = itertools.repeat(None) if names is None else names
+
+    def process(item):
+        if metrics is None:
+            return process_mask_once(item[0], class_codes, name=item[1], **kwargs)
+        with metrics.busy():
+            result = process_mask_once(item[0], class_codes, name=item[1], **kwargs)
+        count_outcome(metrics, result)
+        return result
+
+    results = stream_map(process, zip(mask_files, names), max_workers)
+    yield from tqdm(results, total=total, desc=desc, unit="file")
+
+
+def new_pixel_counts(class_codes):
+    """Create empty pixel and per-class mask counters."""
+    pixel_counts = {0: 0}  # Start with background class (0)
+    for code in class_codes.values():
+        pixel_counts[code] = 0
+    masks_per_class = {name: 0 for name in class_codes.keys()}
+    return pixel_counts, masks_per_class
+
+
+def accumulate_pixel_counts(result, pixel_counts, masks_per_class):
+    """Add the counts of one process_mask_once result to the running totals."""
+    masks_per_class[result["class_name"]] += 1
+    if result["failed"]:
+        return
+    pixel_counts[0] += result["total"] - result["foreground"]
+    pixel_counts[result["class_idx"]] += result["foreground"]
+
+
+def write_pixel_counts_csv(output_file, pixel_counts, masks_per_class, class_codes):
+    """Write pixel counts, percentages and masks per class to a CSV file."""
+    label_to_name = {v: k for k, v in class_codes.items()}
+    total_pixels = sum(pixel_counts.values())
+    percentages = {label_id: (count / total_pixels) * 100 if total_pixels else 0.0
+                   for label_id, count in pixel_counts.items()}
+
+    with open(output_file, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        # Section 1: Pixel counts and percentages
+        writer.writerow(['Label ID', 'Class Name', 'Pixel Count', 'Percentage', 'Mask Count'])
+
+        # Sort by percentage (descending) to show most common classes first
+        sorted_items = sorted(pixel_counts.items(), key=lambda x: percentages[x[0]], reverse=True)
+
+        for label_id, count in sorted_items:
+            class_name = label_to_name.get(label_id, 'Unknown')
+            mask_count = masks_per_class.get(class_name, 0) if label_id > 0 else 0
+            writer.writerow([label_id, class_name, count, f"{percentages[label_id]:.4f}", mask_count])
+
+        # Add a separator and a section for masks per class summary
+        writer.writerow([])
+        writer.writerow(['Class Name', 'Mask Count', 'Description'])
+
+        # Sort by mask count (descending)
+        sorted_masks = sorted(masks_per_class.items(), key=lambda x: x[1], reverse=True)
+
+        for class_name, count in sorted_masks:
+            if count > 0:
+                writer.writerow([class_name, count, f"Number of masks for {class_name}"])
+
+
+def lazy_source(config, dataset_split, mask_path, class_idx):
+    """
+    prompt.json fields of a lazily colored source: the plain mask, relative to
+    the directory of the split's prompt.json, and its class index.
+    """
+    output_path = Path(resolve_variables(config, config["paths"][f"{dataset_split}_prompt_output_path"]))
+    return {"mask": os.path.relpath(mask_path, output_path.parent), "class_idx": int(class_idx)}
+
+
+def prompt_record(config, dataset_split, name, prompt, target=None, mask_path=None, class_idx=None):
+    """
+    Create a prompt.json record with the directory prefixes from the config.
+
+    target overrides the target path, e.g. for split views that read HE images
+    from their tissue directories. The source keeps the suffix the colored mask
+    is written with (see image_io.encoded_path). With mask_path, the record also
+    points to the plain mask and class index the source is colored from on read.
+    """
+    source_dir_name = Path(config["paths"][f"{dataset_split}_colored_mask_dir"]).name
+    target_dir_name = Path(config["dataset"]["output_dirs"][f"{dataset_split}_target"]).name
+    record = {
+        "source": f"{source_dir_name}/{encoded_path(name, 'colored').name}",
+        "target": target or f"{target_dir_name}/{name}",
+        "prompt": prompt
+    }
+    if mask_path is not None:
+        record.update(lazy_source(config, dataset_split, mask_path, class_idx))
+    return record
+
+
+def view_target(config, dataset_split, he_path):
+    """Target path of a split view tile, relative to the directory of the split's prompt.json."""
+    output_path = Path(resolve_variables(config, config["paths"][f"{dataset_split}_prompt_output_path"]))
+    return os.path.relpath(he_path, output_path.parent)
+
+
+def main(
+    dataset_split="train",
+    config_path="./config/config.yaml",
+    mask_dir=None,
+    count=True,
+    color=None,
+    prompt=True,
+    use_augmentation=False,
+    filter_background=False,
+    use_detailed_labels=True,
+    incremental=None,
+    split_manifest=None
+):
+    """
+    Decode every mask of a split once and produce the pixel class counts,
+    the colored masks and the prompt.json lines in a single pass.
+
+    Args:
+        dataset_split: Dataset split to process ('train' or 'val')
+        config_path: Path to configuration file
+        mask_dir: Directory containing mask files (overrides config if provided)
+        count: Write the pixel class percentages CSV and the per-mask statistics index
+        color: Write colored masks to the colored mask directory (defaults to writing them
+            unless settings.lazy_colorization is set)
+        prompt: Write the prompt.json file
+        use_augmentation: Augment prompts with technical context
+        filter_background: Skip prompts for masks with only background
+        use_detailed_labels: Use detailed class descriptions in prompts
+        incremental: Skip masks whose manifest entries are up to date (defaults to manifest.enabled)
+        split_manifest: Read the split's tiles from the tissue directories listed in this split
+            manifest (True for dataset.split.manifest) instead of mask_dir
+    """
+    if dataset_split not in ["train", "val"]:
+        raise ValueError("Dataset split must be either 'train' or 'val'")
+
+    config = load_config(config_path)
+    configure_image_io(config)
+
+    class_codes = load_class_codes(resolve_variables(config, config["paths"]["labels_tsv"]))
+    print(f"Loaded {len(class_codes)} class codes")
+
+    if mask_dir is None:
+        mask_dir = resolve_variables(config, config["dataset"]["output_dirs"][f"{dataset_split}_source"])
+    mask_dir = Path(mask_dir)
+    lazy = lazy_colorization(config)
+    if color is None:
+        color = not lazy
+
+    kwargs = {"filter_background": filter_background}
+    manifests = [load_manifest(config, "counts", dataset_split, enabled=incremental)]
+    kwargs["counts_manifest"] = manifests[0]
+    if color:
+        colored_dir = Path(resolve_variables(config, config["paths"][f"{dataset_split}_colored_mask_dir"]))
+        colored_dir.mkdir(parents=True, exist_ok=True)
+        kwargs["colored_dir"] = colored_dir
+        kwargs["color_map"] = build_color_map(config["settings"]["colors"])
+        kwargs["colored_format"] = colored_mask_format(config)
+        manifests.append(load_manifest(config, "color", dataset_split, extra=str(colored_dir), enabled=incremental))
+        kwargs["color_manifest"] = manifests[-1]
+    if prompt:
+        labels_key = "labels_detailed_tsv" if use_detailed_labels else "labels_tsv"
+        kwargs["label_to_name"] = load_labels_from_tsv(resolve_variables(config, config["paths"][labels_key]))
+        kwargs["prompt_template"] = config["settings"].get("prompt_template", DEFAULT_PROMPT_TEMPLATE)
+        output_path = Path(resolve_variables(config, config["paths"][f"{dataset_split}_prompt_output_path"]))
+        os.makedirs(output_path.parent, exist_ok=True)
+
+    names = targets = mask_paths = None
+    if split_manifest:
+        view = split_view(config, split_manifest, dataset_split)
+        mask_files = [mask_path for mask_path, _, _ in view]
+        names = [name for _, _, name in view]
+        targets = {name: view_target(config, dataset_split, he_path) for _, he_path, name in view}
+        mask_paths = {name: mask_path for mask_path, _, name in view}
+    else:
+        # Streamed from the directory, so masks are processed while it is being read
+        mask_files = scan_files(mask_dir, f".{config['settings']['mask_file_extension']}")
+        print(f"Reading mask files from {mask_dir}")
+
+    pixel_counts, masks_per_class = new_pixel_counts(class_codes)
+    unknown_classes = 0
+    total_files = 0
+    processed_prompts = 0
+    results = []
+
+    thread_multiplier = config["settings"].get("thread_multiplier", 2)
+    max_workers = os.cpu_count() * thread_multiplier
+    metrics = StageMetrics("mask_pass", dataset_split, workers=max_workers)
+
+    prompt_file = open(output_path, 'w') if prompt else None
+    try:
+        for result in run_mask_pass(mask_files, class_codes, max_workers=max_workers, names=names,
+                                    desc=f"Processing {dataset_split} masks", metrics=metrics, **kwargs):
+            total_files += 1
+            if result is None:
+                unknown_classes += 1
+                continue
+            accumulate_pixel_counts(result, pixel_counts, masks_per_class)
+            if count:
+                results.append(result)
+
+            if prompt_file is not None and result["prompt"] and not result["prompt"].endswith(": "):
+                text = augment_prompt(result["prompt"], use_augmentation)
+                mask_path = None
+                if lazy:
+                    mask_path = mask_paths[result["name"]] if mask_paths else mask_dir / result["name"]
+                record = prompt_record(config, dataset_split, result["name"], text,
+                                       targets[result["name"]] if targets else None,
+                                       mask_path=mask_path, class_idx=result["class_idx"])
+                prompt_file.write(f"{json.dumps(record)}\n")
+                processed_prompts += 1
+    finally:
+        if prompt_file is not None:
+            prompt_file.close()
+        for manifest in manifests:
+            manifest.save()
+
+    print(f"\nTotal masks processed: {total_files - unknown_classes}")
+    print(f"Unknown class masks: {unknown_classes}")
+
+    if count:
+        results_dir = Path(resolve_variables(config, config["paths"]["results_dir"]))
+        os.makedirs(results_dir, exist_ok=True)
+        output_file = results_dir / f"{dataset_split}_{config['files']['output_file']}"
+        write_pixel_counts_csv(output_file, pixel_counts, masks_per_class, class_codes)
+        print(f"Pixel class counts written to {output_file}")
+        index_path = stats_index_path(config, dataset_split)
+        save_stats_index(index_path, build_stats_index(results))
+        print(f"Per-mask statistics index written to {index_path}")
+    if color:
+        print(f"Colored masks saved to {kwargs['colored_dir']}")
+    if prompt:
+        print(f"Valid prompts generated: {processed_prompts}")
+        print(f"Prompts saved to {output_path}")
+    write_metrics(config, metrics, cached=manifests[0].hits, prompts=processed_prompts)
+
+
+if __name__ == "__main__":
+    Fire(main)
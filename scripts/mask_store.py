@@ -0,0 +1,341 @@
+import os
+import concurrent.futures
+from pathlib import Path
+
+import cv2
+import numpy as np
+from tqdm import tqdm
+from fire import Fire
+
+from discovery import scan_files
+from image_io import read_image, read_images, save_image, configure as configure_image_io
+from mask_pass import mask_colorizer, color_palette
+from packed_masks import (PackedMasks, load_packed_masks, count_foreground, packed_bbox, unpack_class_coded,
+                          PACKED_SUFFIX)
+from split_views import split_view
+from stats_index import index_dtype
+from utils import resolve_variables, load_config, load_class_codes, extract_class_name
+
+
+def mask_store_path(config, dataset_split, store=True):
+    """
+    Resolve the store option of the scripts.
+
+    True selects paths.<split>_mask_store from the config, a string is used as the path.
+    """
+    if store is True:
+        return Path(resolve_variables(config, config["paths"][f"{dataset_split}_mask_store"]))
+    return Path(store)
+
+
+def store_index_path(store_path):
+    """Location of the row index next to a mask store, e.g. masks.index.npy for masks.npy."""
+    store_path = Path(store_path)
+    return store_path.with_name(f"{store_path.stem}.index.npy")
+
+
+def store_index_dtype(name_length):
+    return np.dtype([("name", f"U{max(name_length, 1)}"), ("class_code", np.uint8)])
+
+
+def build_mask_store(mask_files, class_codes, store_path, names=None, max_workers=None, desc="Storing masks"):
+    """
+    Decode masks once and write them into a single (N, H, W) uint8 .npy file.
+
+    Masks are read and decoded by separate thread pools (see image_io.read_images)
+    and written row by row in the order of mask_files. Masks of an unknown class, unreadable masks and masks whose
+    shape differs from the first one are left out. The companion index maps
+    every row to its tile name and class code.
+
+    Returns:
+        The row index
+    """
+    names = names or [Path(mask_file).name for mask_file in mask_files]
+    tiles = [(mask_file, name) for mask_file, name in zip(mask_files, names)
+             if extract_class_name(name) in class_codes]
+    if len(tiles) < len(mask_files):
+        print(f"Warning: Skipping {len(mask_files) - len(tiles)} masks of unknown class")
+    if not tiles:
+        raise ValueError("No masks to store")
+
+    first = read_image(tiles[0][0], "gray")
+    if first is None:
+        raise ValueError(f"Could not load mask at {tiles[0][0]}")
+    shape = first.shape
+
+    store_path = Path(store_path)
+    store_path.parent.mkdir(parents=True, exist_ok=True)
+    masks = np.lib.format.open_memmap(store_path, mode='w+', dtype=np.uint8, shape=(len(tiles), *shape))
+    rows = []
+    decoded = read_images([mask_file for mask_file, _ in tiles], "gray", decode_workers=max_workers)
+    for (mask_file, name), mask in tqdm(zip(tiles, decoded), total=len(tiles), desc=desc, unit="file"):
+        if mask is None or mask.shape != shape:
+            print(f"\nWarning: Skipping {mask_file}, it could not be read or is not {shape}")
+            continue
+        masks[len(rows)] = mask
+        rows.append((name, class_codes[extract_class_name(name)]))
+    masks.flush()
+    del masks
+
+    # Rows of skipped masks stay at the end of the file; the index length is authoritative
+    index = np.array(rows, dtype=store_index_dtype(max(len(name) for name, _ in rows)))
+    np.save(store_index_path(store_path), index)
+    return index
+
+
+def load_mask_store(store_path):
+    """
+    Open a mask store read-only as a memory map.
+
+    Bit-packed files (.sgpk, see packed_masks.py) are opened as PackedMasks,
+    which unpack to 0/255 masks when sliced and converted with np.asarray.
+
+    Returns:
+        Tuple of the (N, H, W) memory-mapped masks and the row index
+    """
+    index = np.load(store_index_path(store_path))
+    if Path(store_path).suffix == PACKED_SUFFIX:
+        masks = load_packed_masks(store_path)
+    else:
+        masks = np.load(store_path, mmap_mode='r')
+    return masks[:len(index)], index
+
+
+def iter_store_chunks(masks, chunk_rows=64, unpack=True):
+    """
+    Yield (start row, chunk) slices of a mask store, reading chunk_rows masks at a time.
+
+    With unpack=False, chunks of PackedMasks are yielded still packed.
+    """
+    for start in range(0, len(masks), chunk_rows):
+        chunk = masks[start:start + chunk_rows]
+        yield start, np.asarray(chunk) if unpack or not isinstance(chunk, PackedMasks) else chunk
+
+
+def chunk_bbox(chunk):
+    """Bounding boxes (y0, x0, y1, x1) of a chunk of (N, H, W) masks, all -1 for empty masks."""
+    foreground = chunk != 0
+    rows_any = foreground.any(axis=2)
+    cols_any = foreground.any(axis=1)
+    bbox = np.stack([
+        rows_any.argmax(axis=1),
+        cols_any.argmax(axis=1),
+        chunk.shape[1] - rows_any[:, ::-1].argmax(axis=1),
+        chunk.shape[2] - cols_any[:, ::-1].argmax(axis=1),
+    ], axis=1)
+    bbox[~rows_any.any(axis=1)] = -1
+    return bbox
+
+
+def store_stats_index(masks, index, chunk_rows=64, desc="Counting stored masks"):
+    """
+    Compute the per-mask statistics index of a mask store in one streaming pass.
+
+    Foreground counts and bounding boxes are computed for a whole chunk of
+    masks at a time, with a popcount lookup on the packed bytes for PackedMasks.
+    The result has the layout of stats_index.build_stats_index.
+    """
+    n, height, width = masks.shape
+    stats = np.empty(n, dtype=index_dtype(index.dtype["name"].itemsize // 4))
+    stats["name"] = index["name"]
+    stats["class_code"] = index["class_code"]
+    stats["total"] = height * width
+    stats["height"] = height
+    stats["width"] = width
+
+    for start, chunk in tqdm(iter_store_chunks(masks, chunk_rows, unpack=False),
+                             total=-(-n // chunk_rows), desc=desc):
+        rows = slice(start, start + len(chunk))
+        if isinstance(chunk, PackedMasks):
+            stats["foreground"][rows] = count_foreground(chunk.packed)
+            stats["bbox"][rows] = packed_bbox(chunk.packed, width)
+        else:
+            stats["foreground"][rows] = np.count_nonzero(chunk.reshape(len(chunk), -1), axis=1)
+            stats["bbox"][rows] = chunk_bbox(chunk)
+
+    stats["fg_fraction"] = stats["foreground"] / stats["total"]
+    order = np.argsort(stats["name"], kind="stable")
+    return stats[order]
+
+
+def _write_pngs(executor, arrays, names, output_dir, palette=None, output=None):
+    """Encode a chunk of arrays to image files on the thread pool, with the encoder settings of output."""
+    list(executor.map(lambda item: save_image(item[0], Path(output_dir) / item[1], palette=palette, output=output),
+                      zip(arrays, names)))
+
+
+def color_store(masks, index, color_map, output_dir, chunk_rows=64, max_workers=None, colored_format="rgb",
+                desc="Coloring stored masks"):
+    """
+    Write the colored version of every stored mask.
+
+    A chunk of masks is colorized with a single lookup through the class
+    tables of the shared colorizer, then its PNGs are encoded in parallel. With colored_format 'palette', the
+    class indices are written with the colors as PNG palette instead.
+    """
+    colorizer = mask_colorizer(color_map)
+    png_palette = color_palette(color_map)
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    max_workers = max_workers or os.cpu_count()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for start, chunk in tqdm(iter_store_chunks(masks, chunk_rows, unpack=False),
+                                 total=-(-len(masks) // chunk_rows), desc=desc):
+            codes = index["class_code"][start:start + len(chunk)]
+            names = index["name"][start:start + len(chunk)]
+            if colored_format == "palette":
+                if isinstance(chunk, PackedMasks):
+                    indexed = unpack_class_coded(chunk.packed, chunk.width, codes)
+                else:
+                    indexed = np.where(chunk != 0, codes[:, None, None], 0)
+                _write_pngs(executor, indexed.astype(np.uint8), names, output_dir, palette=png_palette,
+                            output="colored")
+                continue
+            if isinstance(chunk, PackedMasks):
+                colored = colorizer.labels(unpack_class_coded(chunk.packed, chunk.width, codes))
+            else:
+                colored = colorizer.binary_chunk(chunk, codes)
+            _write_pngs(executor, colored, names, output_dir, output="colored")
+
+
+def label_map_lut(label_map):
+    """
+    Compile a label map into a lookup table, unmapped labels going to 0.
+
+    The table has 256 entries, or more when the map has larger labels.
+    """
+    lut = np.zeros(max(256, max(label_map, default=0) + 1), dtype=np.uint8)
+    for old_label, new_label in label_map.items():
+        lut[old_label] = new_label
+    return lut
+
+
+def remap_labels(masks, lut, out=None):
+    """
+    Remap the labels of masks of any shape through a lookup table in a single pass.
+
+    uint8 masks go through cv2.LUT, written into out when given (which may be
+    masks itself). Wider masks, e.g. 16-bit PNGs, are looked up with np.take,
+    labels beyond the table going to 0.
+    """
+    if masks.dtype == np.uint8:
+        flat = masks.reshape(-1, masks.shape[-1])
+        if out is None:
+            return cv2.LUT(flat, lut[:256]).reshape(masks.shape)
+        cv2.LUT(flat, lut[:256], dst=out.reshape(-1, out.shape[-1]))
+        return out
+    size = int(masks.max(initial=0)) + 1
+    if size > len(lut):
+        lut = np.pad(lut, (0, size - len(lut)))
+    return np.take(lut, masks, out=out)
+
+
+def reduce_store(masks, index, label_map, output_dir, chunk_rows=64, max_workers=None, desc="Reducing stored masks"):
+    """
+    Write every stored mask with its labels remapped through label_map.
+
+    Unmapped values become 0, as in reduce_mask_classes, and a chunk of masks
+    is remapped with a single 256-entry lookup table.
+    """
+    lut = label_map_lut(label_map)
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    max_workers = max_workers or os.cpu_count()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for start, chunk in tqdm(iter_store_chunks(masks, chunk_rows), total=-(-len(masks) // chunk_rows), desc=desc):
+            _write_pngs(executor, remap_labels(chunk, lut), index["name"][start:start + len(chunk)], output_dir,
+                        output="reduced")
+
+
+def store_remapped(index):
+    """Whether the labels of a mask store were already remapped in place (see reduce_store_in_place)."""
+    return "remapped" in index.dtype.names and bool(index["remapped"].any())
+
+
+def mark_store_remapped(store_path, index):
+    """Rewrite the row index of a mask store with every row flagged as remapped."""
+    marked = np.empty(len(index), dtype=np.dtype([*((name, index.dtype[name]) for name in index.dtype.names
+                                                     if name != "remapped"), ("remapped", np.bool_)]))
+    for name in index.dtype.names:
+        if name != "remapped":
+            marked[name] = index[name]
+    marked["remapped"] = True
+    np.save(store_index_path(store_path), marked)
+    return marked
+
+
+def reduce_store_in_place(store_path, label_map, chunk_rows=64, desc="Reducing stored masks in place"):
+    """
+    Remap the labels of a .npy mask store in place, chunk by chunk through its memory map.
+
+    No mask files are written: the store holds the reduced masks afterwards.
+    Bit-packed stores only hold binary masks and cannot be remapped. The
+    store index is flagged before the first chunk is written, and a flagged
+    store is never remapped again, since a second pass would map the reduced
+    labels once more (e.g. 255 -> 3 -> 0).
+
+    Returns:
+        Number of masks remapped
+    """
+    if Path(store_path).suffix == PACKED_SUFFIX:
+        raise ValueError(f"Bit-packed store {store_path} cannot hold remapped labels, use a .npy store")
+    index = np.load(store_index_path(store_path))
+    if store_remapped(index):
+        raise ValueError(f"Mask store {store_path} was already remapped in place, rebuild it with "
+                         f"mask_store.py before remapping it again")
+    lut = label_map_lut(label_map)
+    index = mark_store_remapped(store_path, index)
+    masks = np.load(store_path, mmap_mode='r+')[:len(index)]
+    for start in tqdm(range(0, len(masks), chunk_rows), desc=desc):
+        chunk = masks[start:start + chunk_rows]
+        remap_labels(chunk, lut, out=chunk)
+    masks.flush()
+    return len(masks)
+
+
+def main(
+    dataset_split="train",
+    config_path="./config/config.yaml",
+    mask_dir=None,
+    store_path=None,
+    split_manifest=None
+):
+    """
+    Consolidate the masks of a split into a memory-mapped (N, H, W) uint8 store.
+
+    Args:
+        dataset_split: Dataset split to store ('train' or 'val')
+        config_path: Path to configuration file
+        mask_dir: Directory with the mask images (defaults to the split's source directory)
+        store_path: Output .npy file (defaults to paths.<split>_mask_store)
+        split_manifest: Read the split's tiles from the tissue directories listed in this split
+            manifest (True for dataset.split.manifest) instead of mask_dir
+    """
+    if dataset_split not in ["train", "val"]:
+        raise ValueError("Dataset split must be either 'train' or 'val'")
+
+    config = load_config(config_path)
+    configure_image_io(config)
+    class_codes = load_class_codes(resolve_variables(config, config["paths"]["labels_tsv"]))
+    store_path = mask_store_path(config, dataset_split, store_path or True)
+
+    if split_manifest:
+        view = split_view(config, split_manifest, dataset_split)
+        mask_files = [mask_path for mask_path, _, _ in view]
+        names = [name for _, _, name in view]
+    else:
+        if mask_dir is None:
+            mask_dir = resolve_variables(config, config["dataset"]["output_dirs"][f"{dataset_split}_source"])
+        mask_files = sorted(scan_files(mask_dir, f".{config['settings']['mask_file_extension']}"))
+        names = None
+        print(f"Found {len(mask_files)} mask files in {mask_dir}")
+
+    index = build_mask_store(mask_files, class_codes, store_path, names=names,
+                             desc=f"Storing {dataset_split} masks")
+    masks, _ = load_mask_store(store_path)
+    print(f"Stored {len(index)} masks of shape {masks.shape[1:]} in {store_path} "
+          f"({masks.nbytes / 1e6:.1f} MB)")
+
+
+if __name__ == "__main__":
+    Fire(main)
@@ -0,0 +1,142 @@
+import json
+import time
+import resource
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+
+from utils import resolve_variables
+
+# Tile outcomes making up the files of a stage
+OUTCOMES = ("processed", "skipped", "failed", "unknown_class")
+
+# Fields of /proc/self/io: bytes passed to read/write calls (rchar, wchar),
+# bytes actually fetched from or sent to storage (read_bytes, write_bytes)
+PROC_IO_FIELDS = ("rchar", "wchar", "read_bytes", "write_bytes", "syscr", "syscw")
+
+
+def children_cpu_seconds():
+    """User and system CPU time of the terminated and waited-for child processes (e.g. process pool workers)."""
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def read_proc_io():
+    """I/O counters of this process from /proc/self/io, or None where it is not available."""
+    try:
+        with open("/proc/self/io", 'r') as f:
+            counters = dict(line.split(":", 1) for line in f if ":" in line)
+    except OSError:
+        return None
+    return {key: int(counters[key]) for key in PROC_IO_FIELDS if key in counters}
+
+
+class StageMetrics:
+    """
+    Throughput, I/O and tile counters of one stage run.
+
+    Wall time, CPU time and I/O counters are taken when the object is created
+    and again in report(). Tile outcomes are counted with count(), and busy()
+    measures the time workers spend on tiles for the worker utilization. All
+    methods are thread-safe.
+
+    CPU time includes process pool workers once they have exited (the pools
+    of the scripts are shut down before the report), taken from the rusage of
+    the children; Linux likewise adds the I/O counters of exited children to
+    /proc/self/io. busy() only covers threads of this process, so the worker
+    utilization of process backends is not reported. backend ('thread',
+    'process' or 'serial') is recorded in the report.
+    """
+
+    def __init__(self, stage, dataset_split=None, workers=1, backend="thread"):
+        self.stage = stage
+        self.dataset_split = dataset_split
+        self.workers = workers
+        self.backend = backend
+        self.counts = defaultdict(int)
+        self.busy_seconds = 0.0
+        self._lock = threading.Lock()
+        self._start_wall = time.perf_counter()
+        self._start_cpu = time.process_time()
+        self._start_children_cpu = children_cpu_seconds()
+        self._start_io = read_proc_io()
+
+    def count(self, key, n=1):
+        with self._lock:
+            self.counts[key] += n
+
+    @contextmanager
+    def busy(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.busy_seconds += elapsed
+
+    def report(self, **extra):
+        """
+        Build the metrics dictionary of the run so far.
+
+        Files are the tiles counted under one of OUTCOMES; extra items are added
+        to the report as they are.
+        """
+        wall = time.perf_counter() - self._start_wall
+        worker_cpu = children_cpu_seconds() - self._start_children_cpu
+        cpu = time.process_time() - self._start_cpu + worker_cpu
+        files = sum(self.counts[key] for key in OUTCOMES)
+        report = {
+            "stage": self.stage,
+            "split": self.dataset_split,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "wall_seconds": wall,
+            "cpu_seconds": cpu,
+            "worker_process_cpu_seconds": worker_cpu,
+            "cpu_utilization": cpu / wall if wall else 0.0,
+            "backend": self.backend,
+            "workers": self.workers,
+            "worker_utilization": self.busy_seconds / (wall * self.workers) if wall and self.busy_seconds else None,
+            "files": files,
+            "files_per_sec": files / wall if wall else 0.0,
+            "counts": dict(self.counts),
+        }
+        io = read_proc_io()
+        if io is not None and self._start_io is not None:
+            delta = {key: io[key] - self._start_io[key] for key in io if key in self._start_io}
+            report["io"] = delta
+            report["read_mb"] = delta.get("rchar", 0) / 1e6
+            report["write_mb"] = delta.get("wchar", 0) / 1e6
+            report["read_mb_per_sec"] = report["read_mb"] / wall if wall else 0.0
+            report["write_mb_per_sec"] = report["write_mb"] / wall if wall else 0.0
+        report.update(extra)
+        return report
+
+
+def metrics_path(config, stage, dataset_split=None):
+    """Location of the metrics file of a stage, e.g. results/metrics/color-train.json."""
+    metrics_config = config.get("metrics", {})
+    directory = Path(resolve_variables(config, metrics_config.get("dir", "${base_dirs.results}/metrics")))
+    return directory / (f"{stage}-{dataset_split}.json" if dataset_split else f"{stage}.json")
+
+
+def write_metrics(config, metrics, **extra):
+    """
+    Write the report of a StageMetrics to its metrics file, unless metrics.enabled is false.
+
+    Returns:
+        The path written, or None when metrics are disabled
+    """
+    if not config.get("metrics", {}).get("enabled", True):
+        return None
+    path = metrics_path(config, metrics.stage, metrics.dataset_split)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    report = metrics.report(**extra)
+    tmp_path = path.with_suffix(".json.tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    tmp_path.replace(path)
+    print(f"Metrics written to {path} ({report['files_per_sec']:.1f} files/s, "
+          f"{report['cpu_utilization']:.0%} CPU)")
+    return path
@@ -0,0 +1,162 @@
+import struct
+from pathlib import Path
+
+import numpy as np
+from tqdm import tqdm
+from fire import Fire
+
+from utils import resolve_variables, load_config
+
+# File header: magic, version, foreground value, mask count, height, width
+PACKED_MAGIC = b"SGPKMASK"
+PACKED_VERSION = 1
+PACKED_HEADER = struct.Struct("<8sBBxxIII")
+PACKED_SUFFIX = ".sgpk"
+
+# Number of set bits of every byte value
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+class PackedMasks:
+    """
+    Read-only view of a bit-packed mask file.
+
+    Every mask row is stored with np.packbits, 8 pixels per byte, so that an
+    (N, H, W) binary mask array takes (N, H, ceil(W / 8)) bytes. Slicing
+    unpacks only the requested masks.
+    """
+
+    def __init__(self, packed, width, foreground_value=255):
+        self.packed = packed
+        self.width = width
+        self.foreground_value = foreground_value
+
+    @property
+    def shape(self):
+        return (self.packed.shape[0], self.packed.shape[1], self.width)
+
+    @property
+    def nbytes(self):
+        return self.packed.nbytes
+
+    def __len__(self):
+        return self.packed.shape[0]
+
+    def __getitem__(self, rows):
+        if not isinstance(rows, slice):
+            raise TypeError("PackedMasks only supports slicing by rows")
+        return PackedMasks(self.packed[rows], self.width, self.foreground_value)
+
+    def __array__(self, dtype=None, copy=None):
+        masks = unpack_masks(self.packed, self.width, self.foreground_value)
+        return masks if dtype is None else masks.astype(dtype)
+
+
+def pack_masks(masks):
+    """Pack the foreground of (..., H, W) masks into bits along the last axis."""
+    return np.packbits(np.asarray(masks) != 0, axis=-1)
+
+
+def unpack_masks(packed, width, value=255):
+    """Unpack bit-packed masks into uint8 arrays with value for foreground pixels and 0 elsewhere."""
+    bits = np.unpackbits(np.asarray(packed), axis=-1, count=width)
+    return bits * np.uint8(value) if value != 1 else bits
+
+
+def unpack_class_coded(packed, width, class_codes):
+    """Unpack masks into class-coded arrays, foreground pixels taking the class code of their mask."""
+    bits = np.unpackbits(np.asarray(packed), axis=-1, count=width)
+    return bits * np.asarray(class_codes, dtype=np.uint8)[:, None, None]
+
+
+def count_foreground(packed):
+    """Foreground pixel count of every mask from a popcount lookup on the packed bytes."""
+    packed = np.asarray(packed)
+    return POPCOUNT[packed].reshape(len(packed), -1).sum(axis=1, dtype=np.int64)
+
+
+def packed_bbox(packed, width):
+    """
+    Bounding boxes (y0, x0, y1, x1) of bit-packed masks, all -1 for empty masks.
+
+    Rows are tested on the packed bytes; columns are found by OR-reducing the
+    rows of every mask before unpacking a single row of bits.
+    """
+    packed = np.asarray(packed)
+    height = packed.shape[1]
+    rows_any = packed.any(axis=2)
+    cols_any = np.unpackbits(np.bitwise_or.reduce(packed, axis=1), axis=-1, count=width).astype(bool)
+    bbox = np.stack([
+        rows_any.argmax(axis=1),
+        cols_any.argmax(axis=1),
+        height - rows_any[:, ::-1].argmax(axis=1),
+        width - cols_any[:, ::-1].argmax(axis=1),
+    ], axis=1)
+    bbox[~rows_any.any(axis=1)] = -1
+    return bbox
+
+
+def write_packed_masks(path, masks, foreground_value=255, chunk_rows=64, desc="Packing masks"):
+    """
+    Write binary (N, H, W) masks to a bit-packed file, chunk by chunk.
+
+    Raises:
+        ValueError: if a mask has values other than 0 and foreground_value
+    """
+    n, height, width = masks.shape
+    with open(path, 'wb') as f:
+        f.write(PACKED_HEADER.pack(PACKED_MAGIC, PACKED_VERSION, foreground_value, n, height, width))
+        for start in tqdm(range(0, n, chunk_rows), desc=desc):
+            chunk = np.asarray(masks[start:start + chunk_rows])
+            if np.any((chunk != 0) & (chunk != foreground_value)):
+                raise ValueError(f"Masks {start}-{start + len(chunk) - 1} are not binary (0/{foreground_value})")
+            f.write(pack_masks(chunk).tobytes())
+
+
+def load_packed_masks(path):
+    """Open a bit-packed mask file as a memory-mapped PackedMasks."""
+    with open(path, 'rb') as f:
+        magic, version, foreground_value, n, height, width = PACKED_HEADER.unpack(f.read(PACKED_HEADER.size))
+    if magic != PACKED_MAGIC or version != PACKED_VERSION:
+        raise ValueError(f"{path} is not a version {PACKED_VERSION} packed mask file")
+    packed = np.memmap(path, dtype=np.uint8, mode='r', offset=PACKED_HEADER.size,
+                       shape=(n, height, (width + 7) // 8))
+    return PackedMasks(packed, width, foreground_value)
+
+
+def main(
+    dataset_split="train",
+    config_path="./config/config.yaml",
+    store_path=None,
+    packed_path=None
+):
+    """
+    Convert the mask store of a split into a bit-packed mask file.
+
+    Args:
+        dataset_split: Dataset split to convert ('train' or 'val')
+        config_path: Path to configuration file
+        store_path: Mask store to convert (defaults to paths.<split>_mask_store)
+        packed_path: Output file (defaults to paths.<split>_packed_masks)
+    """
+    # mask_store reads packed files through this module, so it is imported here
+    from mask_store import mask_store_path, store_index_path, load_mask_store
+    
+    config = load_config(config_path)
+    store_path = mask_store_path(config, dataset_split, store_path or True)
+    if packed_path is None:
+        packed_path = resolve_variables(config, config["paths"][f"{dataset_split}_packed_masks"])
+    packed_path = Path(packed_path)
+
+    masks, index = load_mask_store(store_path)
+    write_packed_masks(packed_path, masks, chunk_rows=config["settings"].get("store_chunk_rows", 64),
+                       desc=f"Packing {dataset_split} masks")
+    np.save(store_index_path(packed_path), index)
+
+    packed = load_packed_masks(packed_path)
+    print(f"Packed {len(packed)} masks from {store_path} into {packed_path}: "
+          f"{masks.nbytes / 1e6:.1f} MB -> {packed.nbytes / 1e6:.1f} MB")
+
+
+if __name__ == "__main__":
+    Fire(main)
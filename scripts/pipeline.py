@@ -0,0 +1,461 @@
+import os
+import json
+import contextlib
+import queue
+import threading
+import time
+from pathlib import Path
+
+from discovery import scan_files
+from image_io import encoded_path, configure as configure_image_io
+from manifest import load_manifest
+from mask_store import label_map_lut
+from metrics import StageMetrics, write_metrics
+from prompt_augmenter import augment_prompt
+from shards import sample_files, write_shards, shard_dir, shard_index_path
+from split_dataset import split_pairs, split_output_dirs, materialize_pair
+from stats_index import build_stats_index, save_stats_index, stats_index_path
+from mask_pass import (count_outcome, process_mask_once, build_color_map, colored_mask_format, lazy_colorization,
+                       mask_prompt, load_labels_from_tsv, new_pixel_counts, accumulate_pixel_counts,
+                       write_pixel_counts_csv, prompt_record, view_target, mask_colorizer, DEFAULT_PROMPT_TEMPLATE)
+from split_views import split_view, split_manifest_path, write_split_manifest
+from utils import resolve_variables, load_config, load_class_codes, stream_map
+
+STAGE_NAMES = ["split", "reduce", "color", "prompt", "stats", "export"]
+
+# Stages run when --stages is not given; export is opt-in
+DEFAULT_STAGES = ["split", "reduce", "color", "prompt", "stats"]
+
+_END = object()
+
+
+class Stage:
+    """A named pipeline step that turns a stream of input items into a stream of output items."""
+
+    def __init__(self, name, func, deps=()):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+
+
+def topological_order(stages):
+    """Return the stages ordered so that every stage comes after its dependencies."""
+    by_name = {stage.name: stage for stage in stages}
+    order = []
+    state = {}
+
+    def visit(stage):
+        if state.get(stage.name) == "done":
+            return
+        if state.get(stage.name) == "visiting":
+            raise ValueError(f"Pipeline has a dependency cycle through stage '{stage.name}'")
+        state[stage.name] = "visiting"
+        for dep in stage.deps:
+            if dep not in by_name:
+                raise ValueError(f"Stage '{stage.name}' depends on unknown stage '{dep}'")
+            visit(by_name[dep])
+        state[stage.name] = "done"
+        order.append(stage)
+
+    for stage in stages:
+        visit(stage)
+    return order
+
+
+def run_stages(stages, queue_size=1024):
+    """
+    Run a stage DAG in one process, one thread per stage.
+
+    Every item a stage yields is streamed to all of its dependents through a
+    bounded queue, so downstream stages start as soon as the first item is
+    ready and independent stages run concurrently.
+
+    Returns:
+        Dictionary of stage name -> {"items": items yielded, "seconds": wall time}
+    """
+    order = topological_order(stages)
+    inboxes = {stage.name: queue.Queue(maxsize=queue_size) for stage in order}
+    dependents = {stage.name: [s.name for s in order if stage.name in s.deps] for stage in order}
+    abort = threading.Event()
+    errors = {}
+    stats = {}
+
+    def put(inbox, item):
+        while not abort.is_set():
+            try:
+                inbox.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def read_inbox(stage):
+        inbox = inboxes[stage.name]
+        remaining = len(stage.deps)
+        while remaining and not abort.is_set():
+            try:
+                item = inbox.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is _END:
+                remaining -= 1
+            else:
+                yield item
+
+    def worker(stage):
+        start = time.perf_counter()
+        count = 0
+        try:
+            for item in stage.func(read_inbox(stage)):
+                if abort.is_set():
+                    break
+                count += 1
+                for name in dependents[stage.name]:
+                    put(inboxes[name], item)
+        except BaseException as e:
+            errors[stage.name] = e
+            abort.set()
+        finally:
+            for name in dependents[stage.name]:
+                put(inboxes[name], _END)
+            stats[stage.name] = {"items": count, "seconds": time.perf_counter() - start}
+
+    threads = [threading.Thread(target=worker, args=(stage,), name=f"stage-{stage.name}")
+               for stage in order]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        name, error = next(iter(errors.items()))
+        raise RuntimeError(f"Pipeline stage '{name}' failed: {error}") from error
+    return stats
+
+
+def split_stage(config, splits, seed, max_workers, incremental=None, mode=None):
+    """
+    Link HE images and masks into the split directories, streaming each materialized mask.
+
+    Once every pair has been seen, the membership of both splits is written to
+    the split manifest (dataset.split.manifest), as split_dataset.py does.
+    """
+    mode = mode or config["dataset"]["split"].get("link_mode", "hardlink")
+    output_dirs = split_output_dirs(config)
+    manifests = {split: load_manifest(config, "split", split, extra=[seed, mode], enabled=incremental)
+                 for split in splits}
+
+    def link_pair(pair):
+        split, he_path, mask_path, common_name = pair
+        manifest = manifests[split]
+        mask_out = output_dirs[f"{split}_source"] / common_name
+        if manifest.lookup(he_path) is not None and manifest.lookup(mask_path) is not None:
+            return {"split": split, "path": mask_out}
+        result = materialize_pair(pair, output_dirs, mode)
+        if result is None:
+            return None
+        manifest.update(he_path, outputs=[output_dirs[f"{split}_target"] / common_name])
+        manifest.update(mask_path, outputs=[mask_out])
+        return {"split": split, "path": mask_out}
+
+    def run(_):
+        found = []
+
+        def pending():
+            for pair in split_pairs(config, seed):
+                if pair[2].exists():
+                    found.append(pair)
+                if pair[0] in splits:
+                    yield pair
+
+        try:
+            for item in stream_map(link_pair, pending(), max_workers):
+                if item is not None:
+                    yield item
+        finally:
+            for manifest in manifests.values():
+                manifest.save()
+        manifest_path = split_manifest_path(config)
+        write_split_manifest(manifest_path, found, seed, config["dataset"]["split"]["train_percentage"])
+        print(f"Split manifest written to {manifest_path}")
+    return run
+
+
+def scan_stage(config, splits):
+    """Stream the masks already present in the split directories, in directory order."""
+    ext = config["settings"]["mask_file_extension"]
+
+    def run(_):
+        for split in splits:
+            source_dir = Path(resolve_variables(config, config["dataset"]["output_dirs"][f"{split}_source"]))
+            for path in scan_files(source_dir, f".{ext}"):
+                yield {"split": split, "path": Path(path)}
+    return run
+
+
+def view_stage(config, splits, split_manifest):
+    """Stream the masks of split views straight from the tissue directories."""
+    def run(_):
+        for split in splits:
+            for mask_path, he_path, name in split_view(config, split_manifest, split):
+                yield {"split": split, "path": mask_path, "name": name,
+                       "target": view_target(config, split, he_path)}
+    return run
+
+
+def reduce_stage(config, splits, max_workers, incremental=None):
+    """Reduce mask classes with files.mapper, or pass masks through if no mapper is configured."""
+    mapper_yaml = config.get("files", {}).get("mapper")
+
+    def run(items):
+        if mapper_yaml is None:
+            yield from items
+            return
+
+        from importlib import import_module
+        reduce_module = import_module("3_reduce_mask_classes")
+        mapper_path = resolve_variables(config, mapper_yaml)
+        lut = label_map_lut(reduce_module.load_yaml_mapper(mapper_path))
+        with open(mapper_path, 'r') as f:
+            mapper_text = f.read()
+        plain_dirs = {}
+        manifests = {}
+        for split in splits:
+            plain_dirs[split] = Path(resolve_variables(config, config["paths"][f"{split}_plain_mask_dir"]))
+            plain_dirs[split].mkdir(parents=True, exist_ok=True)
+            manifests[split] = load_manifest(config, "reduce", split,
+                                             extra={"mapper": mapper_text, "output_dir": str(plain_dirs[split])},
+                                             enabled=incremental)
+
+        def reduce_one(item):
+            split = item["split"]
+            output_path = encoded_path(plain_dirs[split] / item.get("name", item["path"].name), "reduced")
+            if manifests[split].lookup(item["path"]) is None:
+                reduce_module.reduce_mask_classes(item["path"], output_path, lut)
+                manifests[split].update(item["path"], outputs=[output_path])
+            # Outputs keep the tile name, whatever suffix the reduced mask is written with
+            return {**item, "path": output_path, "name": item.get("name", item["path"].name)}
+
+        try:
+            yield from stream_map(reduce_one, items, max_workers)
+        finally:
+            for manifest in manifests.values():
+                manifest.save()
+    return run
+
+
+def color_stage(config, class_codes, splits, max_workers, write_colored=True, incremental=None, metrics=None):
+    """Decode each mask once, write its colored version and stream its pixel counts."""
+    color_map = build_color_map(config["settings"]["colors"]) if write_colored else None
+    colored_format = colored_mask_format(config)
+    colored_dirs = {}
+    counts_manifests = {}
+    color_manifests = {}
+    for split in splits:
+        counts_manifests[split] = load_manifest(config, "counts", split, enabled=incremental)
+        colored_dirs[split] = None
+        color_manifests[split] = None
+        if write_colored:
+            colored_dirs[split] = Path(resolve_variables(config, config["paths"][f"{split}_colored_mask_dir"]))
+            colored_dirs[split].mkdir(parents=True, exist_ok=True)
+            color_manifests[split] = load_manifest(config, "color", split, extra=str(colored_dirs[split]),
+                                                   enabled=incremental)
+
+    def color_one(item):
+        split = item["split"]
+        with metrics.busy() if metrics is not None else contextlib.nullcontext():
+            result = process_mask_once(item["path"], class_codes, color_map=color_map,
+                                       colored_dir=colored_dirs[split],
+                                       counts_manifest=counts_manifests[split],
+                                       color_manifest=color_manifests[split],
+                                       name=item.get("name"), colored_format=colored_format)
+        count_outcome(metrics, result)
+        if result is not None:
+            result["split"] = split
+            result["target"] = item.get("target")
+            result["path"] = item["path"]
+        return result
+
+    def run(items):
+        try:
+            for result in stream_map(color_one, items, max_workers):
+                if result is not None:
+                    yield result
+        finally:
+            for manifest in [*counts_manifests.values(), *color_manifests.values()]:
+                if manifest is not None:
+                    manifest.save()
+    return run
+
+
+def prompt_stage(config, use_augmentation, filter_background, use_detailed_labels):
+    """
+    Write prompt.json lines from the pixel counts streamed by the color stage.
+
+    With settings.lazy_colorization, the records also point to the plain mask
+    that consumers color on read.
+    """
+    lazy = lazy_colorization(config)
+    labels_key = "labels_detailed_tsv" if use_detailed_labels else "labels_tsv"
+    label_to_name = load_labels_from_tsv(resolve_variables(config, config["paths"][labels_key]))
+    prompt_template = config["settings"].get("prompt_template", DEFAULT_PROMPT_TEMPLATE)
+
+    def run(items):
+        files = {}
+        try:
+            for result in items:
+                if result["failed"] or (filter_background and result["foreground"] == 0):
+                    continue
+                split = result["split"]
+                if split not in files:
+                    output_path = Path(resolve_variables(config, config["paths"][f"{split}_prompt_output_path"]))
+                    os.makedirs(output_path.parent, exist_ok=True)
+                    files[split] = open(output_path, 'w')
+                prompt = mask_prompt(result["class_idx"], result["foreground"], result["total"],
+                                     label_to_name, prompt_template)
+                prompt = augment_prompt(prompt, use_augmentation)
+                record = prompt_record(config, split, result["name"], prompt, result.get("target"),
+                                       mask_path=result["path"] if lazy else None, class_idx=result["class_idx"])
+                files[split].write(f"{json.dumps(record)}\n")
+                yield {**record, "split": split}
+        finally:
+            for f in files.values():
+                f.close()
+    return run
+
+
+def stats_stage(config, class_codes):
+    """Accumulate the streamed pixel counts and write one CSV and statistics index per split."""
+    results_dir = Path(resolve_variables(config, config["paths"]["results_dir"]))
+
+    def run(items):
+        totals = {}
+        results = {}
+        for result in items:
+            split = result["split"]
+            if split not in totals:
+                totals[split] = new_pixel_counts(class_codes)
+                results[split] = []
+            accumulate_pixel_counts(result, *totals[split])
+            results[split].append(result)
+
+        os.makedirs(results_dir, exist_ok=True)
+        for split, (pixel_counts, masks_per_class) in totals.items():
+            output_file = results_dir / f"{split}_{config['files']['output_file']}"
+            write_pixel_counts_csv(output_file, pixel_counts, masks_per_class, class_codes)
+            save_stats_index(stats_index_path(config, split), build_stats_index(results[split]))
+            yield {"split": split, "path": output_file}
+    return run
+
+
+def export_stage(config, max_workers):
+    """Pack the streamed prompt records with their images and masks into tar shards, one set per split."""
+    export_config = config.get("export", {})
+    directory = shard_dir(config)
+    shard_size = export_config.get("shard_size", 1000)
+    max_workers = export_config.get("max_workers") or max_workers
+    colorizer = mask_colorizer(build_color_map(config["settings"]["colors"]))
+
+    def run(items):
+        samples = {}
+        for record in items:
+            split = record["split"]
+            prompt_dir = Path(resolve_variables(config, config["paths"][f"{split}_prompt_output_path"])).parent
+            samples.setdefault(split, []).append(sample_files(config, split, record, prompt_dir))
+        for split, split_samples in samples.items():
+            index = write_shards(split_samples, directory, split, shard_size, max_workers,
+                                 desc=f"Writing {split} shards", colorizer=colorizer)
+            yield {"split": split, "path": shard_index_path(directory, split), "shards": len(index["shards"])}
+    return run
+
+
+def _as_list(value):
+    """Accept comma-separated strings as well as lists from the command line."""
+    if isinstance(value, str):
+        return [v.strip() for v in value.split(",") if v.strip()]
+    return list(value)
+
+
+def run(
+    config_path="./config/config.yaml",
+    splits=("train", "val"),
+    stages=tuple(DEFAULT_STAGES),
+    use_augmentation=False,
+    filter_background=False,
+    use_detailed_labels=True,
+    seed=None,
+    incremental=None,
+    split_manifest=None
+):
+    """
+    Run the dataset preparation pipeline: split -> reduce -> color -> prompt/stats -> export.
+
+    Stages run concurrently in one process and stream masks to each other, so
+    coloring starts while the split is still copying files.
+
+    Args:
+        config_path: Path to configuration file
+        splits: Dataset splits to process ('train', 'val' or both)
+        stages: Stages to run; when 'split' is left out, the existing split directories are used.
+            'export' (tar shards from the prompts) only runs when listed, and writes the colored
+            masks as with 'color' unless settings.lazy_colorization is on
+        use_augmentation: Augment prompts with technical context
+        filter_background: Skip prompts for masks with only background
+        use_detailed_labels: Use detailed class descriptions in prompts
+        seed: Random seed for the split (defaults to dataset.split.seed)
+        incremental: Only process new or changed files (defaults to manifest.enabled)
+        split_manifest: Read the tiles from the tissue directories listed in this split manifest
+            (True for dataset.split.manifest) instead of splitting or scanning the split directories
+    """
+    config = load_config(config_path)
+    configure_image_io(config)
+    splits = _as_list(splits)
+    stages = _as_list(stages)
+    for split in splits:
+        if split not in ["train", "val"]:
+            raise ValueError("Dataset split must be either 'train' or 'val'")
+    unknown = set(stages) - set(STAGE_NAMES)
+    if unknown:
+        raise ValueError(f"Unknown stages {sorted(unknown)}, expected some of {STAGE_NAMES}")
+
+    class_codes = load_class_codes(resolve_variables(config, config["paths"]["labels_tsv"]))
+    pipeline_config = config.get("pipeline", {})
+    max_workers = os.cpu_count() * config["settings"].get("thread_multiplier", 2)
+    if seed is None:
+        seed = config["dataset"]["split"].get("seed")
+    # Stages share the process, so I/O and CPU are measured for the whole run
+    metrics = StageMetrics("pipeline", "+".join(splits), workers=max_workers)
+
+    if split_manifest:
+        source = Stage("split", view_stage(config, splits, split_manifest))
+    elif "split" in stages:
+        source = Stage("split", split_stage(config, splits, seed, max_workers, incremental))
+    else:
+        source = Stage("split", scan_stage(config, splits))
+    pipeline = [source, Stage("reduce", reduce_stage(config, splits, max_workers, incremental), deps=["split"])]
+    # Shards pack the colored masks, so export writes them too unless they are colored on read
+    write_colored = ("color" in stages or "export" in stages) and not lazy_colorization(config)
+    if "export" in stages and "color" not in stages and write_colored:
+        print("Writing colored masks for the export stage (settings.lazy_colorization is off)")
+    if "color" in stages or "prompt" in stages or "stats" in stages or "export" in stages:
+        # Lazily colored sources are computed by the consumers, so only pixel counts are produced
+        pipeline.append(Stage("color", color_stage(config, class_codes, splits, max_workers,
+                                                   write_colored=write_colored,
+                                                   incremental=incremental,
+                                                   metrics=metrics),
+                              deps=["reduce"]))
+    if "prompt" in stages or "export" in stages:
+        pipeline.append(Stage("prompt", prompt_stage(config, use_augmentation, filter_background,
+                                                     use_detailed_labels), deps=["color"]))
+    if "stats" in stages:
+        pipeline.append(Stage("stats", stats_stage(config, class_codes), deps=["color"]))
+    if "export" in stages:
+        pipeline.append(Stage("export", export_stage(config, max_workers), deps=["prompt"]))
+
+    print(f"Running stages {[stage.name for stage in pipeline]} for splits {splits}")
+    stage_stats = run_stages(pipeline, queue_size=pipeline_config.get("queue_size", 1024))
+
+    print("\nPipeline Summary:")
+    for name, info in stage_stats.items():
+        print(f"  {name}: {info['items']} items in {info['seconds']:.1f}s")
+        info["items_per_sec"] = info["items"] / info["seconds"] if info["seconds"] else 0.0
+    write_metrics(config, metrics, stages=stage_stats)
@@ -0,0 +1,182 @@
+import io
+import os
+import sys
+import json
+import time
+import cProfile
+import pstats
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+
+from utils import resolve_variables, load_config
+
+# Per-tile phases reported by profiled runs
+PHASES = ("read", "decode", "compute", "encode", "write")
+
+
+class PhaseTimer:
+    """
+    Thread-safe wall time totals of the per-tile phases.
+
+    Disabled by default, in which case phase() costs a single attribute check.
+    Totals live in the process that records them: phases timed in the workers
+    of a process pool are not collected.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.seconds[name] += elapsed
+                self.calls[name] += 1
+
+    def summary(self):
+        return {name: {"seconds": self.seconds[name], "calls": self.calls[name],
+                       "ms_per_call": 1000 * self.seconds[name] / self.calls[name]}
+                for name in sorted(self.seconds, key=lambda name: PHASES.index(name) if name in PHASES else len(PHASES))}
+
+
+# Shared by the mask kernels of all scripts, enabled by profile_call
+tile_phases = PhaseTimer()
+
+
+class StackSampler(threading.Thread):
+    """
+    Sample the Python stacks of all threads at a fixed interval.
+
+    cProfile only sees the thread it was enabled in, while the scripts do
+    most of their work in thread pools; the sampled stacks cover every thread
+    of this process, but not the workers of a process pool.
+    """
+
+    def __init__(self, interval=0.005):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.stacks = defaultdict(int)
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self.ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def write_collapsed(self, path):
+        """Write the samples as collapsed stacks, the input format of flamegraph.pl and speedscope."""
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(f"{stack} {count}\n")
+
+
+def profiled_backend(requested=None, configured="thread"):
+    """
+    Pool backend of an entry point, switched to threads while profiling.
+
+    Neither the phase timer nor the stack sampler reach into worker processes,
+    so a process backend that only comes from the config is replaced by the
+    thread backend during a profiled run, and an explicitly requested one is
+    kept with a warning.
+    """
+    if requested is not None:
+        if tile_phases.enabled and requested == "process":
+            print("Warning: Profiling does not cover process pool workers, only the main process "
+                  "is profiled (use the thread backend for per-tile phases and stacks)")
+        return requested
+    if tile_phases.enabled and configured == "process":
+        print("Profiling with the thread backend instead of the configured process backend")
+        return "thread"
+    return configured
+
+
+def profile_dir(config):
+    return Path(resolve_variables(config, config["paths"]["results_dir"])) / "profiles"
+
+
+def profile_call(func, arguments, config_path, name=None, interval=0.005):
+    """
+    Run an entry point with profiling and write the reports into results/profiles.
+
+    Writes, per run, <name>-<timestamp>.prof (cProfile stats of the main
+    thread, readable with pstats or snakeviz), .collapsed (sampled stacks of
+    all threads for a flame graph) and -phases.json (wall and CPU time and the
+    per-tile read/decode/compute/encode/write totals). Only this process is
+    profiled; entry points pick their backend with profiled_backend so that
+    the work stays in its threads.
+
+    Args:
+        func: Entry point, called again with profile=False
+        arguments: Keyword arguments of the call, usually locals() of the entry point
+        config_path: Path to configuration file, for the results directory
+        name: Name of the run in the report filenames (defaults to the function name)
+        interval: Stack sampling interval in seconds
+    """
+    arguments = dict(arguments, profile=False)
+    output_dir = profile_dir(load_config(config_path))
+    output_dir.mkdir(parents=True, exist_ok=True)
+    name = name or func.__name__
+    prefix = output_dir / f"{name}-{time.strftime('%Y%m%d-%H%M%S')}"
+
+    profiler = cProfile.Profile()
+    sampler = StackSampler(interval)
+    tile_phases.reset()
+    tile_phases.enabled = True
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    sampler.start()
+    profiler.enable()
+    try:
+        return func(**arguments)
+    finally:
+        profiler.disable()
+        sampler.stop()
+        tile_phases.enabled = False
+        wall, cpu = time.perf_counter() - start_wall, time.process_time() - start_cpu
+        report = {"entry_point": name, "wall_seconds": wall, "cpu_seconds": cpu,
+                  "cpu_utilization": cpu / wall if wall else 0.0, "phases": tile_phases.summary()}
+
+        profiler.dump_stats(f"{prefix}.prof")
+        sampler.write_collapsed(f"{prefix}.collapsed")
+        with open(f"{prefix}-phases.json", 'w') as f:
+            json.dump(report, f, indent=2)
+        print_profile_report(report, profiler, prefix)
+
+
+def print_profile_report(report, profiler, prefix, top=15):
+    print(f"\nProfile of {report['entry_point']}: {report['wall_seconds']:.2f}s wall, "
+          f"{report['cpu_seconds']:.2f}s CPU ({report['cpu_utilization']:.0%} of one core)")
+    if report["phases"]:
+        # Phases overlap across worker threads, so their sum can exceed the wall time
+        print(f"{'Phase':<10}{'Calls':>10}{'Seconds':>12}{'ms/call':>10}")
+        for name, phase in report["phases"].items():
+            print(f"{name:<10}{phase['calls']:>10}{phase['seconds']:>12.2f}{phase['ms_per_call']:>10.3f}")
+    stream = io.StringIO()
+    pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(top)
+    print(stream.getvalue())
+    print(f"Profile written to {prefix}.prof, {prefix}.collapsed and {prefix}-phases.json")
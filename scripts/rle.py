@@ -0,0 +1,290 @@
+import os
+import json
+import random
+import threading
+import concurrent.futures
+from pathlib import Path
+
+import numpy as np
+from tqdm import tqdm
+from fire import Fire
+
+from discovery import scan_files
+from image_io import read_image, configure as configure_image_io
+from manifest import file_fingerprint
+from split_views import split_view
+from utils import resolve_variables, load_config
+
+# Name of the RLE index written next to the mask PNGs of a directory
+RLE_INDEX_NAME = "rle.jsonl"
+
+
+def encode_rle(mask):
+    """
+    Encode the foreground of a mask as COCO run-length counts.
+
+    Pixels are read in column-major order and the counts alternate between
+    background and foreground runs, starting with background (possibly 0).
+
+    Returns:
+        Dictionary with 'size' [height, width] and uncompressed 'counts'
+    """
+    flat = np.asarray(mask).ravel(order='F') != 0
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    boundaries = np.concatenate(([0], changes, [flat.size]))
+    counts = np.diff(boundaries)
+    if flat.size and flat[0]:
+        counts = np.concatenate(([0], counts))
+    return {"size": [int(mask.shape[0]), int(mask.shape[1])], "counts": counts.tolist()}
+
+
+def decode_rle(rle):
+    """Decode an uncompressed RLE into a uint8 mask of 0s and 1s."""
+    height, width = rle["size"]
+    counts = np.asarray(rle["counts"], dtype=np.int64)
+    values = np.arange(len(counts)) % 2
+    return np.repeat(values.astype(np.uint8), counts).reshape((height, width), order='F')
+
+
+def compress_counts(counts):
+    """Compress RLE counts into the COCO string format used by pycocotools."""
+    chars = []
+    for i, count in enumerate(counts):
+        x = int(count)
+        if i > 2:
+            x -= int(counts[i - 2])
+        more = True
+        while more:
+            c = x & 0x1f
+            x >>= 5
+            more = (x != -1) if (c & 0x10) else (x != 0)
+            if more:
+                c |= 0x20
+            chars.append(chr(c + 48))
+    return "".join(chars)
+
+
+def decompress_counts(string):
+    """Decompress a COCO RLE counts string into a list of counts."""
+    counts = []
+    p = 0
+    while p < len(string):
+        x = 0
+        k = 0
+        more = True
+        while more:
+            c = ord(string[p]) - 48
+            x |= (c & 0x1f) << (5 * k)
+            more = bool(c & 0x20)
+            p += 1
+            k += 1
+            if not more and (c & 0x10):
+                x |= -1 << (5 * k)
+        if len(counts) > 2:
+            x += counts[-2]
+        counts.append(x)
+    return counts
+
+
+def _runs(rle):
+    """Start and end (exclusive) of the foreground runs in column-major pixel order."""
+    counts = np.asarray(rle["counts"], dtype=np.int64)
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    return starts[1::2], ends[1::2]
+
+
+def rle_area(rle):
+    """Number of foreground pixels."""
+    return int(np.sum(rle["counts"][1::2]))
+
+
+def rle_bbox(rle):
+    """
+    Bounding box (y0, x0, y1, x1) with exclusive ends of the foreground, or all -1 if empty.
+
+    Columns come from the first and last run; rows from the run offsets inside
+    their columns, widened to the full height if any run spans two columns.
+    """
+    height = rle["size"][0]
+    starts, ends = _runs(rle)
+    keep = ends > starts
+    starts, ends = starts[keep], ends[keep]
+    if starts.size == 0:
+        return (-1, -1, -1, -1)
+    last = ends - 1
+    x0 = int(starts[0] // height)
+    x1 = int(last[-1] // height) + 1
+    if np.any(starts // height != last // height):
+        return (0, x0, height, x1)
+    return (int((starts % height).min()), x0, int((last % height).max()) + 1, x1)
+
+
+def rle_crop_area(rle, y0, x0, y1, x1):
+    """
+    Number of foreground pixels inside the crop [y0, y1) x [x0, x1), straight from the runs.
+
+    F(p), the number of crop pixels with a column-major index below p, is
+    computed for every run boundary, and each run contributes F(end) - F(start).
+    """
+    height = rle["size"][0]
+    crop_height = y1 - y0
+
+    def pixels_before(p):
+        column, row = np.divmod(p, height)
+        full_columns = np.clip(column, x0, x1) - x0
+        partial = np.where((column >= x0) & (column < x1), np.clip(row, y0, y1) - y0, 0)
+        return full_columns * crop_height + partial
+
+    starts, ends = _runs(rle)
+    return int(np.sum(pixels_before(ends) - pixels_before(starts)))
+
+
+def sample_crops(rle, crop_size, num_crops=1, min_fraction=0.0, max_tries=100, seed=None):
+    """
+    Sample square crops whose foreground fraction is at least min_fraction, without decoding the mask.
+
+    Returns:
+        List of (y0, x0, y1, x1, foreground fraction), fewer than num_crops if
+        max_tries candidates per crop were rejected
+    """
+    rng = random.Random(seed)
+    height, width = rle["size"]
+    if crop_size > height or crop_size > width:
+        raise ValueError(f"Crop size {crop_size} is larger than the mask ({height}x{width})")
+    crops = []
+    for _ in range(num_crops):
+        for _ in range(max_tries):
+            y0 = rng.randint(0, height - crop_size)
+            x0 = rng.randint(0, width - crop_size)
+            fraction = rle_crop_area(rle, y0, x0, y0 + crop_size, x0 + crop_size) / (crop_size * crop_size)
+            if fraction >= min_fraction:
+                crops.append((y0, x0, y0 + crop_size, x0 + crop_size, fraction))
+                break
+    return crops
+
+
+def rle_stats(rle):
+    """Mask statistics in the format of process_mask_once, computed from the runs."""
+    height, width = rle["size"]
+    return {"foreground": rle_area(rle), "total": height * width, "height": height, "width": width,
+            "bbox": rle_bbox(rle)}
+
+
+def rle_index_path(mask_dir):
+    return Path(mask_dir) / RLE_INDEX_NAME
+
+
+def build_rle_index(mask_dir, suffix=".png", max_workers=None, desc="Encoding masks"):
+    """
+    Encode the mask PNGs of a directory ending with suffix and write the RLE index next to them.
+
+    Each line holds the mask filename, its file fingerprint and the COCO RLE
+    with compressed counts. Returns the number of encoded masks.
+    """
+    mask_dir = Path(mask_dir)
+    mask_files = [Path(path) for path in sorted(scan_files(mask_dir, suffix))]
+
+    def encode(mask_path):
+        mask = read_image(mask_path, "gray")
+        if mask is None:
+            print(f"\nError: Could not load mask at {mask_path}")
+            return None
+        rle = encode_rle(mask)
+        return {"name": mask_path.name, "file": file_fingerprint(mask_path),
+                "size": rle["size"], "counts": compress_counts(rle["counts"])}
+
+    max_workers = max_workers or os.cpu_count()
+    tmp_path = rle_index_path(mask_dir).with_suffix(".jsonl.tmp")
+    count = 0
+    with open(tmp_path, 'w') as f, concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for entry in tqdm(executor.map(encode, mask_files), total=len(mask_files), desc=desc, unit="file"):
+            if entry is not None:
+                f.write(f"{json.dumps(entry)}\n")
+                count += 1
+    os.replace(tmp_path, rle_index_path(mask_dir))
+    return count
+
+
+class RleIndex:
+    """
+    Lazily loaded RLE indexes of the mask directories.
+
+    lookup returns the RLE of a mask when the index of its directory has an
+    entry whose fingerprint still matches the file, and None otherwise.
+    """
+
+    def __init__(self):
+        self.indexes = {}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _directory_index(self, mask_dir):
+        with self._lock:
+            if mask_dir not in self.indexes:
+                entries = {}
+                path = rle_index_path(mask_dir)
+                if path.exists():
+                    with open(path, 'r') as f:
+                        for line in f:
+                            entry = json.loads(line)
+                            entries[entry["name"]] = entry
+                self.indexes[mask_dir] = entries
+            return self.indexes[mask_dir]
+
+    def lookup(self, mask_path):
+        mask_path = Path(mask_path)
+        entry = self._directory_index(mask_path.parent).get(mask_path.name)
+        up_to_date = False
+        if entry is not None:
+            try:
+                current = file_fingerprint(mask_path)
+                up_to_date = entry["file"] == current
+            except OSError:
+                pass
+        with self._lock:
+            if up_to_date:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if not up_to_date:
+            return None
+        return {"size": entry["size"], "counts": decompress_counts(entry["counts"])}
+
+
+def main(
+    dataset_split="train",
+    config_path="./config/config.yaml",
+    mask_dir=None,
+    split_manifest=None
+):
+    """
+    Write the RLE index next to the mask PNGs of a split.
+
+    Args:
+        dataset_split: Dataset split to encode ('train' or 'val')
+        config_path: Path to configuration file
+        mask_dir: Directory with the mask images (defaults to the split's source directory)
+        split_manifest: Encode the tissue directories of the split's tiles in this split
+            manifest (True for dataset.split.manifest) instead of mask_dir
+    """
+    config = load_config(config_path)
+    configure_image_io(config)
+    suffix = f".{config['settings']['mask_file_extension']}"
+    if split_manifest:
+        # Tissue directories also hold the HE images
+        mask_dirs = sorted({mask_path.parent for mask_path, _, _ in split_view(config, split_manifest, dataset_split)})
+        suffix = config['dataset']['source_dirs']['mask_suffix']
+    else:
+        if mask_dir is None:
+            mask_dir = resolve_variables(config, config["dataset"]["output_dirs"][f"{dataset_split}_source"])
+        mask_dirs = [Path(mask_dir)]
+
+    for directory in mask_dirs:
+        count = build_rle_index(directory, suffix, desc=f"Encoding {directory.name} masks")
+        print(f"Wrote RLE of {count} masks to {rle_index_path(directory)}")
+
+
+if __name__ == "__main__":
+    Fire(main)
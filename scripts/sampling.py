@@ -0,0 +1,112 @@
+import csv
+import math
+import random
+from collections import defaultdict
+from pathlib import Path
+from statistics import NormalDist
+
+import numpy as np
+
+from utils import extract_class_name
+
+
+def stratify(mask_files, names=None, seed=0):
+    """
+    Group mask files by the class in their filename, each group in random order.
+
+    Returns:
+        (strata, unknown): dict of class name -> list of (mask path, name), and the number of
+        files without a class
+    """
+    strata = defaultdict(list)
+    unknown = 0
+    names = names or [None] * len(mask_files)
+    for mask_path, name in zip(mask_files, names):
+        class_name = extract_class_name(name or Path(mask_path).name)
+        if class_name:
+            strata[class_name].append((mask_path, name))
+        else:
+            unknown += 1
+    rng = random.Random(seed)
+    for class_name in sorted(strata):
+        rng.shuffle(strata[class_name])
+    return dict(strata), unknown
+
+
+def allocate_round(population, sampled, round_size, min_per_stratum=2):
+    """
+    Masks to draw from each stratum in the next round.
+
+    The round is split over the strata in proportion to their sizes, with at
+    least min_per_stratum masks so that every stratum has a variance estimate.
+    """
+    total = sum(population.values())
+    allocation = {}
+    for stratum, size in population.items():
+        take = max(math.ceil(round_size * size / total), min_per_stratum)
+        allocation[stratum] = min(take, size - sampled[stratum])
+    return allocation
+
+
+def stratified_percentages(samples, population, confidence=0.95):
+    """
+    Pixel percentages of every label with confidence intervals from a stratified sample.
+
+    The percentage of a label is the ratio of its pixels to all pixels,
+    estimated with the stratified ratio estimator. Its variance is the
+    linearized (Taylor) variance with finite population correction, so strata
+    that were read completely add no uncertainty.
+
+    Args:
+        samples: Dict of stratum -> (n, 256) array of the per-label pixel counts of its sampled masks
+        population: Dict of stratum -> number of masks
+        confidence: Confidence level of the intervals
+
+    Returns:
+        (percentages, half_widths): 256-entry arrays in percent; half widths are
+        infinite while a stratum has fewer than two sampled masks
+    """
+    estimated_counts = np.zeros(256)
+    estimated_total = 0.0
+    for stratum, counts in samples.items():
+        if len(counts):
+            estimated_counts += population[stratum] * counts.mean(axis=0)
+            estimated_total += population[stratum] * counts.sum(axis=1).mean()
+    if estimated_total == 0:
+        return np.zeros(256), np.full(256, np.inf)
+    ratios = estimated_counts / estimated_total
+
+    variance = np.zeros(256)
+    for stratum, size in population.items():
+        counts = samples.get(stratum, np.empty((0, 256)))
+        n = len(counts)
+        if n == size:
+            continue
+        if n < 2:
+            variance[:] = np.inf
+            break
+        residuals = (counts - counts.sum(axis=1, keepdims=True) * ratios) / estimated_total
+        variance += size ** 2 * (1 - n / size) * residuals.var(axis=0, ddof=1) / n
+
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    return 100 * ratios, 100 * z * np.sqrt(variance)
+
+
+def write_sampled_csv(output_file, percentages, half_widths, class_codes, population, sampled, confidence):
+    """Write estimated pixel percentages with their confidence intervals and the masks read per class."""
+    label_to_name = {v: k for k, v in class_codes.items()}
+    labels = sorted(set([0, *class_codes.values()]) | set(np.flatnonzero(percentages).tolist()),
+                    key=lambda label: percentages[label], reverse=True)
+    with open(output_file, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        level = f"{confidence:.0%}"
+        writer.writerow(['Label ID', 'Class Name', 'Percentage', f'CI {level} Low', f'CI {level} High',
+                         'Half Width', 'Masks Sampled', 'Mask Count'])
+        for label in labels:
+            class_name = label_to_name.get(label, 'Unknown')
+            half_width = half_widths[label]
+            writer.writerow([label, class_name, f"{percentages[label]:.4f}",
+                             f"{max(percentages[label] - half_width, 0.0):.4f}",
+                             f"{min(percentages[label] + half_width, 100.0):.4f}", f"{half_width:.4f}",
+                             sampled.get(class_name, 0) if label > 0 else sum(sampled.values()),
+                             population.get(class_name, 0) if label > 0 else sum(population.values())])
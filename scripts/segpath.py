@@ -0,0 +1,25 @@
+from fire import Fire
+
+from batch_loader import main as load
+from image_io import main as codecs
+from mask_store import main as store
+from packed_masks import main as pack
+from pipeline import run
+from rle import main as rle
+from shards import export, read
+from split_dataset import split
+from synthetic_data import main as synth
+
+if __name__ == "__main__":
+    Fire({
+        "run": run,
+        "split": split,
+        "export": export,
+        "read": read,
+        "store": store,
+        "pack": pack,
+        "rle": rle,
+        "load": load,
+        "synth": synth,
+        "codecs": codecs,
+    })
@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 import numpy as np
-import cv2
 import json
 import os
 import random
@@ -12,13 +11,22 @@ from collections import defaultdict
 from fire import Fire
 from tqdm import tqdm
 
+from discovery import scan_files
+from image_io import read_image, save_image, configure as configure_image_io
+from mask_pass import build_color_map, mask_colorizer
+from profiling import profile_call
 from utils import clean_class_name, create_prompt, extract_class_name, load_class_codes
 from utils import resolve_variables, load_config
+from split_views import split_view
+from stats_index import load_stats_index, stats_index_path, index_by_class
 
 def select_samples(
     config_path: str = "./config/config.yaml",
     filename: str = "combined_mask",
-    random_seed: int = 42
+    random_seed: int = 42,
+    use_index: bool = False,
+    split_manifest: str = None,
+    profile: bool = False
 ):
     """
     Select one mask per class, combine them into a single visualization,
@@ -28,12 +36,23 @@ def select_samples(
         config_path: Path to configuration file
         filename: Base filename for output files (without extension)
         random_seed: Random seed for reproducibility
+        use_index: Pick masks from the per-mask statistics index instead of listing the
+            mask directory; the index is not checked against the masks on disk, so rebuild
+            it after masks change
+        split_manifest: Read the val tiles from the tissue directories listed in this split
+            manifest (True for dataset.split.manifest) instead of the val mask directory
+        profile: Write cProfile stats, a collapsed-stack flame graph and per-tile phase times
+            into results/profiles (see profiling.py)
     """
+    if profile:
+        return profile_call(select_samples, locals(), config_path)
+    
     # Set random seed for reproducibility
     random.seed(random_seed)
     
     # Load configuration
     config = load_config(config_path)
+    configure_image_io(config)
     
     # Get results directory from config
     results_dir = Path(resolve_variables(config, config["paths"]["results_dir"]))
@@ -67,16 +86,40 @@ def select_samples(
         for row in reader:
             detailed_labels[int(row['GT_code'])] = row['label']
     
-    # Get all mask files
-    mask_files = list(mask_dir.glob("*.png"))
-    print(f"Found {len(mask_files)} mask files in {mask_dir}")
+    index_path = stats_index_path(config, "val")
+    
+    # Mask path of every tile name, from the split view or the val mask directory
+    if split_manifest:
+        mask_paths = {name: mask_path for mask_path, _, name in split_view(config, split_manifest, "val")}
+    else:
+        mask_paths = None
+    
+    def mask_path_of(name):
+        return mask_paths[name] if mask_paths is not None else mask_dir / name
     
     # Group files by class
     class_groups = defaultdict(list)
-    for mask_path in mask_files:
-        class_name = extract_class_name(mask_path.name)
-        if class_name in class_codes:
-            class_groups[class_name].append(mask_path)
+    mask_shapes = {}
+    if use_index:
+        # The statistics index already has the class and shape of every mask
+        index = load_stats_index(index_path)
+        if mask_paths is not None:
+            # Only the tiles of the split view
+            index = index[np.isin(index["name"], list(mask_paths))]
+        print(f"Found {len(index)} masks in statistics index {index_path}")
+        for class_name, names in index_by_class(index, class_codes).items():
+            class_groups[class_name] = [mask_path_of(name) for name in sorted(names)]
+        mask_shapes = {mask_path_of(str(row["name"])): (int(row["height"]), int(row["width"])) for row in index}
+    else:
+        # Get all mask files
+        if mask_paths is None:
+            mask_paths = {os.path.basename(path): Path(path) for path in scan_files(mask_dir, ".png")}
+            print(f"Found {len(mask_paths)} mask files in {mask_dir}")
+        
+        for name, mask_path in mask_paths.items():
+            class_name = extract_class_name(name)
+            if class_name in class_codes:
+                class_groups[class_name].append(mask_path)
     
     # Check if we have masks for all classes
     if len(class_groups) < len(class_codes):
@@ -94,9 +137,11 @@ def select_samples(
             selected = random.choice(masks)
             selected_masks[class_name] = selected
             
-            # Read the first mask to get the shape
-            if reference_shape is None:
-                mask = cv2.imread(str(selected), cv2.IMREAD_GRAYSCALE)
+            # Read the first mask to get the shape, unless the index already has it
+            if reference_shape is None and selected in mask_shapes:
+                reference_shape = mask_shapes[selected]
+            elif reference_shape is None:
+                mask = read_image(selected, "gray")
                 if mask is not None:
                     reference_shape = mask.shape
     
@@ -119,7 +164,7 @@ def select_samples(
     # Add each mask to the combined image with its class index
     for class_name, mask_path in selected_masks.items():
         class_idx = class_codes[class_name]
-        mask = cv2.imread(str(mask_path), cv2.IMREAD_GRAYSCALE)
+        mask = read_image(mask_path, "gray")
         
         if mask is not None and mask.shape == reference_shape:
             # For binary masks, foreground is class_idx, background remains 0
@@ -153,26 +198,16 @@ def select_samples(
     prompt = create_prompt(class_percentages, prompt_template)
     
     # Create a colored version of the combined mask
-    colors = config["settings"]["colors"]
-    colored_mask = np.zeros((reference_shape[0], reference_shape[1], 3), dtype=np.uint8)
-    
-    for class_idx in range(min(len(colors), 9)):  # Make sure we don't exceed color map
-        if class_idx < len(colors):
-            # Convert hex color to RGB
-            hex_color = colors[class_idx].lstrip('#')
-            rgb_color = tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
-            # Apply color to the mask where class_idx matches
-            colored_mask[combined_mask == class_idx] = rgb_color
+    # One lookup through the shared palette table, classes without a color stay black
+    colored_mask = mask_colorizer(build_color_map(config["settings"]["colors"])).labels(combined_mask)
     
     # Save files with consistent naming
     # 1. Colored mask
-    colored_mask_path = results_dir / f"{filename}.png"
-    cv2.imwrite(str(colored_mask_path), colored_mask)
+    colored_mask_path = save_image(colored_mask, results_dir / f"{filename}.png", output="samples")
     print(f"Saved colored mask to {colored_mask_path}")
     
     # 2. Grayscale mask with class indices
-    gray_mask_path = results_dir / f"{filename}_gray.png"
-    cv2.imwrite(str(gray_mask_path), combined_mask)
+    gray_mask_path = save_image(combined_mask, results_dir / f"{filename}_gray.png", output="samples")
     print(f"Saved grayscale mask to {gray_mask_path}")
     
     # 3. Prompt text file
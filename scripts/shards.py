@@ -0,0 +1,346 @@
+import os
+import io
+import json
+import time
+import random
+import tarfile
+import concurrent.futures
+from pathlib import Path
+
+from tqdm import tqdm
+from fire import Fire
+
+from image_io import read_image, encode_image, encoder_settings, encoded_path, configure as configure_image_io
+from mask_pass import build_color_map, mask_colorizer
+from utils import resolve_variables, load_config
+
+# Tar member extension of each part of a sample, WebDataset style: <key>.<ext>. Image parts keep the
+# suffix of their file instead of .png, e.g. color.webp for colored masks encoded as WebP
+SAMPLE_EXTENSIONS = {
+    "he": "he.png",
+    "color": "color.png",
+    "mask": "mask.png",
+    "prompt": "txt",
+}
+
+
+def read_prompt_records(prompt_path):
+    """Read the JSON lines of a prompt.json file."""
+    with open(prompt_path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def plain_mask_path(config, dataset_split, name, target_path):
+    """
+    Find the plain (non-colored) mask of a sample.
+
+    Reduced masks in the plain mask directory come first (with the suffix they
+    are encoded with), then the masks of the split directory, then the mask
+    next to the HE image of a split view tile.
+    """
+    source_dirs = config["dataset"]["source_dirs"]
+    candidates = [
+        encoded_path(Path(resolve_variables(config, config["paths"][f"{dataset_split}_plain_mask_dir"])) / name,
+                     "reduced"),
+        Path(resolve_variables(config, config["dataset"]["output_dirs"][f"{dataset_split}_source"])) / name,
+    ]
+    if target_path.name.endswith(source_dirs["he_suffix"]):
+        candidates.append(target_path.with_name(
+            target_path.name.replace(source_dirs["he_suffix"], source_dirs["mask_suffix"])))
+    for path in candidates:
+        if path.exists():
+            return path
+    return None
+
+
+def sample_files(config, dataset_split, record, prompt_dir):
+    """
+    Resolve the files of one prompt.json record.
+
+    Returns:
+        Dictionary with the sample key, the HE, colored mask and plain mask paths and the prompt.
+        The colored mask of a lazily colored record is its (plain mask path, class index) pair.
+    """
+    source_path = prompt_dir / record["source"]
+    target_path = prompt_dir / record["target"]
+    # The source may be encoded as WebP, the tile name keeps the mask file extension
+    name = f"{source_path.stem}.{config['settings']['mask_file_extension']}"
+    return {
+        "key": source_path.stem,
+        "he": target_path,
+        "color": (prompt_dir / record["mask"], record["class_idx"]) if "mask" in record else source_path,
+        "mask": plain_mask_path(config, dataset_split, name, target_path),
+        "prompt": record["prompt"],
+    }
+
+
+def _add_member(tar, name, data):
+    """Add a member with fixed metadata so that shards are reproducible."""
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mode = 0o444
+    tar.addfile(info, io.BytesIO(data))
+
+
+def part_extension(sample, part):
+    """Tar member extension of an image part, with the suffix of its file (or of its encoding, when colored lazily)."""
+    if isinstance(sample[part], tuple):
+        return f"{part}{encoded_path(sample[part][0], 'colored').suffix}"
+    return f"{part}{Path(sample[part]).suffix}"
+
+
+def read_part(sample, part, colorizer=None):
+    """Bytes of one part of a sample, coloring and encoding lazily colored masks with a MaskColorizer."""
+    if part == "color" and isinstance(sample[part], tuple):
+        mask_path, class_idx = sample[part]
+        mask = read_image(mask_path, "gray")
+        if mask is None:
+            raise FileNotFoundError(f"Could not load mask at {mask_path}")
+        settings = encoder_settings("colored")
+        return encode_image(colorizer.binary(mask, class_idx), settings["format"].upper(), settings).getvalue()
+    with open(sample[part], 'rb') as f:
+        return f.read()
+
+
+def write_shard(shard_path, samples, colorizer=None):
+    """
+    Write samples to one tar shard, each sample as consecutive <key>.<ext> members.
+
+    The shard is written next to its final location and renamed when complete.
+    Lazily colored masks are colored with colorizer (a mask_pass.MaskColorizer).
+
+    Returns:
+        Dictionary with the shard filename, sample count, size in bytes and sample keys
+    """
+    shard_path = Path(shard_path)
+    tmp_path = shard_path.with_suffix(shard_path.suffix + ".tmp")
+    keys = []
+    with tarfile.open(tmp_path, 'w', format=tarfile.USTAR_FORMAT) as tar:
+        for sample in samples:
+            for part in ("he", "color", "mask"):
+                if sample[part] is None:
+                    continue
+                _add_member(tar, f"{sample['key']}.{part_extension(sample, part)}", read_part(sample, part, colorizer))
+            _add_member(tar, f"{sample['key']}.{SAMPLE_EXTENSIONS['prompt']}", sample["prompt"].encode())
+            keys.append(sample["key"])
+    os.replace(tmp_path, shard_path)
+    return {"shard": shard_path.name, "samples": len(keys), "bytes": shard_path.stat().st_size, "keys": keys}
+
+
+def shard_dir(config, output_dir=None):
+    """Resolve the shard output directory from the export section of the config."""
+    if output_dir is None:
+        output_dir = resolve_variables(config, config.get("export", {}).get("dir", "${base_dirs.data}/shards"))
+    return Path(output_dir)
+
+
+def shard_index_path(directory, dataset_split):
+    return Path(directory) / f"{dataset_split}-index.json"
+
+
+def write_shards(samples, directory, dataset_split, shard_size=1000, max_workers=None, desc="Writing shards",
+                 colorizer=None):
+    """
+    Pack a stream of samples into fixed-size shards with a pool of shard writers.
+
+    Samples are grouped in order into shards of shard_size samples, and every
+    full shard is handed to a writer thread while the next one is collected.
+    The shard index <split>-index.json lists every shard with its samples.
+
+    Returns:
+        The shard index dictionary
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    max_workers = max_workers or os.cpu_count()
+
+    def shard_batches():
+        batch = []
+        for sample in samples:
+            batch.append(sample)
+            if len(batch) == shard_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    futures = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for shard_idx, batch in enumerate(shard_batches()):
+            shard_path = directory / f"{dataset_split}-{shard_idx:06d}.tar"
+            futures.append(executor.submit(write_shard, shard_path, batch, colorizer))
+        shards = [future.result() for future in tqdm(futures, desc=desc, unit="shard")]
+
+    index = {
+        "split": dataset_split,
+        "shard_size": shard_size,
+        "samples": sum(shard["samples"] for shard in shards),
+        "bytes": sum(shard["bytes"] for shard in shards),
+        "shards": shards,
+    }
+    index_path = shard_index_path(directory, dataset_split)
+    with open(index_path, 'w') as f:
+        json.dump(index, f)
+
+    # Shards left over from an earlier export with more samples
+    for path in directory.glob(f"{dataset_split}-*.tar"):
+        if path.name not in {shard["shard"] for shard in shards}:
+            path.unlink()
+    return index
+
+
+def load_shard_index(index_path):
+    """Load a shard index and return it with the full path of every shard."""
+    index_path = Path(index_path)
+    with open(index_path, 'r') as f:
+        index = json.load(f)
+    index["paths"] = [index_path.parent / shard["shard"] for shard in index["shards"]]
+    return index
+
+
+def iter_shard_samples(shard_path):
+    """
+    Stream the samples of one shard in order.
+
+    Yields:
+        Dictionary with '__key__', the raw image bytes of 'he', 'color' and 'mask'
+        (when present) and the 'prompt' string
+    """
+    ext_to_part = {ext: part for part, ext in SAMPLE_EXTENSIONS.items()}
+    sample = None
+    with tarfile.open(shard_path, 'r|') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            key, ext = member.name.split('.', 1)
+            if sample is not None and sample["__key__"] != key:
+                yield sample
+                sample = None
+            if sample is None:
+                sample = {"__key__": key}
+            data = tar.extractfile(member).read()
+            part = ext_to_part.get(ext) or ext.split('.', 1)[0]
+            sample[part] = data.decode() if part == "prompt" else data
+    if sample is not None:
+        yield sample
+
+
+def iter_shards(shard_paths, shuffle_buffer=0, seed=None, rank=0, world_size=1):
+    """
+    Stream samples from tar shards with optional shuffling.
+
+    Shards are read sequentially, each with a single open and streaming reads.
+    With shuffle_buffer > 0, the shard order is shuffled and samples pass
+    through a buffer of that size from which a random sample is emitted for
+    every new one, which mixes samples across neighbouring shards. rank and
+    world_size select every world_size-th shard for distributed readers.
+    """
+    rng = random.Random(seed)
+    shard_paths = list(shard_paths)[rank::world_size]
+    if shuffle_buffer > 0:
+        rng.shuffle(shard_paths)
+
+    buffer = []
+    for shard_path in shard_paths:
+        for sample in iter_shard_samples(shard_path):
+            if shuffle_buffer <= 0:
+                yield sample
+                continue
+            if len(buffer) < shuffle_buffer:
+                buffer.append(sample)
+                continue
+            i = rng.randrange(len(buffer))
+            yield buffer[i]
+            buffer[i] = sample
+    rng.shuffle(buffer)
+    yield from buffer
+
+
+def export(
+    config_path="./config/config.yaml",
+    splits=("train", "val"),
+    output_dir=None,
+    shard_size=None,
+    max_workers=None
+):
+    """
+    Export {HE image, colored mask, plain mask, prompt} samples of prompt.json into tar shards.
+
+    Args:
+        config_path: Path to configuration file
+        splits: Dataset splits to export ('train', 'val' or both)
+        output_dir: Directory of the shards (defaults to export.dir)
+        shard_size: Number of samples per shard (defaults to export.shard_size)
+        max_workers: Number of parallel shard writers (defaults to export.max_workers or cpu count)
+    """
+    config = load_config(config_path)
+    configure_image_io(config)
+    export_config = config.get("export", {})
+    splits = [s.strip() for s in splits.split(",")] if isinstance(splits, str) else list(splits)
+    shard_size = shard_size or export_config.get("shard_size", 1000)
+    max_workers = max_workers or export_config.get("max_workers") or os.cpu_count()
+    directory = shard_dir(config, output_dir)
+    colorizer = mask_colorizer(build_color_map(config["settings"]["colors"]))
+
+    for dataset_split in splits:
+        if dataset_split not in ["train", "val"]:
+            raise ValueError("Dataset split must be either 'train' or 'val'")
+        prompt_path = Path(resolve_variables(config, config["paths"][f"{dataset_split}_prompt_output_path"]))
+        records = read_prompt_records(prompt_path)
+        print(f"Exporting {len(records)} {dataset_split} samples from {prompt_path} to {directory}")
+
+        samples = [sample_files(config, dataset_split, record, prompt_path.parent) for record in records]
+        missing = sum(1 for sample in samples if sample["mask"] is None)
+        if missing:
+            print(f"Warning: {missing} samples have no plain mask")
+
+        start = time.perf_counter()
+        index = write_shards(samples, directory, dataset_split, shard_size, max_workers,
+                             desc=f"Writing {dataset_split} shards", colorizer=colorizer)
+        elapsed = time.perf_counter() - start
+        print(f"Wrote {index['samples']} samples in {len(index['shards'])} shards "
+              f"({index['bytes'] / 1e6:.1f} MB) in {elapsed:.1f}s")
+
+
+def read(
+    config_path="./config/config.yaml",
+    dataset_split="train",
+    output_dir=None,
+    shuffle_buffer=1000,
+    seed=None,
+    limit=None
+):
+    """
+    Stream the shards of a split and report the read throughput.
+
+    Args:
+        config_path: Path to configuration file
+        dataset_split: Dataset split to read
+        output_dir: Directory of the shards (defaults to export.dir)
+        shuffle_buffer: Size of the shuffle buffer (0 reads the samples in order)
+        seed: Random seed for shuffling
+        limit: Stop after this many samples
+    """
+    config = load_config(config_path)
+    index = load_shard_index(shard_index_path(shard_dir(config, output_dir), dataset_split))
+    total = min(index["samples"], limit) if limit else index["samples"]
+
+    count = 0
+    total_bytes = 0
+    start = time.perf_counter()
+    for sample in tqdm(iter_shards(index["paths"], shuffle_buffer, seed), total=total, unit="sample"):
+        total_bytes += sum(len(value) for value in sample.values())
+        count += 1
+        if count == total:
+            break
+    elapsed = time.perf_counter() - start
+    print(f"Read {count} samples from {len(index['paths'])} shards: "
+          f"{count / elapsed if elapsed else 0.0:.1f} samples/s, "
+          f"{total_bytes / 1e6 / elapsed if elapsed else 0.0:.1f} MB/s")
+
+
+if __name__ == "__main__":
+    Fire({
+        "export": export,
+        "read": read,
+    })
@@ -0,0 +1,209 @@
+import os
+import errno
+import fcntl
+import random
+import shutil
+import time
+import concurrent.futures
+from pathlib import Path
+
+from tqdm import tqdm
+from fire import Fire
+
+from discovery import scan_dirs
+from split_views import write_split_manifest, split_manifest_path
+from utils import resolve_variables, load_config
+
+LINK_MODES = ["hardlink", "reflink", "symlink", "copy"]
+
+# ioctl request number of FICLONE from linux/fs.h
+FICLONE = 0x40049409
+
+
+def reflink_file(src, dst):
+    """Clone src into dst with FICLONE, copying the data when the filesystem cannot share extents."""
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS):
+                raise
+            shutil.copyfileobj(fsrc, fdst, 1 << 20)
+
+
+def materialize_file(src, dst, mode="hardlink"):
+    """
+    Make dst refer to the contents of src without copying where possible.
+
+    Hardlinks fall back to a copy across filesystems; symlinks point to the
+    absolute source path. An existing dst is replaced.
+    """
+    if mode not in LINK_MODES:
+        raise ValueError(f"Unknown link mode '{mode}', expected one of {LINK_MODES}")
+    try:
+        os.unlink(dst)
+    except FileNotFoundError:
+        pass
+
+    if mode == "hardlink":
+        try:
+            os.link(src, dst)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            shutil.copyfile(src, dst)
+    elif mode == "reflink":
+        reflink_file(src, dst)
+    elif mode == "symlink":
+        os.symlink(os.path.abspath(src), dst)
+    else:
+        shutil.copyfile(src, dst)
+
+
+def split_pairs(config, seed=None):
+    """
+    Find HE/mask pairs in the tissue directories and assign them to train or val.
+
+    Yields:
+        (split, he_path, mask_path, common_name) where common_name is the HE
+        filename without he_suffix but with the original extension
+    """
+    data_dir = Path(resolve_variables(config, config["base_dirs"]["data"]))
+    source_dirs = config["dataset"]["source_dirs"]
+    he_suffix = source_dirs["he_suffix"]
+    mask_suffix = source_dirs["mask_suffix"]
+
+    # Tissue directories are scanned in parallel, then put back in config order so the split is reproducible
+    directories = [str(data_dir / tissue_dir) for tissue_dir in source_dirs["tissue_dirs"]]
+    order = {directory: i for i, directory in enumerate(directories)}
+    he_files = [Path(path) for path in sorted(scan_dirs(directories, he_suffix),
+                                              key=lambda path: (order[os.path.dirname(path)], path))]
+
+    random.Random(seed).shuffle(he_files)
+    train_count = len(he_files) * config["dataset"]["split"]["train_percentage"] // 100
+
+    for i, he_path in enumerate(he_files):
+        split = "train" if i < train_count else "val"
+        mask_path = he_path.with_name(he_path.name.replace(he_suffix, mask_suffix))
+        # Common filename without suffixes but with the original extension
+        common_name = he_path.name.replace(he_suffix, "")
+        if not common_name.endswith(he_path.suffix):
+            common_name += he_path.suffix
+        yield split, he_path, mask_path, common_name
+
+
+def split_output_dirs(config, remove_old=None):
+    """Resolve and create the split output directories, removing old ones if configured."""
+    output_dirs = {key: Path(resolve_variables(config, value))
+                   for key, value in config["dataset"]["output_dirs"].items()}
+    if remove_old is None:
+        remove_old = config.get("cleanup", {}).get("remove_old_dirs", False)
+    if remove_old:
+        for path in output_dirs.values():
+            shutil.rmtree(path, ignore_errors=True)
+    for path in output_dirs.values():
+        path.mkdir(parents=True, exist_ok=True)
+    return output_dirs
+
+
+def materialize_pair(pair, output_dirs, mode):
+    """
+    Materialize one HE image and its mask in the split directories.
+
+    Returns:
+        Tuple of (split, mask output path, bytes materialized), or None if the mask is missing
+    """
+    split, he_path, mask_path, common_name = pair
+    if not mask_path.exists():
+        print(f"Warning: Mask file not found for {he_path}")
+        return None
+    he_out = output_dirs[f"{split}_target"] / common_name
+    mask_out = output_dirs[f"{split}_source"] / common_name
+    materialize_file(he_path, he_out, mode)
+    materialize_file(mask_path, mask_out, mode)
+    return split, mask_out, os.path.getsize(he_path) + os.path.getsize(mask_path)
+
+
+def _materialize_batch(batch, output_dirs, mode):
+    return [materialize_pair(pair, output_dirs, mode) for pair in batch]
+
+
+def split(
+    config_path="./config/config.yaml",
+    mode=None,
+    seed=None,
+    batch_size=256,
+    max_workers=None,
+    manifest_path=None,
+    materialize=True
+):
+    """
+    Split the dataset into train and val without duplicating the data.
+
+    Uses the same naming rules as 1_split_dataset.sh, but links files into the
+    split directories instead of copying them. The membership is always written
+    to a split manifest; with materialize=False nothing else is written and the
+    scripts read the tiles straight from the tissue directories.
+
+    Args:
+        config_path: Path to configuration file
+        mode: 'hardlink', 'reflink', 'symlink' or 'copy' (defaults to dataset.split.link_mode)
+        seed: Random seed for the split (defaults to dataset.split.seed)
+        batch_size: Number of pairs handled per worker task
+        max_workers: Number of worker threads (defaults to cpu count * thread_multiplier)
+        manifest_path: Where to write the split manifest (defaults to dataset.split.manifest)
+        materialize: Link the files into the split directories
+    """
+    config = load_config(config_path)
+    mode = mode or config["dataset"]["split"].get("link_mode", "hardlink")
+    if mode not in LINK_MODES:
+        raise ValueError(f"Unknown link mode '{mode}', expected one of {LINK_MODES}")
+    if seed is None:
+        seed = config["dataset"]["split"].get("seed")
+    max_workers = max_workers or os.cpu_count() * config["settings"].get("thread_multiplier", 2)
+
+    pairs = []
+    for pair in split_pairs(config, seed):
+        if pair[2].exists():
+            pairs.append(pair)
+        else:
+            print(f"Warning: Mask file not found for {pair[1]}")
+    print(f"Total images found: {len(pairs)}")
+
+    manifest_path = split_manifest_path(config, manifest_path or True)
+    write_split_manifest(manifest_path, pairs, seed, config["dataset"]["split"]["train_percentage"])
+    print(f"Split manifest written to {manifest_path}")
+    if not materialize:
+        counts = {split: sum(1 for pair in pairs if pair[0] == split) for split in ("train", "val")}
+        print(f"Train tiles: {counts['train']}")
+        print(f"Validation tiles: {counts['val']}")
+        return
+
+    output_dirs = split_output_dirs(config)
+    print(f"Materializing split with {mode} using {max_workers} threads")
+
+    batches = [pairs[i:i + batch_size] for i in range(0, len(pairs), batch_size)]
+    counts = {"train": 0, "val": 0}
+    total_bytes = 0
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_materialize_batch, batch, output_dirs, mode) for batch in batches]
+        with tqdm(total=len(pairs), desc="Splitting dataset", unit="pair") as progress:
+            for future in concurrent.futures.as_completed(futures):
+                results = future.result()
+                for result in results:
+                    if result is not None:
+                        counts[result[0]] += 1
+                        total_bytes += result[2]
+                progress.update(len(results))
+    elapsed = time.perf_counter() - start
+
+    print("\nDataset split complete!")
+    print(f"Train pairs: {counts['train']}")
+    print(f"Validation pairs: {counts['val']}")
+    print(f"Throughput: {len(pairs) / elapsed if elapsed else 0.0:.1f} pairs/s, "
+          f"{total_bytes / 1e6 / elapsed if elapsed else 0.0:.1f} MB/s of source data in {elapsed:.1f}s")
+
+
+if __name__ == "__main__":
+    Fire(split)
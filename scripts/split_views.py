@@ -0,0 +1,70 @@
+import os
+import json
+from pathlib import Path
+
+from utils import resolve_variables, extract_class_name
+
+
+def write_split_manifest(path, pairs, seed=None, train_percentage=None):
+    """
+    Write the train/val membership of a split as a JSON manifest of tile IDs.
+
+    Args:
+        path: Output path of the manifest
+        pairs: (split, he_path, mask_path, common_name) tuples from split_pairs
+        seed: Random seed used for the split
+        train_percentage: Percentage of tiles assigned to train
+    """
+    splits = {"train": [], "val": []}
+    for split, _, _, common_name in pairs:
+        splits[split].append(Path(common_name).stem)
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({"seed": seed, "train_percentage": train_percentage,
+                   "splits": {split: sorted(ids) for split, ids in splits.items()}}, f, indent=1)
+
+
+def load_split_manifest(path):
+    """Load a split manifest as a dictionary of split -> list of tile IDs."""
+    with open(path, 'r') as f:
+        return json.load(f)["splits"]
+
+
+def split_manifest_path(config, split_manifest=True):
+    """
+    Resolve the split manifest option of the scripts.
+
+    True selects dataset.split.manifest from the config, a string is used as the path.
+    """
+    if split_manifest is True:
+        return Path(resolve_variables(config, config["dataset"]["split"]["manifest"]))
+    return Path(split_manifest)
+
+
+def tile_paths(config, tile_id):
+    """Paths of the original HE image and mask of a tile in its tissue directory."""
+    source_dirs = config["dataset"]["source_dirs"]
+    tissue_dir = extract_class_name(tile_id)
+    if tissue_dir not in source_dirs["tissue_dirs"]:
+        raise ValueError(f"Tile {tile_id} does not belong to any of dataset.source_dirs.tissue_dirs")
+    directory = Path(resolve_variables(config, config["base_dirs"]["data"])) / tissue_dir
+    return directory / f"{tile_id}{source_dirs['he_suffix']}", directory / f"{tile_id}{source_dirs['mask_suffix']}"
+
+
+def split_view(config, split_manifest, dataset_split):
+    """
+    Tiles of a split read straight from the original tissue directories.
+
+    Returns:
+        List of (mask_path, he_path, name) where name is the tile filename used for
+        outputs, matching the names a physical split would have
+    """
+    path = split_manifest_path(config, split_manifest)
+    ext = os.path.splitext(config["dataset"]["source_dirs"]["he_suffix"])[1]
+    view = []
+    for tile_id in load_split_manifest(path)[dataset_split]:
+        he_path, mask_path = tile_paths(config, tile_id)
+        view.append((mask_path, he_path, f"{tile_id}{ext}"))
+    print(f"Using {len(view)} {dataset_split} tiles from split manifest {path}")
+    return view
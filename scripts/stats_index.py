@@ -0,0 +1,92 @@
+from pathlib import Path
+
+import numpy as np
+
+from utils import resolve_variables
+
+# Bounding boxes are (y0, x0, y1, x1) with exclusive ends, or all -1 for empty masks
+EMPTY_BBOX = (-1, -1, -1, -1)
+
+
+def mask_bbox(mask):
+    """Bounding box of the foreground pixels of a mask."""
+    rows = np.flatnonzero(mask.any(axis=1))
+    if rows.size == 0:
+        return EMPTY_BBOX
+    cols = np.flatnonzero(mask.any(axis=0))
+    return (int(rows[0]), int(cols[0]), int(rows[-1]) + 1, int(cols[-1]) + 1)
+
+
+def index_dtype(name_length):
+    """Structured dtype of the per-mask statistics index."""
+    return np.dtype([
+        ("name", f"U{max(name_length, 1)}"),
+        ("class_code", np.uint8),
+        ("foreground", np.int64),
+        ("total", np.int64),
+        ("fg_fraction", np.float32),
+        ("height", np.int32),
+        ("width", np.int32),
+        ("bbox", np.int32, (4,)),
+    ])
+
+
+def build_stats_index(results):
+    """
+    Build the statistics index from process_mask_once results.
+
+    Failed results are left out. Rows are sorted by name so that the index is
+    independent of processing order.
+    """
+    results = sorted((r for r in results if not r["failed"]), key=lambda r: r["name"])
+    index = np.empty(len(results), dtype=index_dtype(max((len(r["name"]) for r in results), default=1)))
+    for i, r in enumerate(results):
+        index[i] = (r["name"], r["class_idx"], r["foreground"], r["total"],
+                    r["foreground"] / r["total"] if r["total"] else 0.0,
+                    r["height"], r["width"], r["bbox"])
+    return index
+
+
+def stats_index_path(config, dataset_split, variant=None):
+    """Location of the statistics index of a split, with '-<variant>' before the suffix for e.g. multi-class counts."""
+    path = Path(resolve_variables(config, config["paths"][f"{dataset_split}_stats_index"]))
+    return path.with_name(f"{path.stem}-{variant}{path.suffix}") if variant else path
+
+
+def save_stats_index(path, index):
+    """Write the statistics index as a compressed .npz file."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    np.savez_compressed(path, stats=index)
+
+
+def load_stats_index(path):
+    """Load a statistics index written by save_stats_index."""
+    with np.load(path) as data:
+        return data["stats"]
+
+
+def index_pixel_counts(index, class_codes):
+    """
+    Aggregate the statistics index into the pixel and per-class mask counters
+    used by write_pixel_counts_csv.
+    """
+    pixel_counts = {0: int(index["total"].sum() - index["foreground"].sum())}
+    masks_per_class = {}
+    for name, code in class_codes.items():
+        selected = index["class_code"] == code
+        if code > 0:
+            pixel_counts[code] = int(index["foreground"][selected].sum())
+        masks_per_class[name] = int(np.count_nonzero(selected)) if code > 0 else 0
+    return pixel_counts, masks_per_class
+
+
+def index_by_class(index, class_codes):
+    """Group the mask names of the index by class name."""
+    code_to_name = {code: name for name, code in class_codes.items()}
+    groups = {}
+    for code in np.unique(index["class_code"]):
+        name = code_to_name.get(int(code))
+        if name is not None:
+            groups[name] = index["name"][index["class_code"] == code].tolist()
+    return groups
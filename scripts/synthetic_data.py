@@ -0,0 +1,200 @@
+import os
+import time
+import shutil
+import concurrent.futures
+from pathlib import Path
+
+import cv2
+import numpy as np
+from tqdm import tqdm
+from fire import Fire
+
+from utils import resolve_variables, load_config
+
+# Mask sparsity of every tissue directory: mean foreground fraction of the
+# non-empty tiles, typical structure size in pixels at the SegPath tile size
+# and fraction of background-only tiles
+CLASS_SPARSITY = {
+    "aSMA_SmoothMuscle": (0.18, 40, 0.10),
+    "CD235a_RBC": (0.04, 6, 0.30),
+    "CD3CD20_Lymphocyte": (0.08, 8, 0.20),
+    "CD45RB_Leukocyte": (0.10, 8, 0.20),
+    "ERG_Endothelium": (0.05, 12, 0.25),
+    "MIST1_PlasmaCell": (0.02, 8, 0.40),
+    "MNDA_MyeloidCell": (0.03, 8, 0.35),
+    "panCK_Epithelium": (0.30, 60, 0.05),
+}
+DEFAULT_SPARSITY = (0.05, 10, 0.25)
+
+# SegPath tiles are 984x984 crops of whole-slide images
+SEGPATH_TILE_SIZE = 984
+TILES_PER_SLIDE = 64
+
+# RGB colors of eosin-stained stroma and hematoxylin-stained cells
+EOSIN = np.array([232, 182, 212], dtype=np.float32)
+HEMATOXYLIN = np.array([112, 72, 156], dtype=np.float32)
+
+
+def tile_name(tissue_dir, tile_index, tile_size, seed=0):
+    """
+    SegPath-style tile name like 'CD235a_RBC_033_026624_045056'.
+
+    Tiles are grouped into slides of TILES_PER_SLIDE tiles laid out on a grid
+    whose origin depends on the slide and seed.
+    """
+    slide, position = divmod(tile_index, TILES_PER_SLIDE)
+    origin_y, origin_x = np.random.default_rng([seed, slide]).integers(0, 64, size=2) * tile_size
+    columns = int(np.sqrt(TILES_PER_SLIDE))
+    y = origin_y + (position // columns) * tile_size
+    x = origin_x + (position % columns) * tile_size
+    return f"{tissue_dir}_{slide:03d}_{y:06d}_{x:06d}"
+
+
+def smooth_noise(rng, tile_size, feature_size):
+    """Blob-like noise: uniform noise on a grid of feature_size cells, upsampled to the tile."""
+    cells = max(2, int(np.ceil(tile_size / max(feature_size, 1))) + 1)
+    grid = rng.random((cells, cells), dtype=np.float32)
+    return cv2.resize(grid, (tile_size, tile_size), interpolation=cv2.INTER_CUBIC)
+
+
+def synthetic_mask(rng, tile_size, fraction, feature_size):
+    """Binary 0/255 mask whose foreground covers fraction of the tile in blobs of about feature_size pixels."""
+    if fraction <= 0:
+        return np.zeros((tile_size, tile_size), dtype=np.uint8)
+    noise = smooth_noise(rng, tile_size, feature_size)
+    threshold = np.quantile(noise, 1.0 - fraction)
+    return np.where(noise > threshold, np.uint8(255), np.uint8(0))
+
+
+def synthetic_he(rng, mask, feature_size):
+    """RGB H&E-like image: textured eosin background with hematoxylin-stained foreground cells."""
+    tile_size = mask.shape[0]
+    stain = 0.25 * smooth_noise(rng, tile_size, 4 * feature_size)[..., None]
+    stain[mask != 0] += 0.6
+    image = EOSIN + (HEMATOXYLIN - EOSIN) * np.clip(stain, 0.0, 1.0)
+    image += rng.normal(0.0, 6.0, size=image.shape).astype(np.float32)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def generate_tile(tissue_dir, class_index, tile_index, tile_size=SEGPATH_TILE_SIZE, seed=0):
+    """
+    Generate one HE/mask pair, deterministic for a given seed, class and tile index.
+
+    Returns:
+        Tuple of the tile name, the (H, W, 3) RGB HE image and the (H, W) mask
+    """
+    mean_fraction, feature_size, empty_fraction = CLASS_SPARSITY.get(tissue_dir, DEFAULT_SPARSITY)
+    feature_size = feature_size * tile_size / SEGPATH_TILE_SIZE
+    rng = np.random.default_rng([seed, class_index, tile_index])
+    if rng.random() < empty_fraction:
+        fraction = 0.0
+    else:
+        # Beta distribution around the class mean, so tile sparsity varies like on real slides
+        fraction = rng.beta(8 * mean_fraction, 8 * (1 - mean_fraction))
+    mask = synthetic_mask(rng, tile_size, fraction, feature_size)
+    he = synthetic_he(rng, mask, feature_size)
+    return tile_name(tissue_dir, tile_index, tile_size, seed), he, mask
+
+
+def write_tile(data_dir, tissue_dir, class_index, tile_index, tile_size, seed, he_suffix, mask_suffix):
+    """Generate a tile and write its HE image and mask. Returns the foreground fraction and bytes written."""
+    name, he, mask = generate_tile(tissue_dir, class_index, tile_index, tile_size, seed)
+    he_path = Path(data_dir) / tissue_dir / f"{name}{he_suffix}"
+    mask_path = Path(data_dir) / tissue_dir / f"{name}{mask_suffix}"
+    cv2.imwrite(str(he_path), cv2.cvtColor(he, cv2.COLOR_RGB2BGR))
+    cv2.imwrite(str(mask_path), mask)
+    return np.count_nonzero(mask) / mask.size, he_path.stat().st_size + mask_path.stat().st_size
+
+
+def generate_dataset(output_dir, tissue_dirs, tiles_per_class, tile_size=SEGPATH_TILE_SIZE, seed=0,
+                     he_suffix="_HE.png", mask_suffix="_mask.png", max_workers=None, desc="Generating tiles"):
+    """
+    Write tiles_per_class HE/mask pairs into every tissue directory under output_dir.
+
+    Tiles are generated by a thread pool; every tile only depends on the seed,
+    its class and its index, so the dataset is identical for any worker count.
+
+    Returns:
+        Dictionary with the number of tiles, bytes written and mean foreground
+        fraction of every tissue directory
+    """
+    output_dir = Path(output_dir)
+    for tissue_dir in tissue_dirs:
+        (output_dir / tissue_dir).mkdir(parents=True, exist_ok=True)
+    jobs = [(tissue_dir, class_index, tile_index)
+            for class_index, tissue_dir in enumerate(tissue_dirs) for tile_index in range(tiles_per_class)]
+
+    summary = {tissue_dir: {"tiles": 0, "bytes": 0, "fg_fraction": 0.0} for tissue_dir in tissue_dirs}
+    max_workers = max_workers or os.cpu_count()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(
+            lambda job: write_tile(output_dir, *job, tile_size, seed, he_suffix, mask_suffix), jobs
+        )
+        for (tissue_dir, _, _), (fraction, nbytes) in tqdm(zip(jobs, results), total=len(jobs), desc=desc, unit="tile"):
+            summary[tissue_dir]["tiles"] += 1
+            summary[tissue_dir]["bytes"] += nbytes
+            summary[tissue_dir]["fg_fraction"] += fraction
+    for stats in summary.values():
+        stats["fg_fraction"] /= max(stats["tiles"], 1)
+    return summary
+
+
+def main(
+    config_path="./config/config.yaml",
+    output_dir=None,
+    tiles_per_class=None,
+    tile_size=None,
+    seed=None,
+    max_workers=None
+):
+    """
+    Generate a synthetic SegPath-like tree for benchmarks.
+
+    The tree mirrors the repository layout: data/ with the tissue directories of
+    the config, meta/ with the class code files and config/config.yaml, so the
+    scripts can be run from inside it without any changes.
+
+    Args:
+        config_path: Path to configuration file
+        output_dir: Root of the generated tree (defaults to synthetic.dir)
+        tiles_per_class: HE/mask pairs per tissue directory (defaults to synthetic.tiles_per_class)
+        tile_size: Tile width and height in pixels (defaults to synthetic.tile_size)
+        seed: Random seed (defaults to synthetic.seed)
+        max_workers: Generating threads (defaults to cpu count)
+    """
+    config = load_config(config_path)
+    synthetic_config = config.get("synthetic", {})
+    source_dirs = config["dataset"]["source_dirs"]
+    output_dir = Path(output_dir or resolve_variables(config, synthetic_config["dir"]))
+    tiles_per_class = tiles_per_class or synthetic_config.get("tiles_per_class", 100)
+    tile_size = tile_size or synthetic_config.get("tile_size", SEGPATH_TILE_SIZE)
+    seed = synthetic_config.get("seed", 0) if seed is None else seed
+
+    # Class codes and config next to the data, so relative base_dirs resolve inside the tree
+    (output_dir / "meta").mkdir(parents=True, exist_ok=True)
+    (output_dir / "config").mkdir(parents=True, exist_ok=True)
+    for key in ("labels_tsv", "labels_detailed_tsv"):
+        meta_path = Path(resolve_variables(config, config["paths"][key]))
+        if meta_path.exists():
+            shutil.copyfile(meta_path, output_dir / "meta" / meta_path.name)
+    shutil.copyfile(config_path, output_dir / "config" / "config.yaml")
+
+    print(f"Generating {tiles_per_class} {tile_size}x{tile_size} tiles for each of "
+          f"{len(source_dirs['tissue_dirs'])} tissue directories in {output_dir / 'data'} (seed {seed})")
+    start = time.perf_counter()
+    summary = generate_dataset(
+        output_dir / "data", source_dirs["tissue_dirs"], tiles_per_class, tile_size=tile_size, seed=seed,
+        he_suffix=source_dirs["he_suffix"], mask_suffix=source_dirs["mask_suffix"], max_workers=max_workers
+    )
+    elapsed = time.perf_counter() - start
+
+    print(f"\n{'Tissue directory':<22}{'Tiles':>8}{'MB':>10}{'Foreground':>12}")
+    for tissue_dir, stats in summary.items():
+        print(f"{tissue_dir:<22}{stats['tiles']:>8}{stats['bytes'] / 1e6:>10.1f}{stats['fg_fraction']:>12.2%}")
+    total_tiles = sum(stats["tiles"] for stats in summary.values())
+    print(f"\nWrote {total_tiles} pairs in {elapsed:.1f}s ({total_tiles / elapsed if elapsed else 0.0:.1f} pairs/s)")
+    print(f"Run the scripts from {output_dir} to benchmark them on this data")
+
+
+if __name__ == "__main__":
+    Fire(main)
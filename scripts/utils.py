@@ -1,5 +1,7 @@
 import csv
 import re
+import concurrent.futures
+from collections import deque
 
 import yaml
 
@@ -68,4 +70,29 @@ def create_prompt(class_percentages, prompt_template):
     class_descriptions = ", ".join([f"{class_name} {percentage:.2f}%"
                                   for class_name, percentage in class_percentages])
     prompt = prompt_template.format(class_descriptions=class_descriptions)
-    return prompt
\ No newline at end of file
+    return prompt
+
+
+def stream_map(func, items, max_workers, executor=None):
+    """
+    Apply func to a stream of items with a thread pool, yielding results in input order.
+
+    Unlike Executor.map this does not consume the whole input first, so results
+    flow downstream while the upstream stage is still producing items. An
+    existing executor (e.g. a process pool) can be passed instead.
+    """
+    max_in_flight = max_workers * 2
+    pending = deque()
+    own_executor = executor is None
+    if own_executor:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= max_in_flight:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        if own_executor:
+            executor.shutdown(wait=True)
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from packed_masks import (PACKED_HEADER, load_packed_masks, write_packed_masks, pack_masks, unpack_masks,
+                          unpack_class_coded, count_foreground, packed_bbox)
+
+
+def random_masks(n=6, height=11, width=13, foreground_value=255, seed=0):
+    """Binary masks with a width that is not a multiple of 8, including an empty and a full mask."""
+    rng = np.random.default_rng(seed)
+    masks = np.where(rng.random((n, height, width)) < 0.3, np.uint8(foreground_value), np.uint8(0))
+    masks[0] = 0
+    masks[1] = foreground_value
+    return masks
+
+
+def numpy_bbox(mask):
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if rows.size == 0:
+        return [-1, -1, -1, -1]
+    return [rows[0], cols[0], rows[-1] + 1, cols[-1] + 1]
+
+
+def test_pack_unpack_round_trip():
+    masks = random_masks()
+    packed = pack_masks(masks)
+    assert packed.shape == (6, 11, 2)
+    np.testing.assert_array_equal(unpack_masks(packed, 13), masks)
+    np.testing.assert_array_equal(unpack_masks(packed, 13, value=1), masks // 255)
+
+
+def test_sgpk_file_round_trip(tmp_path):
+    masks = random_masks(n=10, foreground_value=1)
+    path = tmp_path / "masks.sgpk"
+    write_packed_masks(path, masks, foreground_value=1, chunk_rows=3)
+    assert path.stat().st_size == PACKED_HEADER.size + 10 * 11 * 2
+
+    loaded = load_packed_masks(path)
+    assert loaded.shape == masks.shape
+    assert loaded.foreground_value == 1
+    np.testing.assert_array_equal(np.asarray(loaded), masks)
+    np.testing.assert_array_equal(np.asarray(loaded[4:7]), masks[4:7])
+
+
+def test_write_rejects_non_binary_masks(tmp_path):
+    masks = random_masks()
+    masks[3, 0, 0] = 7
+    with pytest.raises(ValueError):
+        write_packed_masks(tmp_path / "masks.sgpk", masks)
+
+
+def test_load_rejects_other_files(tmp_path):
+    path = tmp_path / "masks.sgpk"
+    path.write_bytes(b"NOTMASKS" + bytes(PACKED_HEADER.size))
+    with pytest.raises(ValueError):
+        load_packed_masks(path)
+
+
+def test_count_foreground_and_bbox_match_numpy():
+    masks = random_masks(n=8, height=17, width=21, seed=1)
+    masks[2] = 0
+    masks[2, 5:9, 14:19] = 255
+    packed = pack_masks(masks)
+    np.testing.assert_array_equal(count_foreground(packed), np.count_nonzero(masks, axis=(1, 2)))
+    np.testing.assert_array_equal(packed_bbox(packed, 21), [numpy_bbox(mask) for mask in masks])
+
+
+def test_unpack_class_coded():
+    masks = random_masks(n=3)
+    coded = unpack_class_coded(pack_masks(masks), 13, [1, 4, 9])
+    np.testing.assert_array_equal(coded, (masks != 0) * np.array([1, 4, 9], dtype=np.uint8)[:, None, None])
@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+
+from rle import (encode_rle, decode_rle, compress_counts, decompress_counts, rle_area, rle_bbox, rle_crop_area,
+                 sample_crops)
+from synthetic_data import generate_tile
+
+
+def example_masks():
+    """Edge cases plus synthetic SegPath masks of a sparse and a dense class."""
+    rng = np.random.default_rng(0)
+    masks = [
+        np.zeros((7, 5), dtype=np.uint8),
+        np.full((7, 5), 255, dtype=np.uint8),
+        np.eye(6, dtype=np.uint8) * 255,
+        (rng.random((9, 13)) < 0.5).astype(np.uint8),
+    ]
+    # One pixel in the first and the last position, and a run spanning two columns
+    corners = np.zeros((4, 3), dtype=np.uint8)
+    corners[0, 0] = corners[-1, -1] = 1
+    spanning = np.zeros((4, 3), dtype=np.uint8)
+    spanning[2:, 0] = spanning[:1, 1] = 1
+    masks += [corners, spanning]
+    for class_index, tissue_dir in enumerate(["CD235a_RBC", "panCK_Epithelium"]):
+        for tile_index in range(4):
+            masks.append(generate_tile(tissue_dir, class_index, tile_index, tile_size=96)[2])
+    return masks
+
+
+def numpy_bbox(mask):
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if rows.size == 0:
+        return (-1, -1, -1, -1)
+    return (int(rows[0]), int(cols[0]), int(rows[-1]) + 1, int(cols[-1]) + 1)
+
+
+@pytest.mark.parametrize("mask", example_masks())
+def test_encode_decode_round_trip(mask):
+    rle = encode_rle(mask)
+    assert rle["size"] == list(mask.shape)
+    assert sum(rle["counts"]) == mask.size
+    np.testing.assert_array_equal(decode_rle(rle), mask != 0)
+
+
+@pytest.mark.parametrize("mask", example_masks())
+def test_compressed_counts_round_trip(mask):
+    counts = encode_rle(mask)["counts"]
+    assert decompress_counts(compress_counts(counts)) == counts
+
+
+@pytest.mark.parametrize("mask", example_masks())
+def test_area_and_bbox_match_numpy(mask):
+    rle = encode_rle(mask)
+    assert rle_area(rle) == np.count_nonzero(mask)
+    assert rle_bbox(rle) == numpy_bbox(mask)
+
+
+@pytest.mark.parametrize("mask", example_masks())
+def test_crop_area_matches_numpy(mask):
+    rle = encode_rle(mask)
+    height, width = mask.shape
+    rng = np.random.default_rng(1)
+    crops = [(0, 0, height, width), (0, 0, 0, 0)]
+    for _ in range(20):
+        y0, y1 = sorted(rng.integers(0, height + 1, size=2))
+        x0, x1 = sorted(rng.integers(0, width + 1, size=2))
+        crops.append((y0, x0, y1, x1))
+    for y0, x0, y1, x1 in crops:
+        assert rle_crop_area(rle, y0, x0, y1, x1) == np.count_nonzero(mask[y0:y1, x0:x1])
+
+
+def test_sample_crops_fraction():
+    mask = generate_tile("panCK_Epithelium", 7, 1, tile_size=96)[2]
+    crops = sample_crops(encode_rle(mask), 32, num_crops=5, min_fraction=0.2, seed=0)
+    assert crops
+    for y0, x0, y1, x1, fraction in crops:
+        assert (y1 - y0, x1 - x0) == (32, 32)
+        assert fraction >= 0.2
+        assert fraction == np.count_nonzero(mask[y0:y1, x0:x1]) / 32 ** 2
+
+
+def test_sample_crops_rejects_large_crops():
+    with pytest.raises(ValueError):
+        sample_crops(encode_rle(np.zeros((8, 8), dtype=np.uint8)), 9)
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+from sampling import stratify, allocate_round, stratified_percentages
+from synthetic_data import CLASS_SPARSITY, generate_tile
+
+TILES_PER_CLASS = 40
+
+
+@pytest.fixture(scope="module")
+def dataset():
+    """Per-tile 256-entry label counts of a synthetic dataset, foreground coded as class index + 1, by class."""
+    counts = {}
+    for class_index, tissue_dir in enumerate(CLASS_SPARSITY):
+        tiles = []
+        for tile_index in range(TILES_PER_CLASS):
+            mask = generate_tile(tissue_dir, class_index, tile_index, tile_size=64)[2]
+            tiles.append(np.bincount(np.where(mask != 0, class_index + 1, 0).ravel(), minlength=256))
+        counts[tissue_dir] = np.array(tiles)
+    return counts
+
+
+def exact_percentages(counts):
+    total = sum(tiles.sum(axis=0) for tiles in counts.values())
+    return 100 * total / total.sum()
+
+
+def test_full_sample_is_exact(dataset):
+    population = {class_name: len(tiles) for class_name, tiles in dataset.items()}
+    percentages, half_widths = stratified_percentages(dataset, population)
+    np.testing.assert_allclose(percentages, exact_percentages(dataset))
+    np.testing.assert_array_equal(half_widths, 0)
+
+
+def test_partial_sample_interval_covers_exact_percentages(dataset):
+    population = {class_name: len(tiles) for class_name, tiles in dataset.items()}
+    samples = {class_name: tiles[:TILES_PER_CLASS // 2] for class_name, tiles in dataset.items()}
+    percentages, half_widths = stratified_percentages(samples, population, confidence=0.99)
+    exact = exact_percentages(dataset)
+    assert np.all(np.isfinite(half_widths))
+    assert np.all(half_widths[exact == 0] == 0)
+    assert np.all(np.abs(percentages - exact) <= half_widths)
+    assert 0 < half_widths.max() < 5
+
+
+def test_single_sampled_mask_gives_infinite_intervals(dataset):
+    population = {class_name: len(tiles) for class_name, tiles in dataset.items()}
+    samples = {class_name: tiles[:1 if class_name == "CD235a_RBC" else 5] for class_name, tiles in dataset.items()}
+    _, half_widths = stratified_percentages(samples, population)
+    assert np.all(np.isinf(half_widths))
+
+
+def test_empty_sample():
+    percentages, half_widths = stratified_percentages({}, {"CD235a_RBC": 3})
+    np.testing.assert_array_equal(percentages, 0)
+    assert np.all(np.isinf(half_widths))
+
+
+def test_allocate_round():
+    population = {"a": 900, "b": 90, "c": 10}
+    allocation = allocate_round(population, {"a": 0, "b": 0, "c": 0}, round_size=100, min_per_stratum=5)
+    assert allocation == {"a": 90, "b": 9, "c": 5}
+    allocation = allocate_round(population, {"a": 890, "b": 0, "c": 8}, round_size=100, min_per_stratum=5)
+    assert allocation == {"a": 10, "b": 9, "c": 2}
+
+
+def test_stratify_groups_by_class():
+    files = [f"{tissue_dir}_000_{i:06d}_000000_mask.png" for tissue_dir in CLASS_SPARSITY for i in range(5)]
+    strata, unknown = stratify(files + ["unnamed.png"], seed=3)
+    assert unknown == 1
+    assert set(strata) == set(CLASS_SPARSITY)
+    for class_name, items in strata.items():
+        assert sorted(path for path, _ in items) == sorted(f for f in files if f.startswith(class_name))
+    assert stratify(files, seed=3)[0] == strata